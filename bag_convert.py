@@ -1,4 +1,4 @@
-from pyservica import Sip
+from pyservica import Sip, log_to_console
 import bagit
 from pathlib import Path
 import sys
@@ -36,4 +36,5 @@ def main(bagdir, outdir, parent_ref, security_tag='UMA_restricted'):
     sip.close()
 
 if __name__ == '__main__':
+    log_to_console()
     main(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,135 @@
+"""Load benchmark for the preservica_API client against the local mock
+server. Reports requests/s and per-request p50/p99 latency for
+get_children, get_objectsbyid and a meta_update sync.
+
+python api_bench.py --folders 10 --items 100 --latency 0.01 --workers 8
+"""
+
+
+import time
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+from lxml import etree
+from preservica_API import preservica_session
+from preservica_API import meta_update
+from preservica_API.mock_server import mock_preservica
+
+
+def serve(conn, folders, items, latency, error_rate, page_size):
+    server = mock_preservica(
+        latency=latency, error_rate=error_rate, page_size=page_size)
+    root = server.populate(folders, items)
+    conn.send((server.host, root))
+    server.serve_forever()
+
+
+def start_server(folders, items, latency, error_rate, page_size):
+    """Runs the mock server in its own process so it doesn't compete with
+    the client for the GIL. Returns the process, host and root folder ref."""
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=serve,
+        args=(child, folders, items, latency, error_rate, page_size),
+        daemon=True)
+    proc.start()
+    host, root = parent.recv()
+    return proc, host, root
+
+
+class recorder(object):
+    """Response hook collecting per-request latencies."""
+
+    def __init__(self):
+        self.latencies = []
+
+    def __call__(self, response, *args, **kwargs):
+        self.latencies.append(response.elapsed.total_seconds())
+
+
+def session(host, limiter_max):
+    sesh = preservica_session('bench', 'bench', host, 'TEST', protocol='http')
+    sesh.limiter.maximum = limiter_max
+    return sesh
+
+
+def run(label, host, func, limiter_max):
+    sesh = session(host, limiter_max)
+    hook = recorder()
+    sesh.hooks['response'].append(hook)
+    start = time.perf_counter()
+    func(sesh)
+    duration = time.perf_counter() - start
+    lat = sorted(hook.latencies)
+    if len(lat) > 1:
+        cuts = statistics.quantiles(lat, n=100)
+        p50, p99 = cuts[49], cuts[98]
+    else:
+        p50 = p99 = lat[0] if lat else 0
+    print(
+        f'{label:<16} {len(lat):>7} requests {duration:>8.2f}s '
+        f'{len(lat) / duration:>9.1f} req/s '
+        f'p50 {p50 * 1000:>7.1f}ms p99 {p99 * 1000:>7.1f}ms')
+    sesh.close()
+
+
+def emu_export(path, folders, items, prefix='TEST'):
+    """Writes a minimal EMu 'xml for preservica' export covering every
+    asset created by mock_preservica.populate."""
+    table = etree.Element('table', name='ecatalogue')
+    irn = 0
+    for f in range(folders):
+        for i in range(items):
+            irn += 1
+            tup = etree.SubElement(table, 'tuple')
+            for name, value in (
+                    ('irn', str(irn)),
+                    ('EADUnitID', f'{prefix}.{f}.{i}'),
+                    ('EADUnitTitle', f'Updated item {prefix}.{f}.{i}'),
+                    ('EADUnitDate', '1901'),
+                    ('EADScopeAndContent', 'Scope and content')):
+                etree.SubElement(tup, 'atom', name=name).text = value
+    etree.ElementTree(table).write(path, encoding='UTF-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the API client against the mock server')
+    parser.add_argument('--folders', type=int, default=5)
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument(
+        '--latency', type=float, default=0.01,
+        help='seconds of server latency per request')
+    parser.add_argument(
+        '--errorrate', type=float, default=0,
+        help='fraction of requests answered with 503')
+    parser.add_argument('--pagesize', type=int, default=100)
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='concurrency for identifier resolution and the sync')
+    args = parser.parse_args()
+    proc, host, root = start_server(
+        args.folders, args.items, args.latency, args.errorrate, args.pagesize)
+    idents = [
+        f'TEST.{f}.{i}' for f in range(args.folders)
+        for i in range(args.items)]
+
+    def children(sesh):
+        top = sesh.get_object(sesh.make_uri(root, 'structural-objects'))
+        for folder in sesh.get_children(top):
+            sesh.get_children(folder)
+
+    def byid(sesh):
+        for ident in idents:
+            sesh.get_objectsbyid(ident)
+
+    def sync(sesh):
+        with tempfile.NamedTemporaryFile(suffix='.xml') as f:
+            emu_export(f.name, args.folders, args.items)
+            meta_update.main(f.name, sesh, workers=args.workers)
+
+    run('get_children', host, children, args.workers)
+    run('get_objectsbyid', host, byid, args.workers)
+    run('meta_update', host, sync, args.workers)
+    proc.terminate()
@@ -0,0 +1,197 @@
+"""Compares the compiled crosswalk in preservica_API.crosswalk with the
+original hand-written meta_update.build_root, checking that both produce
+byte-identical MODS and reporting records/s for each.
+
+python crosswalk_bench.py --count 20000
+"""
+
+
+import time
+import argparse
+from datetime import date
+from lxml import etree
+from preservica_API.crosswalk import build_mods
+
+nsmap = {
+    'mods': 'http://www.loc.gov/mods/v3',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+
+
+def add_field(parent, field, sourcenode, **kwargs):
+    if hasattr(sourcenode, 'text'):
+        f = etree.SubElement(
+            parent, '{http://www.loc.gov/mods/v3}'+field,
+            attrib=kwargs)
+        f.text = sourcenode.text
+
+
+def legacy_build_host(element):
+    lod = element.find('atom[@name="EADLevelAttribute"]').text
+    host = etree.Element(
+        '{http://www.loc.gov/mods/v3}relatedItem',
+        type='host', displayLabel="Part of "+lod)
+    add_field(
+        host, 'identifier', element.find('atom[@name="EADUnitID"]'),
+        type="UMA")
+    title = etree.SubElement(host, '{http://www.loc.gov/mods/v3}titleInfo')
+    add_field(title, 'title', element.find('atom[@name="EADUnitTitle"]'))
+    oinfo = etree.SubElement(host, '{http://www.loc.gov/mods/v3}originInfo')
+    add_field(
+        oinfo, 'dateCreated', element.find('atom[@name="EADUnitDate"]'))
+    for crtr in element.findall('table[@name="EADOriginationRef_tab"]/tuple'):
+        name = etree.SubElement(host, '{http://www.loc.gov/mods/v3}name')
+        add_field(
+            name, 'namePart',
+            crtr.find('atom[@name="NamFullName"]'))
+        role = etree.SubElement(name, '{http://www.loc.gov/mods/v3}role')
+        roleterm = etree.SubElement(role, '{http://www.loc.gov/mods/v3}roleterm')
+        roleterm.text = 'Creator'
+    return host
+
+
+def legacy_build_root(record):
+    root = etree.Element('{http://www.loc.gov/mods/v3}mods', nsmap=nsmap)
+    root.set('version', '3.4')
+    rinfo = etree.SubElement(root, '{http://www.loc.gov/mods/v3}recordInfo')
+    add_field(
+        rinfo, 'recordIdentifier', record.find('atom[@name="irn"]'),
+        source="EMu catalogue irn")
+    cdate = etree.SubElement(rinfo, '{http://www.loc.gov/mods/v3}recordCreationDate')
+    cdate.text = date.today().isoformat()
+    stand = etree.SubElement(rinfo, '{http://www.loc.gov/mods/v3}descriptionStandard')
+    stand.text = 'University of Melbourne Archives descriptive standards'
+    add_field(
+        root, 'identifier', record.find('atom[@name="EADUnitID"]'),
+        type="UMA")
+    title = etree.SubElement(root, '{http://www.loc.gov/mods/v3}titleInfo')
+    add_field(title, 'title', record.find('atom[@name="EADUnitTitle"]'))
+    oinfo = etree.SubElement(root, '{http://www.loc.gov/mods/v3}originInfo')
+    add_field(
+        oinfo, 'dateCreated', record.find('atom[@name="EADUnitDate"]'))
+    add_field(
+        root, 'abstract', record.find('atom[@name="EADScopeAndContent"]'),
+        displayLabel="Scope and Content")
+    for crtr in record.findall('table[@name="EADOriginationRef_tab"]/tuple'):
+        name = etree.SubElement(record, '{http://www.loc.gov/mods/v3}name')
+        add_field(
+            name, 'namePart',
+            crtr.find('atom[@name="NamFullName"]'))
+        role = etree.SubElement(name, '{http://www.loc.gov/mods/v3}role')
+        roleterm = etree.SubElement(role, '{http://www.loc.gov/mods/v3}roleterm')
+        roleterm.text = 'Creator'
+    for cont in record.findall('table[@name="contributors"]/tuple'):
+        name = etree.Element('{http://www.loc.gov/mods/v3}name')
+        add_field(
+            name, 'namePart',
+            cont.find('atom[@name="NamFullName"]'))
+        role = etree.Element('{http://www.loc.gov/mods/v3}role')
+        add_field(
+            role, 'roleTerm',
+            cont.find('atom[@name="AssRelatedPartiesRelationship"]'))
+        name.append(role)
+        root.append(name)
+    phys = etree.SubElement(
+        root, '{http://www.loc.gov/mods/v3}physicalDescription')
+    for elem in record.xpath('table[@name="EADExtent_tab"]/tuple/atom'):
+        add_field(phys, 'extent', elem)
+    for elem in record.xpath('table[@name="EADGenreForm_tab"]/tuple/atom'):
+        add_field(phys, 'form', elem)
+    for elem in record.xpath('table[@name="EADPhysicalDescription_tab"]/tuple/atom'):
+        add_field(phys, 'note', elem, displayLabel='Technical details')
+    subjects = etree.SubElement(
+        root, '{http://www.loc.gov/mods/v3}subject')
+    for elem in record.xpath('table[@name="EADSubject_tab"]/tuple/atom'):
+        add_field(subjects, 'topic', elem)
+    for elem in record.xpath('table[@name="EADName_tab"]/tuple/atom'):
+        add_field(subjects, 'name', elem)
+    for elem in record.xpath('table[@name="EADGeographicName_tab"]/tuple/atom'):
+        add_field(subjects, 'geographic', elem)
+    for elem in record.xpath('table[@name="EADPersonalName_tab"]/tuple/atom'):
+        add_field(subjects, 'name', elem)
+    for elem in record.xpath('table[@name="EADCorporateName_tab"]/tuple/atom'):
+        add_field(subjects, 'name', elem)
+    for elem in record.xpath('table[@name="EADTitle_tab"]/tuple/atom'):
+        add_field(subjects, 'titleInfo', elem)
+    add_field(
+        root, 'accessCondition',
+        record.find('atom[@name="EADAccessRestrictions"]'),
+        type="access",
+        displayLabel="Conditions governing access")
+    add_field(
+        root, 'accessCondition',
+        record.find('atom[@name="EADUseRestrictions"]'),
+        type="use",
+        displayLabel="Conditions governing use")
+    for host in record.xpath('.//tuple[@name="AssParentObjectRef"]'):
+        if host.find('atom[@name="EADLevelAttribute"]').text is not None:
+            root.append(legacy_build_host(host))
+    return root
+
+
+def atoms(parent, **values):
+    for name, value in values.items():
+        etree.SubElement(parent, 'atom', name=name).text = value
+
+
+def table(parent, name, *rows):
+    tbl = etree.SubElement(parent, 'table', name=name)
+    for row in rows:
+        atoms(etree.SubElement(tbl, 'tuple'), **row)
+    return tbl
+
+
+def records(count):
+    """Synthetic records exercising every field of the crosswalk."""
+    export = etree.Element('table', name='ecatalogue')
+    for n in range(count):
+        tup = etree.SubElement(export, 'tuple')
+        atoms(
+            tup, irn=str(n), EADUnitID=f'1990.0001.{n}',
+            EADUnitTitle=f'Correspondence {n}', EADUnitDate='1901-1910',
+            EADScopeAndContent='Letters & papers <various>',
+            EADAccessRestrictions='Open', EADUseRestrictions='Copyright')
+        table(tup, 'EADOriginationRef_tab', {'NamFullName': 'A Creator'})
+        table(
+            tup, 'contributors',
+            {'NamFullName': 'B Person', 'AssRelatedPartiesRelationship': 'Author'},
+            {'NamFullName': 'C Person'})
+        table(tup, 'EADExtent_tab', {'EADExtent': '1 box'}, {'EADExtent': '2 files'})
+        table(tup, 'EADGenreForm_tab', {'EADGenreForm': 'Letters'})
+        table(tup, 'EADPhysicalDescription_tab', {'EADPhysicalDescription': 'Paper'})
+        table(tup, 'EADSubject_tab', {'EADSubject': 'History'}, {'EADSubject': 'Trade'})
+        table(tup, 'EADName_tab', {'EADName': 'A Name'})
+        table(tup, 'EADGeographicName_tab', {'EADGeographicName': 'Melbourne'})
+        table(tup, 'EADPersonalName_tab', {'EADPersonalName': 'D Person'})
+        table(tup, 'EADCorporateName_tab', {'EADCorporateName': 'E Ltd'})
+        table(tup, 'EADTitle_tab', {'EADTitle': 'A Title'})
+        parents = etree.SubElement(tup, 'table', name='AssParentObjectRef_tab')
+        for level, ident in (('Series', '1990.0001'), (None, '1990')):
+            host = etree.SubElement(parents, 'tuple', name='AssParentObjectRef')
+            etree.SubElement(host, 'atom', name='EADLevelAttribute').text = level
+            atoms(host, EADUnitID=ident, EADUnitTitle=f'Parent {ident}')
+            table(host, 'EADOriginationRef_tab', {'NamFullName': 'Host Creator'})
+    return list(export)
+
+
+def measure(label, build, data):
+    start = time.perf_counter()
+    out = [etree.tostring(build(record), pretty_print=True) for record in data]
+    duration = time.perf_counter() - start
+    print(f'{label:<10} {len(data) / duration:>10.0f} records/s')
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the compiled crosswalk against build_root')
+    parser.add_argument(
+        '--count', type=int, default=20000, help='number of records')
+    args = parser.parse_args()
+    # the legacy function adds elements to the records it is given, so each
+    # gets its own copy
+    legacy = measure('legacy', legacy_build_root, records(args.count))
+    compiled = measure('compiled', build_mods, records(args.count))
+    mismatches = sum(1 for a, b in zip(legacy, compiled) if a != b)
+    print(f'{args.count - mismatches} of {args.count} records byte-identical')
+    if mismatches:
+        raise SystemExit(1)
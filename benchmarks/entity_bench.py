@@ -0,0 +1,120 @@
+"""Compares memory use and parse throughput of preservica_API.entity with the
+original implementation, which kept the full response tree on every object.
+
+python entity_bench.py --count 5000
+"""
+
+
+import gc
+import time
+import argparse
+import resource
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from preservica_API import entity
+
+RESPONSE = """<EntityResponse xmlns="http://preservica.com/EntityAPI/v6.0" xmlns:xip="http://preservica.com/XIP/v6.0">
+  <xip:InformationObject>
+    <xip:Ref>{ref}</xip:Ref>
+    <xip:Title>Item {n}</xip:Title>
+    <xip:Description>A description of item {n} that is long enough to be typical of the catalogue.</xip:Description>
+    <xip:SecurityTag>open</xip:SecurityTag>
+    <xip:Parent>a4e1f0a2-5fe8-4c3c-8ed6-0c6d3c0cf1a7</xip:Parent>
+  </xip:InformationObject>
+  <AdditionalInformation>
+    <Self>https://example.preservica.com/api/entity/information-objects/{ref}</Self>
+    <Parent>https://example.preservica.com/api/entity/structural-objects/a4e1f0a2-5fe8-4c3c-8ed6-0c6d3c0cf1a7</Parent>
+    <Identifiers>https://example.preservica.com/api/entity/information-objects/{ref}/identifiers</Identifiers>
+    <Links>https://example.preservica.com/api/entity/information-objects/{ref}/links</Links>
+    <Representations>https://example.preservica.com/api/entity/information-objects/{ref}/representations</Representations>
+    <Metadata>
+      <Fragment schema="http://www.loc.gov/mods/v3">https://example.preservica.com/api/entity/information-objects/{ref}/metadata/{n}-1</Fragment>
+      <Fragment schema="http://preservica.com/ExtendedXIP/v6.0">https://example.preservica.com/api/entity/information-objects/{ref}/metadata/{n}-2</Fragment>
+    </Metadata>
+  </AdditionalInformation>
+</EntityResponse>"""
+
+
+class legacy_entity(object):
+    """preservica_API.entity as it was before fields were extracted in a
+    single pass."""
+
+    def __init__(self, element):
+        self.xmlResponse = element
+        self.type = element[0].tag.split('}')[1]
+        self.XIP = element[0]
+        self.ref = element.findtext(
+            f'xip:{self.type}/xip:Ref', namespaces=element.nsmap)
+        self.title = element.findtext(
+            f'xip:{self.type}/xip:Title', namespaces=element.nsmap)
+        self.securityTag = element.findtext(
+            f'xip:{self.type}/xip:SecurityTag', namespaces=element.nsmap)
+        self.parentRef = element.findtext(
+            f'xip:{self.type}/xip:Parent', namespaces=element.nsmap)
+        self.uri = element.findtext(
+            'AdditionalInformation/Self', namespaces=element.nsmap)
+        self.parentUri = element.findtext(
+            'AdditionalInformation/Self', namespaces=element.nsmap)
+        self.children = element.findtext(
+            'AdditionalInformation/Children', namespaces=element.nsmap)
+        self.metadata = []
+        for frag in element.findall('.//Metadata/Fragment', namespaces=element.nsmap):
+            self.metadata.append({'schema': frag.get('schema'), 'uri': frag.text})
+
+
+def responses(count):
+    return [
+        RESPONSE.format(ref=f'00000000-0000-0000-0000-{n:012d}', n=n).encode()
+        for n in range(count)]
+
+
+def rss():
+    """Resident set size in bytes, which unlike tracemalloc includes the
+    memory libxml2 allocates for retained trees. Linux only."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+BUILDERS = {
+    'legacy': lambda c: legacy_entity(etree.fromstring(c)),
+    'entity': entity.from_bytes,
+    'keep_xml': lambda c: entity.from_bytes(c, keep_xml=True)}
+
+
+def measure(label, count):
+    """Builds count entities with the named builder, returning the
+    throughput and retained memory per entity."""
+    data = responses(count)
+    build = BUILDERS[label]
+    gc.collect()
+    before = rss()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objects = [build(content) for content in data]
+    duration = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    after = rss()
+    assert all(o.ref is not None and len(o.metadata) == 2 for o in objects)
+    return count / duration, current / count, (after - before) / count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark entity parsing and memory use')
+    parser.add_argument(
+        '--count', type=int, default=5000, help='number of entities')
+    args = parser.parse_args()
+    for label in BUILDERS:
+        # a fresh process per variant so retained memory doesn't accumulate
+        with ProcessPoolExecutor(1) as ex:
+            rate, heap, resident = ex.submit(measure, label, args.count).result()
+        print(
+            f'{label:<10} {rate:>10.0f} entities/s '
+            f'{heap / 1024:>8.2f} kb/entity python heap '
+            f'{resident / 1024:>8.2f} kb/entity resident')
@@ -0,0 +1,75 @@
+"""Measures how long the pyservica command takes to start, against importing
+the libraries directly, and fails if the command starts loading heavy
+dependencies or gets slower than --limit milliseconds. Each measurement is
+a fresh interpreter, best of --repeats.
+
+python import_bench.py --repeats 10 --limit 150
+"""
+
+
+import sys
+import time
+import argparse
+import subprocess
+
+HEAVY = ('lxml', 'requests', 'boto3', 'botocore')
+CASES = {
+    'python': 'pass',
+    'pyservica --help': (
+        'import sys; sys.argv = ["pyservica", "--help"]\n'
+        'from pyservica.cli import main\n'
+        'try:\n    main()\nexcept SystemExit:\n    pass'),
+    'import xip_builder': 'import xip_builder',
+    'import preservica_API': 'import preservica_API',
+    'import preservica_API.s3upload': 'import preservica_API.s3upload',
+}
+
+
+def best_of(code, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', code], check=True,
+            stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def heavy_imports(code):
+    check = code + (
+        '\nimport sys\n'
+        f'print(",".join(m for m in {HEAVY!r} if m in sys.modules), '
+        'file=sys.stderr)')
+    return subprocess.run(
+        [sys.executable, '-c', check], check=True, capture_output=True,
+        text=True).stderr.strip()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument(
+        '--limit', type=float, default=150,
+        help='most milliseconds pyservica --help may take over bare python')
+    args = parser.parse_args()
+    results = {}
+    for name, code in CASES.items():
+        try:
+            results[name] = best_of(code, args.repeats)
+        except subprocess.CalledProcessError:
+            print(f'{name:<32} failed (missing dependency?)')
+            continue
+        print(f'{name:<32} {results[name]:8.1f}ms')
+    failures = []
+    loaded = heavy_imports(CASES['pyservica --help'])
+    if loaded:
+        failures.append(f'pyservica --help imports {loaded}')
+    overhead = results['pyservica --help'] - results['python']
+    if overhead > args.limit:
+        failures.append(
+            f'pyservica --help takes {overhead:.1f}ms over python, limit '
+            f'{args.limit}ms')
+    for failure in failures:
+        print('FAIL', failure)
+    sys.exit(1 if failures else 0)
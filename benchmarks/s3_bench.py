@@ -0,0 +1,69 @@
+"""Compares upload throughput of the fixed transfer settings s3upload used to
+have (multipart only above 1gb) with the adaptive settings chosen by
+transfer_config, across a range of package sizes. Needs an S3 compatible
+endpoint, e.g. moto_server or MinIO running locally.
+
+python s3_bench.py --endpoint-url http://localhost:5000 --sizes 8 64 256
+"""
+
+
+import os
+import time
+import argparse
+import tempfile
+import statistics
+import boto3
+from boto3.s3.transfer import TransferConfig
+from preservica_API import s3upload
+from preservica_API.s3upload import MB, GB
+
+LEGACY = TransferConfig(multipart_threshold=GB)
+
+
+def make_package(directory, size):
+    path = os.path.join(directory, f'{size // MB}mb.zip')
+    with open(path, 'wb') as f:
+        for _ in range(size // MB):
+            f.write(os.urandom(MB))
+    return path
+
+
+def timed_upload(bucket, path, config, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with open(path, 'rb') as data:
+            bucket.upload_fileobj(data, 'bench', Config=config)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--endpoint-url', required=True)
+    parser.add_argument('--bucket', default='s3-bench')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[8, 64, 256],
+        help='Package sizes in mb')
+    parser.add_argument('--sockets', type=int, default=s3upload.MAX_SOCKETS)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    bucket = s3upload.get_client(
+        args.bucket, max_sockets=args.sockets, endpoint_url=args.endpoint_url)
+    try:
+        bucket.create()
+    except bucket.meta.client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    print(f'{"size":>8} {"legacy mb/s":>12} {"adaptive mb/s":>14} '
+          f'{"part":>6} {"conns":>6}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = make_package(tmp, size * MB)
+            config = s3upload.transfer_config(
+                size * MB, max_concurrency=args.sockets)
+            legacy = timed_upload(bucket, path, LEGACY, args.repeats)
+            adaptive = timed_upload(bucket, path, config, args.repeats)
+            print(f'{size:>6}mb {size / legacy:>12.1f} {size / adaptive:>14.1f} '
+                  f'{config.multipart_chunksize // MB:>4}mb '
+                  f'{config.max_concurrency:>6}')
+            os.remove(path)
@@ -1,17 +1,26 @@
+import os
 import time
 import pathlib
 import sys
 import requests
 import datetime
 import json
-from threading import Thread
+import random
+import shutil
+import hashlib
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from bisect import bisect_left
+from collections import OrderedDict
+import queue
+from contextlib import contextmanager
+from threading import Lock, Condition, get_ident
 from io import BytesIO
 from lxml import etree
 import logging
 import argparse
 import subprocess
 FORMAT = '%(asctime)-15s [%(levelname)s] %(message)s'
-logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('siplog')
 logger.setLevel(logging.INFO)
 ENT_MAP = {
@@ -22,48 +31,611 @@ TYPE_MAP = {
     "IO": "information-objects",
     "SO": "structural-objects",
     "CO": "content-objects"}
+SCHEMAS = {
+    "MODS": "http://www.loc.gov/mods/v3",
+    "ExtendedXIP": "http://preservica.com/ExtendedXIP/v6.0"}
+RETRY_STATUSES = (429, 502, 503, 504)
+# statuses meaning the request wasn't acted on, so safe to retry any method
+REJECTED_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+
+XIP_FIELDS = {
+    'Ref': 'ref',
+    'Title': 'title',
+    'SecurityTag': 'securityTag',
+    'Parent': 'parentRef'}
+INFO_FIELDS = {
+    'Self': 'uri',
+    'Parent': 'parentUri',
+    'Children': 'children'}
+
+
+XIP_ORDER = [
+    'Ref', 'Title', 'Description', 'SecurityTag', 'CustodialHistory',
+    'Parent']
+
+
+def log_to_console():
+    """Sends log messages to the console. Called by the command line
+    scripts; importing the package leaves logging to the application."""
+    logging.basicConfig(format=FORMAT)
+
+
+def _insert_xip(xip, tag):
+    """Adds an empty tag to an entity's XIP, in schema order."""
+    elem = etree.Element(etree.QName(xip, tag))
+    later = XIP_ORDER[XIP_ORDER.index(tag)+1:] if tag in XIP_ORDER else []
+    for child in xip.iterchildren(tag=etree.Element):
+        if _localname(child) in later:
+            child.addprevious(elem)
+            return elem
+    xip.append(elem)
+    return elem
+
+
+def _localname(element):
+    return element.tag.rpartition('}')[2]
 
 
 class entity(object):
-    """Class that parses out an xml response into useful attributes."""
-
-    def __init__(self, element):
-        self.xmlResponse = element
-        self.type = element[0].tag.split('}')[1]
-        self.XIP = element[0]
-        self.ref = element.findtext(
-            f'xip:{self.type}/xip:Ref', namespaces=element.nsmap)
-        self.title = element.findtext(
-            f'xip:{self.type}/xip:Title', namespaces=element.nsmap)
-        self.securityTag = element.findtext(
-            f'xip:{self.type}/xip:SecurityTag', namespaces=element.nsmap)
-        self.parentRef = element.findtext(
-            f'xip:{self.type}/xip:Parent', namespaces=element.nsmap)
-        self.uri = element.findtext(
-            'AdditionalInformation/Self', namespaces=element.nsmap)
-        self.parentUri = element.findtext(
-            'AdditionalInformation/Parent', namespaces=element.nsmap)
-        self.parentUri = element.findtext(
-            'AdditionalInformation/Self', namespaces=element.nsmap)
-        self.children = element.findtext(
-            'AdditionalInformation/Children', namespaces=element.nsmap)
-        self.metadata = []
-        for frag in element.findall('.//Metadata/Fragment', namespaces=element.nsmap):
-            self.metadata.append({'schema': frag.get('schema'), 'uri': frag.text})
+    """Class that parses out an xml response into useful attributes. Fields
+    are extracted in a single pass over the response, which is then dropped
+    unless keep_xml is set, so large numbers of entities can be held
+    cheaply. xmlResponse and XIP are None for entities without the XML."""
+
+    __slots__ = (
+        'type', 'ref', 'title', 'securityTag', 'parentRef', 'uri',
+        'parentUri', 'children', 'depth', '_fragments', '_response')
+
+    def __init__(self, element, keep_xml=False):
+        xip = element[0]
+        self.type = _localname(xip)
+        self.ref = self.title = self.securityTag = self.parentRef = None
+        self.uri = self.parentUri = self.children = self.depth = None
+        fragments = []
+        for child in xip.iterchildren(tag=etree.Element):
+            attr = XIP_FIELDS.get(_localname(child))
+            if attr is not None:
+                setattr(self, attr, child.text)
+        for info in element.iterchildren(tag=etree.Element):
+            if _localname(info) != 'AdditionalInformation':
+                continue
+            for child in info.iterchildren(tag=etree.Element):
+                name = _localname(child)
+                if name == 'Metadata':
+                    for frag in child.iterchildren(tag=etree.Element):
+                        fragments.append((frag.get('schema'), frag.text))
+                elif name in INFO_FIELDS:
+                    setattr(self, INFO_FIELDS[name], child.text)
+        self._fragments = tuple(fragments)
+        self._response = element if keep_xml else None
+
+    @classmethod
+    def from_bytes(cls, content, keep_xml=False):
+        return cls(etree.fromstring(content), keep_xml=keep_xml)
+
+    @property
+    def xmlResponse(self):
+        return self._response
+
+    @property
+    def XIP(self):
+        if self._response is None:
+            return None
+        return self._response[0]
+
+    @property
+    def metadata(self):
+        """List of dicts with the schema and uri of each metadata fragment."""
+        return [{'schema': schema, 'uri': uri} for schema, uri in self._fragments]
 
     def __repr__(self):
         return f'<{self.title}: {self.ref}>'
 
 
+def select_fragments(object, schemas=None):
+    """Returns the metadata fragment dicts of object whose schema is in
+    schemas, which may be namespaces or keys of SCHEMAS. No filtering is
+    done if schemas is None."""
+    if schemas is None:
+        return object.metadata
+    schemas = {SCHEMAS.get(schema, schema) for schema in schemas}
+    return [frag for frag in object.metadata if frag['schema'] in schemas]
+
+
+class entity_cache(object):
+    """In-memory LRU cache of entity responses with a time to live, and an
+    optional on-disk tier in cache_dir. Responses are stored as raw bytes
+    along with any ETag or Last-Modified validators the server sent, so
+    expired entries can be revalidated with a conditional request rather
+    than downloaded again. On disk, everything cached under an entity's uri
+    is kept in one directory so it can be dropped with the entity."""
+
+    def __init__(self, maxsize=1024, ttl=300, cache_dir=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = pathlib.Path(cache_dir).expanduser()
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _entity_uri(uri):
+        """The uri of the entity that uri belongs to, e.g. for a
+        metadata fragment, or uri itself if it isn't under an entity."""
+        head, sep, tail = uri.partition('/api/entity/')
+        if not sep:
+            return uri
+        return head + sep + '/'.join(tail.split('/')[:2])
+
+    def _entitydir(self, uri):
+        name = hashlib.sha1(self._entity_uri(uri).encode()).hexdigest()
+        return self.cache_dir / name[:2] / name
+
+    def _diskpath(self, uri):
+        return self._entitydir(uri) / hashlib.sha1(uri.encode()).hexdigest()
+
+    def _read_disk(self, uri):
+        fpath = self._diskpath(uri)
+        meta = fpath.with_suffix('.json')
+        if not meta.exists():
+            return None
+        try:
+            with meta.open() as f:
+                entry = json.load(f)
+            entry['content'] = fpath.read_bytes()
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _write_disk(self, uri, entry):
+        """Writes the body, then its validators, each through a temporary
+        file replaced into place, so a concurrent reader never sees either
+        part written."""
+        fpath = self._diskpath(uri)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp = fpath.with_name(f'{fpath.name}.{get_ident()}.tmp')
+        tmp.write_bytes(entry['content'])
+        os.replace(tmp, fpath)
+        meta = {k: v for k, v in entry.items() if k != 'content'}
+        meta['uri'] = uri
+        with tmp.open('w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, fpath.with_suffix('.json'))
+
+    def _remove_disk(self, uri):
+        """Removes uri and anything cached beneath it from disk."""
+        entitydir = self._entitydir(uri)
+        if self._entity_uri(uri) == uri:
+            shutil.rmtree(entitydir, ignore_errors=True)
+            return
+        for meta in entitydir.glob('*.json'):
+            try:
+                with meta.open() as f:
+                    cached = json.load(f).get('uri', '')
+            except (OSError, ValueError):
+                cached = ''
+            if cached == uri or cached.startswith(uri+'/'):
+                for p in (meta, meta.with_suffix('')):
+                    try:
+                        p.unlink()
+                    except FileNotFoundError:
+                        pass
+
+    def lookup(self, uri):
+        """Returns a tuple of (entry, fresh) for uri, where entry is None if
+        nothing is cached and fresh is False if the entry has outlived the
+        ttl and should be revalidated."""
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is not None:
+                self._entries.move_to_end(uri)
+        if entry is None and self.cache_dir is not None:
+            entry = self._read_disk(uri)
+            if entry is not None:
+                self._store(uri, entry)
+        if entry is None:
+            return None, False
+        return entry, time.time() - entry['stored'] < self.ttl
+
+    def _store(self, uri, entry):
+        with self._lock:
+            self._entries[uri] = entry
+            self._entries.move_to_end(uri)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def store(self, uri, response):
+        """Caches the body and validators of a successful response."""
+        entry = {
+            'content': response.content,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'stored': time.time()}
+        self._store(uri, entry)
+        if self.cache_dir is not None:
+            self._write_disk(uri, entry)
+        return entry
+
+    def touch(self, uri, entry):
+        """Marks a revalidated entry as fresh again."""
+        entry['stored'] = time.time()
+        self._store(uri, entry)
+        if self.cache_dir is not None:
+            self._write_disk(uri, entry)
+
+    def invalidate(self, uri):
+        """Drops uri and anything cached beneath it."""
+        uri = uri.rstrip('/')
+        with self._lock:
+            stale = [
+                k for k in self._entries
+                if k == uri or k.startswith(uri+'/')]
+            for k in stale:
+                del self._entries[k]
+        if self.cache_dir is not None:
+            self._remove_disk(uri)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.cache_dir is not None:
+            for fpath in self.cache_dir.glob('*/*'):
+                if fpath.is_dir():
+                    shutil.rmtree(fpath, ignore_errors=True)
+                else:
+                    fpath.unlink()
+
+    def count(self, hit, revalidated=False):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if revalidated:
+                self.revalidated += 1
+
+    def stats(self):
+        """Returns hit, miss and revalidation counts."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'size': len(self._entries),
+            'hit_ratio': self.hits / lookups if lookups else 0.0}
+
+
+class aimd_limiter(object):
+    """Caps the number of requests in flight, adjusting the cap additively
+    upwards while requests succeed and multiplicatively downwards when the
+    server signals overload (AIMD). One limiter is shared by everything
+    using a session, so concurrent callers back off together."""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5,
+                 cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._inflight = 0
+        self._last_decrease = 0
+        self._cond = Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, success=True):
+        """Frees a slot. Successes grow the limit by one per window of limit
+        requests; failures shrink it, at most once per cooldown seconds so a
+        burst of rejections counts as a single congestion event."""
+        with self._cond:
+            self._inflight -= 1
+            if success:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif time.monotonic() - self._last_decrease > self.cooldown:
+                self._last_decrease = time.monotonic()
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                logger.info(f'Throttled, concurrency limit now {int(self.limit)}')
+            self._cond.notify_all()
+
+
+class token_manager(object):
+    """Holds the access token for one login and renews it ahead of expiry.
+    A single manager can be shared by any number of sessions and threads;
+    the token is renewed on demand by whichever caller first finds it close
+    to expiry, rather than by a background timer."""
+
+    def __init__(self, authenturl, login, password, tenant, margin=60):
+        self.authenturl = authenturl
+        self.tenant = tenant
+        self.margin = margin
+        self._login = login
+        self._password = password
+        self._http = requests.Session()
+        self._lock = Lock()
+        self.token = None
+        self.refresh_token = None
+        self._expires = 0
+
+    def _store(self, data):
+        self.token = data["token"]
+        self.refresh_token = data["refresh-token"]
+        # validFor is in minutes, tokens last 15 minutes by default
+        self._expires = time.monotonic() + 60 * float(data.get("validFor", 15))
+
+    def login(self):
+        """Gets a new access token with the stored credentials."""
+        url = self.authenturl+"/login"
+        querystring = {
+            "username": self._login, "password": self._password,
+            "tenant": self.tenant}
+        logging.info("Authenticating with Preservica")
+        response = self._http.post(url, data=querystring)
+        if response.status_code == 200:
+            self._store(response.json())
+        else:
+            logging.error(f"Unable to authenticate, received status code {response.status_code}")
+            print(response.text)
+
+    def refresh(self):
+        """Renews the token with the refresh token, logging in again if the
+        refresh is refused."""
+        url = self.authenturl+"/refresh"
+        logging.info("Refreshing authentication token")
+        response = self._http.post(
+            url, data={"refreshToken": self.refresh_token})
+        if response.status_code == 200:
+            self._store(response.json())
+        else:
+            self.login()
+
+    def get(self, force=False):
+        """Returns a valid access token. A token inside the expiry margin is
+        renewed by one caller while the others carry on with it; an expired
+        token blocks everyone until it is renewed. force renews regardless,
+        eg after the server has rejected the token."""
+        now = time.monotonic()
+        if not force and now < self._expires - self.margin:
+            return self.token
+        if not force and now < self._expires:
+            if self._lock.acquire(blocking=False):
+                try:
+                    if time.monotonic() >= self._expires - self.margin:
+                        self.refresh()
+                finally:
+                    self._lock.release()
+            return self.token
+        token = self.token
+        with self._lock:
+            if self.token == token:
+                if self.refresh_token is None:
+                    self.login()
+                else:
+                    self.refresh()
+        return self.token
+
+    def revoke(self):
+        if self.token is not None:
+            self._http.post(
+                self.authenturl+"/revoke", params={"access-token": self.token})
+            self.token = None
+        self._http.close()
+
+
+class progress_reader(object):
+    """Wraps a file opened for upload, reporting each block read to
+    callback. Rewinding (eg for a retry) reports a negative amount."""
+
+    def __init__(self, f, callback):
+        self._f = f
+        self._callback = callback
+        self._size = pathlib.Path(f.name).stat().st_size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        block = self._f.read(size)
+        if block:
+            self._callback(len(block))
+        return block
+
+    def tell(self):
+        return self._f.tell()
+
+    def seek(self, offset, whence=0):
+        before = self._f.tell()
+        after = self._f.seek(offset, whence)
+        if after != before:
+            self._callback(after - before)
+        return after
+
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def endpoint(url):
+    """Names the kind of API call a url is, for grouping request metrics."""
+    path = urlsplit(url).path.rstrip('/')
+    if path.endswith('/accesstoken') or '/accesstoken/' in path:
+        return 'token'
+    if '/by-identifier' in path:
+        return 'by-identifier'
+    if path.endswith('/children'):
+        return 'children'
+    if '/metadata' in path:
+        return 'metadata'
+    if 'upload' in path:
+        return 'upload'
+    if path.endswith('/security-tag'):
+        return 'security-tag'
+    if path.endswith('/identifiers'):
+        return 'identifiers'
+    if '/api/entity/' in path:
+        return 'entity'
+    return 'other'
+
+
+class request_metrics(object):
+    """Per endpoint and method counts of requests, response statuses, bytes
+    sent and received and a latency histogram. Installed on a session with
+    enable_metrics, and shared by its workers. Latency is the time to the
+    response headers and bytes come from Content-Length, so reading the
+    metrics never forces a response body to be downloaded. Requests that
+    fail without a response are counted under the status 'error'."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = Lock()
+
+    def _get(self, key):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {
+                'count': 0, 'statuses': {}, 'bytes_sent': 0,
+                'bytes_received': 0, 'latency_sum': 0.0,
+                'latency_buckets': [0] * (len(self.buckets) + 1)}
+        return series
+
+    def record(self, method, url, status, seconds=None, sent=0, received=0):
+        key = (endpoint(url), method.upper())
+        with self._lock:
+            series = self._get(key)
+            series['count'] += 1
+            series['statuses'][status] = series['statuses'].get(status, 0) + 1
+            series['bytes_sent'] += sent
+            series['bytes_received'] += received
+            if seconds is not None:
+                series['latency_sum'] += seconds
+                series['latency_buckets'][bisect_left(self.buckets, seconds)] += 1
+
+    def hook(self, response, *args, **kwargs):
+        """requests response hook."""
+        request = response.request
+        self.record(
+            request.method, request.url, str(response.status_code),
+            seconds=response.elapsed.total_seconds(),
+            sent=int(request.headers.get('Content-Length') or 0),
+            received=int(response.headers.get('Content-Length') or 0))
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self):
+        """Returns the metrics as a dict of endpoint: method: figures.
+        latency_buckets holds cumulative counts of requests that took at
+        most each bucket's upper bound in seconds."""
+        with self._lock:
+            series = {
+                key: dict(value, statuses=dict(value['statuses']),
+                          latency_buckets=list(value['latency_buckets']))
+                for key, value in self._series.items()}
+        snapshot = {}
+        for (name, method), value in sorted(series.items()):
+            timed = sum(value['latency_buckets'])
+            cumulative, total = [], 0
+            for bound, n in zip(self.buckets + ('+Inf',), value['latency_buckets']):
+                total += n
+                cumulative.append([bound, total])
+            value['latency_buckets'] = cumulative
+            value['latency_mean'] = value['latency_sum'] / timed if timed else 0.0
+            snapshot.setdefault(name, {})[method] = value
+        return snapshot
+
+    def json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def prometheus(self, prefix='preservica'):
+        """The metrics in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            f'# HELP {prefix}_requests_total Requests to the Preservica API.',
+            f'# TYPE {prefix}_requests_total counter']
+        for name, methods in snapshot.items():
+            for method, value in methods.items():
+                for status, n in sorted(value['statuses'].items()):
+                    lines.append(
+                        f'{prefix}_requests_total{{endpoint="{name}",'
+                        f'method="{method}",status="{status}"}} {n}')
+        lines += [
+            f'# HELP {prefix}_request_bytes_total Bytes sent and received.',
+            f'# TYPE {prefix}_request_bytes_total counter']
+        for name, methods in snapshot.items():
+            for method, value in methods.items():
+                for direction in ('sent', 'received'):
+                    lines.append(
+                        f'{prefix}_request_bytes_total{{endpoint="{name}",'
+                        f'method="{method}",direction="{direction}"}} '
+                        f'{value["bytes_" + direction]}')
+        lines += [
+            f'# HELP {prefix}_request_duration_seconds Time to response '
+            'headers.',
+            f'# TYPE {prefix}_request_duration_seconds histogram']
+        for name, methods in snapshot.items():
+            for method, value in methods.items():
+                labels = f'endpoint="{name}",method="{method}"'
+                for bound, n in value['latency_buckets']:
+                    lines.append(
+                        f'{prefix}_request_duration_seconds_bucket'
+                        f'{{{labels},le="{bound}"}} {n}')
+                lines.append(
+                    f'{prefix}_request_duration_seconds_sum{{{labels}}} '
+                    f'{value["latency_sum"]}')
+                lines.append(
+                    f'{prefix}_request_duration_seconds_count{{{labels}}} '
+                    f'{value["latency_buckets"][-1][1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the metrics to path, as JSON if it ends in .json and in
+        Prometheus text format otherwise (e.g. for the node exporter's
+        textfile collector)."""
+        path = pathlib.Path(path)
+        text = self.json() if path.suffix == '.json' else self.prometheus()
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_text(text)
+        tmp.replace(path)
+
+
 class preservica_session(requests.Session):
     """Class that handles authentication and wraps useful requests to the
-    Preservica REST API. Best used as a context manager."""
+    Preservica REST API. Best used as a context manager.
+    Requests that fail with a connection error or an overload status (429,
+    502, 503, 504) are retried up to retries times, waiting for the
+    server's Retry-After or a jittered exponential backoff. Concurrency
+    across all threads using the session is governed by limiter.
+    Sessions sharing a token are made with worker() or session_pool; the
+    session that logged in revokes the token when closed."""
 
-    def __init__(self, login, password, host, tenant):
+    def __init__(self, login, password, host, tenant, cache=None, retries=5,
+                 backoff=0.5, max_backoff=60, limiter=None, tokens=None,
+                 protocol='https', metrics=None):
         super(preservica_session, self).__init__()
         logging.info("Starting session")
         self.host = host
         self.tenant = tenant
+        self.protocol = protocol
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if limiter is None:
+            limiter = aimd_limiter()
+        self.limiter = limiter
         self.headers = {
                     'Accept': "*/*",
                     'Cache-Control': "no-cache",
@@ -73,55 +645,124 @@ class preservica_session(requests.Session):
                     'Connection': "keep-alive",
                     'cache-control': "no-cache"
                     }
-        self.baseurl = "https://"+self.host
+        self.baseurl = protocol+"://"+self.host
         self.entityurl = self.baseurl+"/api/entity"
         self.authenturl = self.baseurl+"/api/accesstoken"
-        self.get_token(login, password)
+        self.mount(self.baseurl, requests.adapters.HTTPAdapter(
+            pool_maxsize=self.limiter.maximum))
+        self.metrics = None
+        if metrics is not None:
+            self.enable_metrics(metrics)
+        self.tokens = tokens
+        self._owns_token = tokens is None
+        if tokens is None:
+            self.get_token(login, password)
+
+    def _retry_delay(self, attempt, response=None):
+        """Seconds to wait before retry number attempt, honouring a
+        Retry-After header if the server sent one."""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    try:
+                        date = parsedate_to_datetime(retry_after)
+                        delay = date.timestamp() - time.time()
+                    except (TypeError, ValueError):
+                        delay = None
+                if delay is not None:
+                    return min(max(delay, 0), self.max_backoff)
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, *args, **kwargs):
+        """requests.Session.request with retries and concurrency limiting.
+        File-like request bodies are rewound before each retry."""
+        data = kwargs.get('data')
+        position = data.tell() if hasattr(data, 'seek') else None
+        headers = dict(kwargs.get('headers') or {})
+        kwargs['headers'] = headers
+        attempt = 0
+        reauthenticated = False
+        while True:
+            if self.tokens is not None:
+                headers['Preservica-Access-Token'] = self.tokens.get()
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+            response = error = None
+            self.limiter.acquire()
+            try:
+                response = super(preservica_session, self).request(
+                    method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                # released whatever is raised, or the slot would be lost
+                self.limiter.release(
+                    response is not None
+                    and response.status_code not in RETRY_STATUSES)
+            if error is not None:
+                if self.metrics is not None:
+                    self.metrics.record(method, url, 'error')
+                if attempt >= self.retries or not idempotent:
+                    raise error
+                delay = self._retry_delay(attempt)
+                logger.warning(
+                    f'{method} {url} failed ({error}), retrying in '
+                    f'{delay:.1f}s')
+            else:
+                # a gateway error may come after a write has been applied
+                throttled = response.status_code in (
+                    RETRY_STATUSES if idempotent else REJECTED_STATUSES)
+                if response.status_code == 401 and self.tokens is not None \
+                        and not reauthenticated:
+                    # token revoked or expired early, renew it once
+                    reauthenticated = True
+                    self.tokens.get(force=True)
+                    response.close()
+                    if position is not None:
+                        data.seek(position)
+                    continue
+                if not throttled or attempt >= self.retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logger.warning(
+                    f'{method} {url} returned {response.status_code}, '
+                    f'retrying in {delay:.1f}s')
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+            if position is not None:
+                data.seek(position)
 
     def close(self):
         """
-        Revokes the current token and cancels the refresh timer on session
-        close. Make sure the session is closed explicitly, or use as context
-        manager,otherwise update timer will cause session to hang indefinitely
+        Revokes the current token on session close if this session owns it.
+        Sessions made with worker() leave the shared token alone.
         """
-        url = self.authenturl+"/revoke"
-        self.post(
-            url,
-            params={"access-token": self.headers['Preservica-Access-Token']})
+        if self._owns_token and self.tokens is not None:
+            self.tokens.revoke()
         super(preservica_session, self).close()
 
     def get_token(self, login, password):
         """
-        Gets an access token from Preservica and appends it to the session
-        headers. Starts a timer to refresh after 10 minutes.
+        Gets an access token from Preservica. The token is attached to each
+        request and renewed as it nears expiry.
         """
-        url = self.authenturl+"/login"
-        querystring = {
-            "username": login, "password": password, "tenant": self.tenant}
-        logging.info("Authenticating with Preservica")
-        response = self.post(url, data=querystring)
-        if response.status_code == 200:
-            data = response.json()
-            tokenval = (data["token"])
-            self.headers['Preservica-Access-Token'] = tokenval
-            self.refresh_token = data["refresh-token"]
-            self.refresh_timer = Thread(target=self.refresh, daemon=True)
-            self.refresh_timer.start()
-        else:
-            logging.error(f"Unable to authenticate, received status code {response.status_code}")
-            print(response.text)
+        self.tokens = token_manager(
+            self.authenturl, login, password, self.tenant)
+        self.tokens.login()
 
-    def refresh(self, interval=600):
-        """Refreshes access token every interval."""
-        while True:
-            time.sleep(interval)
-            url = self.authenturl+"/refresh"
-            logging.info("Refreshing authentication token")
-            response = self.post(url, data={"refreshToken": self.refresh_token})
-            data = response.json()
-            tokenval = (data["token"])
-            self.headers['Preservica-Access-Token'] = tokenval
-            self.refresh_token = data["refresh-token"]
+    def worker(self):
+        """Returns a new session, with its own connections, that shares this
+        session's token, limiter and cache. Use one per thread for heavy
+        parallel work."""
+        return type(self)(
+            None, None, self.host, self.tenant, cache=self.cache,
+            retries=self.retries, backoff=self.backoff,
+            max_backoff=self.max_backoff, limiter=self.limiter,
+            tokens=self.tokens, protocol=self.protocol, metrics=self.metrics)
 
     @staticmethod
     def find_config():
@@ -162,9 +803,37 @@ class preservica_session(requests.Session):
         username = config[profile]['Username']
         password = config[profile]['Password']
         tenant = config[profile]['Tenant']
-        sesh = cls(username, password, host, tenant)
+        protocol = config[profile].get('Protocol', 'https')
+        sesh = cls(username, password, host, tenant, protocol=protocol)
         return sesh
 
+    def enable_cache(self, maxsize=1024, ttl=300, cache_dir=None):
+        """Turns on entity caching for get_object. Entries are kept for ttl
+        seconds, after which they are revalidated with the server. If
+        cache_dir is given, entries are also persisted there between runs."""
+        self.cache = entity_cache(maxsize=maxsize, ttl=ttl, cache_dir=cache_dir)
+        return self.cache
+
+    def enable_metrics(self, metrics=None):
+        """Starts recording request metrics, returning the request_metrics
+        instance. Workers made afterwards record into the same one."""
+        if metrics is None:
+            metrics = request_metrics()
+        if self.metrics is not None:
+            self.hooks['response'].remove(self.metrics.hook)
+        self.metrics = metrics
+        self.hooks['response'].append(metrics.hook)
+        return metrics
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _invalidate(self, uri):
+        if self.cache is not None and uri is not None:
+            self.cache.invalidate(uri)
+
     def make_uri(self, ref, type):
         url = self.entityurl+'/'+type+'/'+ref
         return url
@@ -174,80 +843,282 @@ class preservica_session(requests.Session):
         type = uri.split('/')[0]
         return type
 
-    def get_objectsbyid(self, identifier, type='code'):
+    def get_urisbyid(self, identifier, type='code'):
         """
-        Returns a list of entities matching the
-        provided identifier.
+        Returns a list of entity uris matching the provided identifier, or
+        None if the lookup failed.
         """
         parameters = {'type': type, 'value': identifier}
         r = self.get(
             self.entityurl+"/entities/by-identifier",
             params=parameters)
-        tree = etree.parse(BytesIO(r.content))
-        root = tree.getroot()
+        if r.status_code != 200:
+            logger.error(
+                f'Lookup of identifier {identifier} failed with status '
+                f'{r.status_code}')
+            return None
+        root = etree.parse(BytesIO(r.content)).getroot()
+        return [
+            ent.text for ent in root.findall('.//Entity', namespaces=root.nsmap)]
+
+    def get_objectsbyid(self, identifier, type='code'):
+        """
+        Returns a list of entities matching the
+        provided identifier.
+        """
         objects = []
-        for ent in root.findall('.//Entity', namespaces=root.nsmap):
-            object = self.get_object(ent.text)
+        for uri in self.get_urisbyid(identifier, type=type) or []:
+            object = self.get_object(uri)
             objects.append(object)
         return objects
 
-    def get_object(self, uri):
-        """Returns an lxml element response for object of type with ref"""
-        r = self.get(uri)
+    def resolve_identifiers(self, identifiers, **kwargs):
+        """Resolves many identifiers concurrently. See
+        identifier_index.resolve for the available options."""
+        from preservica_API.identifier_index import resolve
+        return resolve(self, identifiers, **kwargs)
+
+    def _get_cached(self, uri):
+        """GETs uri through the entity cache, revalidating stale entries
+        with If-None-Match/If-Modified-Since where the server supplied
+        validators. Returns a tuple of (status code, content)."""
+        entry, fresh = self.cache.lookup(uri)
+        if entry is not None and fresh:
+            self.cache.count(True)
+            return 200, entry['content']
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        r = self.get(uri, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            self.cache.count(True, revalidated=True)
+            self.cache.touch(uri, entry)
+            return 200, entry['content']
+        self.cache.count(False)
         if r.status_code == 200:
-            tree = etree.parse(BytesIO(r.content))
-            object = entity(tree.getroot())
-            return object
+            self.cache.store(uri, r)
+        return r.status_code, r.content
+
+    def get_object(self, uri, keep_xml=False):
+        """Returns the entity at uri. The XML response is only retained on
+        the entity if keep_xml is True."""
+        if self.cache is not None:
+            status, content = self._get_cached(uri)
+        else:
+            r = self.get(uri)
+            status, content = r.status_code, r.content
+        if status == 200:
+            return entity.from_bytes(content, keep_xml=keep_xml)
         else:
             logger.error(
-                f'Request for entity at {uri} failed'
-                f'with status code {r.status_code}')
+                f'Request for entity at {uri} failed '
+                f'with status code {status}')
+
+    def iter_children(self, uri, max=100):
+        """Yields a dict of ref, type, title and uri for each child listed at
+        uri, following the paging links in the children response."""
+        url = uri
+        params = {'start': 0, 'max': max}
+        while url is not None:
+            response = self.get(url, params=params)
+            if response.status_code != 200:
+                logger.error(
+                    f'Request for children at {url} failed with status '
+                    f'{response.status_code}')
+                return
+            root = etree.parse(BytesIO(response.content)).getroot()
+            for ent in root.findall('.//Child', root.nsmap):
+                yield {
+                    'ref': ent.get('ref'), 'type': ent.get('type'),
+                    'title': ent.get('title'), 'uri': ent.text}
+            url = root.findtext('.//Paging/Next', namespaces=root.nsmap)
+            params = None
+
+    def iter_content_objects(self, uri):
+        """Yields a dict of ref, type, title and uri for each content object
+        in the representations of the information object at uri."""
+        response = self.get(uri+'/representations')
+        if response.status_code != 200:
+            logger.error(
+                f'Request for representations at {uri} failed with status '
+                f'{response.status_code}')
+            return
+        root = etree.fromstring(response.content)
+        seen = set()
+        for rep in root.findall('.//Representations/Representation', root.nsmap):
+            response = self.get(rep.text)
+            if response.status_code != 200:
+                logger.error(
+                    f'Request for representation {rep.text} failed with '
+                    f'status {response.status_code}')
+                continue
+            rep_root = etree.fromstring(response.content)
+            for ent in rep_root.findall(
+                    './/ContentObjects/ContentObject', rep_root.nsmap):
+                if ent.get('ref') in seen:
+                    continue
+                seen.add(ent.get('ref'))
+                yield {
+                    'ref': ent.get('ref'), 'type': 'CO',
+                    'title': ent.get('title'), 'uri': ent.text}
 
     def get_children(self, object):
         """Returns a list of objects.
         """
         if object.children is not None:
-            response =  self.get(object.children)
-            if response.status_code == 200:
-                children = []
-                tree = etree.parse(BytesIO(response.content))
-                root = tree.getroot()
-                for ent in root.findall('.//Child', root.nsmap):
-                    object = self.get_object(ent.text)
-                    children.append(object)
-                return children
-            else:
-                logger.error(
-                    f'Request for children of {object} failed with status '
-                    f'{response.status_code}')
+            children = []
+            for child in self.iter_children(object.children):
+                children.append(self.get_object(child['uri']))
+            return children
+
+    def walk(self, ref, **kwargs):
+        """Streams the subtree beneath the folder at ref. See walker.walk for
+        the available options."""
+        from preservica_API.walker import walk
+        return walk(self, ref, **kwargs)
+
+    def get_fragment(self, metauri):
+        """Returns the root element of the metadata fragment at metauri, or
+        None if it couldn't be retrieved. Fragments go through the entity
+        cache when it is enabled."""
+        if self.cache is not None:
+            status, content = self._get_cached(metauri)
+        else:
+            r = self.get(metauri)
+            status, content = r.status_code, r.content
+        if status != 200:
+            logger.error(
+                f'Request for metadata fragment {metauri} failed with status '
+                f'{status}')
+            return None
+        root = etree.fromstring(content)
+        container = root.find('MetadataContainer/Content', root.nsmap)
+        if container is None or len(container) == 0:
+            return None
+        return container[0]
+
+    def get_metadata(self, object, schemas=None):
+        """Returns a list of dicts with the schema, uri and parsed content of
+        each metadata fragment on object (an entity or its uri). schemas
+        limits the fragments downloaded, by namespace or by a key of SCHEMAS
+        such as 'MODS'."""
+        if isinstance(object, str):
+            object = self.get_object(object)
+        fragments = select_fragments(object, schemas)
+        for frag in fragments:
+            frag['content'] = self.get_fragment(frag['uri'])
+        return fragments
+
+    def get_metadata_bulk(self, objects, schemas=None, **kwargs):
+        """Retrieves fragments for many entities concurrently. See
+        metadata.fetch_metadata for the available options."""
+        from preservica_API.metadata import fetch_metadata
+        return fetch_metadata(self, objects, schemas=schemas, **kwargs)
 
     def post_metadata(self, object, fragment):
-        """Appends a new metadata fragment to object of type with ref."""
+        """Appends a new metadata fragment to object of type with ref.
+        Returns the response."""
         url = object.uri+"/metadata"
-        r = self.post(url, data=fragment)
+        r = self.post(
+            url, data=fragment, headers={'Content-Type': 'application/xml'})
+        self._invalidate(object.uri)
         if r.status_code == 200:
             logging.info(f'Successfully added metadata fragment to {object}')
         else:
             logging.error(
                 f'Error adding metadata to {object},'
                 f' status code {r.status_code}')
+        return r
 
     def replace_metadata(self, metauri, fragment):
-        """Replaces the metadata fragment at metaurl."""
-        self.headers['Content-Type'] = 'application/xml'
-        r = self.put(metauri, data=fragment)
+        """Replaces the metadata fragment at metaurl. Returns the response."""
+        r = self.put(
+            metauri, data=fragment, headers={'Content-Type': 'application/xml'})
+        self._invalidate(metauri.split('/metadata/')[0])
         if r.status_code == 200:
             logging.info(f'Successfully replaced metadata fragment {metauri}')
         else:
             logging.error(
                 f'Error replacing metadata fragment {metauri}, '
                 f'status code {r.status_code}')
+        return r
 
     def update_xipmeta(self, object, tag, text):
-        """Updates the given XIP meta tag for given object of type with ref."""
-        object.XIP.find('xip:'+tag, namespaces=object.XIP.nsmap).text = text
-        data = etree.tostring(object.XIP, pretty_print=True).decode()
-        self.put(object.uri, data=data)
+        """Updates the given XIP meta tag for given object of type with ref.
+        Returns the response, or False if the entity couldn't be
+        retrieved."""
+        return self.patch_xipmeta(object, {tag: text}, force=True)
+
+    def patch_xipmeta(self, object, changes, force=False):
+        """Applies a dict of XIP tag: text changes to object in a single PUT,
+        adding tags the entity doesn't have yet. Returns the response, None
+        without sending anything if nothing would change and force is not
+        set, or False if the entity's XIP couldn't be retrieved."""
+        xip = object.XIP
+        if xip is None:
+            current = self.get_object(object.uri, keep_xml=True)
+            if current is None:
+                logger.warning(
+                    f'Not updating {", ".join(changes)} of {object}, '
+                    'unable to retrieve it')
+                return False
+            xip = current.XIP
+        changed = False
+        for tag, text in changes.items():
+            elem = xip.find('xip:'+tag, namespaces=xip.nsmap)
+            if elem is None:
+                elem = _insert_xip(xip, tag)
+            if elem.text != text:
+                elem.text = text
+                changed = True
+        if not changed and not force:
+            return None
+        data = etree.tostring(xip, pretty_print=True).decode()
+        r = self.put(
+            object.uri, data=data, headers={'Content-Type': 'application/xml'})
+        self._invalidate(object.uri)
+        if r.status_code == 200:
+            for tag, text in changes.items():
+                if tag in XIP_FIELDS:
+                    setattr(object, XIP_FIELDS[tag], text)
+        else:
+            logging.error(
+                f'Error updating {", ".join(changes)} of {object}, '
+                f'status code {r.status_code}')
+        return r
+
+    def update_security_tag(self, object, tag, descendants=False):
+        """Changes the security tag of object, and optionally everything
+        beneath it, through the security-tag endpoint. Returns the
+        response. With a cache and descendants, the tree beneath object is
+        listed so the cached descendants can be dropped."""
+        r = self.put(
+            object.uri+'/security-tag', data=tag,
+            params={'includeDescendants': str(descendants).lower()},
+            headers={'Content-Type': 'text/plain'})
+        self._invalidate(object.uri)
+        if descendants and self.cache is not None:
+            self._invalidate_descendants(object)
+        if r.status_code in (200, 202):
+            object.securityTag = tag
+        else:
+            logging.error(
+                f'Error changing security tag of {object}, '
+                f'status code {r.status_code}')
+        return r
+
+    def _invalidate_descendants(self, object):
+        if object.type == ENT_MAP[TYPE_MAP['SO']]:
+            children = self.walk(object.ref)
+        elif object.type == ENT_MAP[TYPE_MAP['IO']]:
+            children = self.iter_content_objects(object.uri)
+        else:
+            return
+        for child in children:
+            self._invalidate(child['uri'])
 
     def update_extended_xip(self, uri, earliest, latest, surrogate=True):
         """Updates or appends the extended XIP fragment for object of type with
@@ -261,26 +1132,37 @@ class preservica_session(requests.Session):
         etree.SubElement(
             extended_xip, 'CoverageTo').text = latest
         extended_xip = etree.tostring(extended_xip, pretty_print=True).decode()
-        meta = self.get_metadata(uri)
-        xip_frags = [m for m in meta if m['schema'] == nspace]
+        object = self.get_object(uri) if isinstance(uri, str) else uri
+        xip_frags = select_fragments(object, [nspace])
         if xip_frags != []:
             meta_uri = xip_frags[0]['uri']  # we're assuming there's only one
             self.replace_metadata(meta_uri, extended_xip)
         else:
-            self.post_metadata(uri, extended_xip)
+            self.post_metadata(object, extended_xip)
 
-    def upload(self, fpath, targeturi):
+    def upload(self, fpath, targeturi, progress=None):
         """Uploads package to the target folder. Note if a parent is specified
-        in the package XIP it will override the provided target.
+        in the package XIP it will override the provided target. The package
+        is streamed from disk; progress, if given, is called with the number
+        of bytes sent as the upload proceeds.
         """
-        self.headers['Content-Type'] = "application/octet-stream"
+        response = self.upload_package(fpath, targeturi, progress=progress)
+        if response is not None:
+            return(response.text)
+
+    def upload_package(self, fpath, targeturi, progress=None):
+        """As upload, but returns the response, or None if the package could
+        not be read."""
         fpath = pathlib.Path(fpath)
         url = self.make_uri(targeturi, 'structural-objects')+"/upload-package?filename=" + fpath.name
         start_time = time.time()
         logging.info(f"Upload of {fpath} commencing")
         try:
-            with fpath.open('rb') as data:
-                response_mref = self.post(url, data=data)
+            with fpath.open('rb') as f:
+                data = f if progress is None else progress_reader(f, progress)
+                response_mref = self.post(
+                    url, data=data,
+                    headers={'Content-Type': "application/octet-stream"})
                 duration = time.time() - start_time
                 if response_mref.status_code == 200:
                     logging.info(
@@ -290,10 +1172,9 @@ class preservica_session(requests.Session):
                     logging.error(
                         f"Upload of {fpath} failed with status"
                         f" {response_mref.status_code}")
-                return(response_mref.text)
+                return response_mref
         except OSError as e:
             print(e)
-        self.headers['Content-Type'] = 'application/xml'
 
     def s3upload(self, fpath, bucket):
         """Uploads package to S3 bucket with required metadata. Needs the
@@ -303,7 +1184,52 @@ class preservica_session(requests.Session):
         S3upload(fpath, bucket)
 
 
+class session_pool(object):
+    """Fixed set of worker sessions sharing one login, for running API calls
+    from a thread pool. Each thread borrows a session for the duration of a
+    call so no two threads share a connection pool."""
+
+    def __init__(self, session, size=4):
+        self.session = session
+        self.size = size
+        self._idle = queue.Queue()
+        self._workers = [session.worker() for _ in range(size)]
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    @contextmanager
+    def acquire(self):
+        worker = self._idle.get()
+        try:
+            yield worker
+        finally:
+            self._idle.put(worker)
+
+    def call(self, func, *args, **kwargs):
+        """Calls func with a borrowed session as its first argument."""
+        with self.acquire() as worker:
+            return func(worker, *args, **kwargs)
+
+    def map(self, func, iterable):
+        """Like ThreadPoolExecutor.map, calling func(session, item) for each
+        item with one thread per pooled session."""
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(self.size) as ex:
+            yield from ex.map(lambda item: self.call(func, item), iterable)
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 if __name__ == '__main__':
+    log_to_console()
     parser = argparse.ArgumentParser(
         description='Simple tasks using the Preservica API')
     parser.add_argument(
@@ -316,9 +1242,25 @@ if __name__ == '__main__':
     parser.add_argument(
         '--upload', nargs=2, metavar=('filepath', 'parentref'),
         help='uploads a package to parent ref via the API')
+    parser.add_argument(
+        '--bulkupload', nargs=2, metavar=('directory', 'parentref'),
+        help='uploads every .zip package in directory to parent ref')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of concurrent uploads for --bulkupload')
+    parser.add_argument(
+        '--journal',
+        help='journal of completed uploads for --bulkupload, defaults to '
+        'upload_journal.jsonl in the directory')
     args = parser.parse_args()
     if args.config is not None:
         preservica_session.write_config(*args.config, profile=args.profile)
     sesh = preservica_session.get_session(profile=args.profile)
     if args.upload is not None:
         sesh.upload(*args.upload)
+    if args.bulkupload is not None:
+        from preservica_API.bulk_upload import bulk_upload
+        bulk_upload(
+            sesh, *args.bulkupload, workers=args.workers,
+            journal=args.journal)
+    sesh.close()
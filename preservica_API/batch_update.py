@@ -0,0 +1,184 @@
+"""Bulk corrections to entity XIP metadata. Changes are read from a CSV
+(with ref, tag and value columns, and optionally type) or JSON lines file
+of the same fields. Each entity is fetched and patched once with all of its
+changes, entities are processed concurrently, no-op changes are skipped and
+progress is checkpointed so an interrupted job can be rerun.
+
+python batch_update.py changes.csv --report results.csv
+"""
+
+
+import csv
+import json
+import pathlib
+import argparse
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from preservica_API import (
+    preservica_session, session_pool, logger, log_to_console, TYPE_MAP)
+
+REPORT_FIELDS = ['ref', 'status', 'tags', 'status_code', 'message']
+
+
+def _text(value, ref, tag):
+    """Element text for a value from a JSON lines row. Numbers and booleans
+    are written as they appear in JSON; null has no text to set."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        raise ValueError(f'Value for {tag} of {ref} is not a string')
+    return json.dumps(value)
+
+
+def read_changes(path, type='IO'):
+    """Returns a dict of entity ref: (type, {tag: value}) from a CSV or
+    JSON lines file, in file order. type is used for rows without one.
+    Rows with a null value are skipped."""
+    path = pathlib.Path(path)
+    with path.open(newline='') as f:
+        if path.suffix in ('.jsonl', '.json'):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+        changes = {}
+        for row in rows:
+            ref = row['ref'].strip()
+            row_type = row.get('type') or type
+            if row_type not in TYPE_MAP:
+                raise ValueError(f'Unknown entity type {row_type} for {ref}')
+            value = _text(row['value'], ref, row['tag'])
+            if value is None:
+                logger.warning(f'Skipping {row["tag"]} of {ref}, no value')
+                continue
+            changes.setdefault(ref, (row_type, {}))[1][row['tag']] = value
+    return changes
+
+
+class checkpoint(object):
+    """File of refs already processed, one per line."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = Lock()
+        self.done = set()
+        if self.path.exists():
+            self.done = set(self.path.read_text().split())
+
+    def add(self, ref):
+        with self._lock:
+            with self.path.open('a') as f:
+                f.write(ref+'\n')
+            self.done.add(ref)
+
+
+def update_entity(session, ref, type, changes, dry_run=False):
+    """Fetches the entity at ref and applies changes, returning a result
+    dict for the report. SecurityTag goes through the security-tag
+    endpoint, everything else in a single XIP PUT."""
+    result = {'ref': ref, 'tags': ' '.join(changes)}
+    uri = ref if ref.startswith('http') else session.make_uri(ref, TYPE_MAP[type])
+    object = session.get_object(uri, keep_xml=True)
+    if object is None:
+        return dict(result, status='missing')
+    changes = dict(changes)
+    security = changes.pop('SecurityTag', None)
+    if security == object.securityTag:
+        security = None
+    responses = []
+    xip = object.XIP
+    pending = {
+        tag: value for tag, value in changes.items()
+        if xip.findtext('xip:'+tag, namespaces=xip.nsmap) != value}
+    if not pending and security is None:
+        return dict(result, status='unchanged')
+    if dry_run:
+        tags = list(pending) + (['SecurityTag'] if security else [])
+        return dict(result, status='would update', tags=' '.join(tags))
+    if pending:
+        responses.append(session.patch_xipmeta(object, pending))
+    if security is not None:
+        responses.append(session.update_security_tag(object, security))
+    codes = [r.status_code for r in responses]
+    ok = all(code in (200, 202) for code in codes)
+    return dict(
+        result, status='updated' if ok else 'failed',
+        status_code=' '.join(map(str, codes)))
+
+
+def batch_update(session, changes, workers=8, checkpoint_file=None,
+                 report=None, dry_run=False):
+    """Applies changes (as from read_changes) workers entities at a time.
+    Refs recorded in checkpoint_file are skipped, and each ref is recorded
+    there once processed. If report is a path, a CSV of results is written
+    to it. Returns the list of result dicts."""
+    done = checkpoint(checkpoint_file) if checkpoint_file else None
+    todo = [
+        (ref, type, tags) for ref, (type, tags) in changes.items()
+        if done is None or ref not in done.done]
+    logger.info(
+        f'Updating {len(todo)} entities, {len(changes) - len(todo)} already done')
+    results = []
+    out = None
+    if report is not None:
+        out = open(report, 'a', newline='')
+        writer = csv.DictWriter(out, REPORT_FIELDS)
+        if out.tell() == 0:
+            writer.writeheader()
+    try:
+        with session_pool(session, size=workers) as pool, \
+                ThreadPoolExecutor(workers) as ex:
+            futures = {
+                ex.submit(pool.call, update_entity, ref, type, tags, dry_run): ref
+                for ref, type, tags in todo}
+            for f in as_completed(futures):
+                ref = futures[f]
+                try:
+                    result = f.result()
+                except Exception as e:
+                    logger.exception(e)
+                    result = {'ref': ref, 'status': 'failed', 'message': str(e)}
+                results.append(result)
+                if out is not None:
+                    writer.writerow(result)
+                if done is not None and result['status'] in ('updated', 'unchanged'):
+                    done.add(ref)
+    finally:
+        if out is not None:
+            out.close()
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    logger.info(f'Batch update complete: {counts}')
+    return results
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Apply a CSV or JSON lines file of (ref, tag, value) '
+        'changes to entity XIP metadata')
+    parser.add_argument('changes', help='CSV or .jsonl file of changes')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--type', default='IO', choices=list(TYPE_MAP),
+        help='entity type for rows that don\'t give one')
+    parser.add_argument(
+        '--workers', type=int, default=8, help='entities updated concurrently')
+    parser.add_argument(
+        '--checkpoint',
+        help='file of processed refs, defaults to the changes file + .done')
+    parser.add_argument('--report', help='CSV file of results')
+    parser.add_argument(
+        '--dryrun', action='store_true',
+        help='report what would change without writing anything')
+    args = parser.parse_args()
+    changes = read_changes(args.changes, type=args.type)
+    if args.checkpoint is None and not args.dryrun:
+        args.checkpoint = args.changes+'.done'
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        batch_update(
+            sesh, changes, workers=args.workers,
+            checkpoint_file=args.checkpoint, report=args.report,
+            dry_run=args.dryrun)
@@ -0,0 +1,189 @@
+"""Parallel upload of a directory of packages via the REST API. Completed
+uploads are recorded in a journal so an interrupted batch only retries the
+packages that are still outstanding."""
+
+
+import sys
+import json
+import time
+import pathlib
+import argparse
+from threading import Lock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from preservica_API import (
+    preservica_session, session_pool, logger, log_to_console)
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+
+class upload_journal(object):
+    """Append-only JSON lines record of package uploads. A package is
+    identified by its name, size and modification time, so a package that
+    is rebuilt under the same name is uploaded again."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = Lock()
+        self._done = set()
+        if self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # partial line from an interrupted write
+                    if entry.get('status') == 'complete':
+                        self._done.add(tuple(entry['key']))
+
+    @staticmethod
+    def key(fpath):
+        stat = pathlib.Path(fpath).stat()
+        return (pathlib.Path(fpath).name, stat.st_size, stat.st_mtime_ns)
+
+    def completed(self, fpath):
+        return self.key(fpath) in self._done
+
+    def record(self, fpath, status, **details):
+        key = self.key(fpath)
+        entry = dict(key=list(key), status=status, time=time.time(), **details)
+        with self._lock:
+            with self.path.open('a') as f:
+                f.write(json.dumps(entry)+'\n')
+            if status == 'complete':
+                self._done.add(key)
+
+
+class upload_progress(object):
+    """Thread-safe byte and package counters for a batch, with throughput
+    and ETA reporting."""
+
+    def __init__(self):
+        self.total = 0
+        self.sent = 0
+        self.packages = 0
+        self.completed = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self._lock = Lock()
+
+    def add(self, fpath):
+        self.total += pathlib.Path(fpath).stat().st_size
+        self.packages += 1
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.sent += bytes_amount
+
+    def finish(self, ok):
+        with self._lock:
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def message(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.sent / elapsed if elapsed else 0
+        remaining = self.total - self.sent
+        eta = f'{remaining / rate:.0f}s' if rate else 'unknown'
+        message = (
+            f'\rUploaded {self.completed} of {self.packages} package(s)')
+        if self.failed > 0:
+            message += f' ({self.failed} failed)'
+        unit, div = ('mb', MB) if self.total < GB else ('gb', GB)
+        message += (
+            f', {self.sent / div:.2f}{unit} / {self.total / div:.2f}{unit}, '
+            f'{rate / MB:.2f}mb/s, ETA {eta}    ')
+        return message
+
+
+def _report(progress, stop, interval):
+    while not stop.wait(interval):
+        sys.stdout.write(progress.message())
+        sys.stdout.flush()
+
+
+def _upload(session, fpath, parentref, progress, journal, delete_source):
+    response = session.upload_package(fpath, parentref, progress=progress)
+    ok = response is not None and response.status_code == 200
+    if ok:
+        journal.record(fpath, 'complete', response=response.text)
+        if delete_source:
+            fpath.unlink()
+    else:
+        status = None if response is None else response.status_code
+        journal.record(fpath, 'failed', status_code=status)
+    progress.finish(ok)
+    return fpath, ok
+
+
+def bulk_upload(session, directory, parentref, workers=4, journal=None,
+                pattern='*.zip', delete_source=False, interval=5):
+    """Uploads every package matching pattern in directory to parentref,
+    workers at a time. Packages already recorded as complete in the journal
+    (by default upload_journal.jsonl in directory) are skipped. Returns a
+    list of the packages that failed."""
+    directory = pathlib.Path(directory)
+    if journal is None:
+        journal = directory / 'upload_journal.jsonl'
+    journal = upload_journal(journal)
+    progress = upload_progress()
+    pending = []
+    for fpath in sorted(directory.glob(pattern)):
+        if journal.completed(fpath):
+            logger.info(f'Skipping {fpath}, already uploaded')
+            continue
+        progress.add(fpath)
+        pending.append(fpath)
+    logger.info(f'Uploading {len(pending)} package(s) from {directory}')
+    stop = Event()
+    reporter = Thread(
+        target=_report, args=(progress, stop, interval), daemon=True)
+    reporter.start()
+    failed = []
+    with session_pool(session, size=workers) as pool, \
+            ThreadPoolExecutor(workers) as ex:
+        futures = {
+            ex.submit(
+                pool.call, _upload, fpath, parentref, progress, journal,
+                delete_source): fpath
+            for fpath in pending}
+        for f in as_completed(futures):
+            try:
+                fpath, ok = f.result()
+            except Exception as e:
+                logger.exception(e)
+                fpath, ok = futures[f], False
+                progress.finish(False)
+            if not ok:
+                failed.append(fpath)
+    stop.set()
+    sys.stdout.write(progress.message()+'\n')
+    return failed
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Upload a directory of packages via the API, resuming '
+        'from the journal of a previous run')
+    parser.add_argument('directory', help='directory of packages')
+    parser.add_argument('parentref', help='ref of target folder')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--workers', type=int, default=4, help='concurrent uploads')
+    parser.add_argument(
+        '--journal', help='path to journal of completed uploads')
+    parser.add_argument(
+        '--deletesource', '-d', action='store_true',
+        help='Delete source packages on successful upload')
+    args = parser.parse_args()
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        failed = bulk_upload(
+            sesh, args.directory, args.parentref, workers=args.workers,
+            journal=args.journal, delete_source=args.deletesource)
+    if failed:
+        sys.exit(1)
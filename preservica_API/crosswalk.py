@@ -0,0 +1,194 @@
+"""Declarative EMu to MODS crosswalk. The mapping is data (CROSSWALK) that
+compile_crosswalk turns into a builder function once, up front. Each record
+is indexed in a single pass over its atoms and tables, and the compiled
+entries then pull values from that index by name rather than evaluating an
+XPath query per field; the few entries that need a real path search use
+precompiled etree.XPath objects."""
+
+
+from datetime import date
+from lxml import etree
+
+MODS_NS = 'http://www.loc.gov/mods/v3'
+NSMAP = {
+    'mods': MODS_NS,
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+
+# Each entry maps EMu data onto a MODS element, in output order:
+#   element   name of the MODS element
+#   atom      copy the text of this atom; nothing is output if the record
+#             has no such atom
+#   table     repeat for each tuple of the named table, evaluating children
+#             against the tuple, or with each_atom for each atom in its tuples
+#   xpath     repeat for each node matching this path, evaluating children
+#             against the node
+#   when      only output if this atom has text
+#   text      constant text, or a callable returning it
+#   attrib    attributes; values may use {atom name} placeholders
+#   children  nested entries
+HOST = [
+    {'element': 'identifier', 'atom': 'EADUnitID', 'attrib': {'type': 'UMA'}},
+    {'element': 'titleInfo', 'children': [
+        {'element': 'title', 'atom': 'EADUnitTitle'}]},
+    {'element': 'originInfo', 'children': [
+        {'element': 'dateCreated', 'atom': 'EADUnitDate'}]},
+    {'element': 'name', 'table': 'EADOriginationRef_tab', 'children': [
+        {'element': 'namePart', 'atom': 'NamFullName'},
+        {'element': 'role', 'children': [
+            {'element': 'roleterm', 'text': 'Creator'}]}]}]
+
+# Creators of the record itself (EADOriginationRef_tab) have never been
+# output, only those of its hosts, so they are left out here too.
+CROSSWALK = [
+    {'element': 'recordInfo', 'children': [
+        {'element': 'recordIdentifier', 'atom': 'irn',
+         'attrib': {'source': 'EMu catalogue irn'}},
+        {'element': 'recordCreationDate',
+         'text': lambda: date.today().isoformat()},
+        {'element': 'descriptionStandard',
+         'text': 'University of Melbourne Archives descriptive standards'}]},
+    {'element': 'identifier', 'atom': 'EADUnitID', 'attrib': {'type': 'UMA'}},
+    {'element': 'titleInfo', 'children': [
+        {'element': 'title', 'atom': 'EADUnitTitle'}]},
+    {'element': 'originInfo', 'children': [
+        {'element': 'dateCreated', 'atom': 'EADUnitDate'}]},
+    {'element': 'abstract', 'atom': 'EADScopeAndContent',
+     'attrib': {'displayLabel': 'Scope and Content'}},
+    {'element': 'name', 'table': 'contributors', 'children': [
+        {'element': 'namePart', 'atom': 'NamFullName'},
+        {'element': 'role', 'children': [
+            {'element': 'roleTerm', 'atom': 'AssRelatedPartiesRelationship'}]}]},
+    {'element': 'physicalDescription', 'children': [
+        {'element': 'extent', 'table': 'EADExtent_tab', 'each_atom': True},
+        {'element': 'form', 'table': 'EADGenreForm_tab', 'each_atom': True},
+        {'element': 'note', 'table': 'EADPhysicalDescription_tab',
+         'each_atom': True, 'attrib': {'displayLabel': 'Technical details'}}]},
+    {'element': 'subject', 'children': [
+        {'element': 'topic', 'table': 'EADSubject_tab', 'each_atom': True},
+        {'element': 'name', 'table': 'EADName_tab', 'each_atom': True},
+        {'element': 'geographic', 'table': 'EADGeographicName_tab',
+         'each_atom': True},
+        {'element': 'name', 'table': 'EADPersonalName_tab', 'each_atom': True},
+        {'element': 'name', 'table': 'EADCorporateName_tab', 'each_atom': True},
+        {'element': 'titleInfo', 'table': 'EADTitle_tab', 'each_atom': True}]},
+    {'element': 'accessCondition', 'atom': 'EADAccessRestrictions',
+     'attrib': {'type': 'access',
+                'displayLabel': 'Conditions governing access'}},
+    {'element': 'accessCondition', 'atom': 'EADUseRestrictions',
+     'attrib': {'type': 'use', 'displayLabel': 'Conditions governing use'}},
+    {'element': 'relatedItem', 'xpath': './/tuple[@name="AssParentObjectRef"]',
+     'when': 'EADLevelAttribute',
+     'attrib': {'type': 'host', 'displayLabel': 'Part of {EADLevelAttribute}'},
+     'children': HOST}]
+
+
+class record_index(object):
+    """The atoms and tables directly beneath an EMu tuple, by name, built in
+    one pass. The first atom of a name wins, as with find()."""
+
+    __slots__ = ('element', 'atoms', 'tables')
+
+    def __init__(self, element):
+        self.element = element
+        self.atoms = {}
+        self.tables = {}
+        for child in element.iterchildren('atom', 'table'):
+            name = child.get('name')
+            if child.tag == 'atom':
+                if name not in self.atoms:
+                    self.atoms[name] = child
+            else:
+                self.tables.setdefault(name, []).append(child)
+
+    def text(self, name):
+        atom = self.atoms.get(name)
+        return None if atom is None else atom.text
+
+    def tuples(self, name):
+        for table in self.tables.get(name, ()):
+            yield from table.iterchildren('tuple')
+
+
+class _atom_text(dict):
+    """format_map mapping resolving placeholders to atom text."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __missing__(self, name):
+        return self.index.text(name) or ''
+
+
+def _compile(entry):
+    """Turns a crosswalk entry into a function emit(parent, index)."""
+    tag = '{%s}%s' % (MODS_NS, entry['element'])
+    attrib = entry.get('attrib', {})
+    templated = any('{' in v for v in attrib.values())
+    children = [_compile(child) for child in entry.get('children', [])]
+    atom = entry.get('atom')
+    table = entry.get('table')
+    each_atom = entry.get('each_atom', False)
+    text = entry.get('text')
+    when = entry.get('when')
+    xpath = etree.XPath(entry['xpath']) if 'xpath' in entry else None
+
+    def element(parent, index):
+        if templated:
+            values = _atom_text(index)
+            attrs = {k: v.format_map(values) for k, v in attrib.items()}
+        else:
+            attrs = attrib
+        elem = etree.SubElement(parent, tag, attrs)
+        if text is not None:
+            elem.text = text() if callable(text) else text
+        for child in children:
+            child(elem, index)
+        return elem
+
+    if xpath is not None:
+        def emit(parent, index):
+            for node in xpath(index.element):
+                sub = record_index(node)
+                if when is None or sub.text(when) is not None:
+                    element(parent, sub)
+    elif table is not None and each_atom:
+        def emit(parent, index):
+            for tup in index.tuples(table):
+                for a in tup.iterchildren('atom'):
+                    etree.SubElement(parent, tag, attrib).text = a.text
+    elif table is not None:
+        def emit(parent, index):
+            for tup in index.tuples(table):
+                element(parent, record_index(tup))
+    elif atom is not None:
+        def emit(parent, index):
+            source = index.atoms.get(atom)
+            if source is not None:
+                if when is None or index.text(when) is not None:
+                    etree.SubElement(parent, tag, attrib).text = source.text
+    else:
+        def emit(parent, index):
+            if when is None or index.text(when) is not None:
+                element(parent, index)
+    return emit
+
+
+def compile_crosswalk(spec=CROSSWALK, root='mods', attrib={'version': '3.4'},
+                      nsmap=NSMAP):
+    """Compiles a crosswalk definition, returning a function that builds the
+    MODS root element for an EMu record."""
+    tag = '{%s}%s' % (MODS_NS, root)
+    entries = [_compile(entry) for entry in spec]
+
+    def build(record):
+        elem = etree.Element(tag, nsmap=nsmap)
+        for k, v in attrib.items():
+            elem.set(k, v)
+        index = record_index(record)
+        for emit in entries:
+            emit(elem, index)
+        return elem
+    return build
+
+
+build_mods = compile_crosswalk()
@@ -0,0 +1,182 @@
+"""Bulk resolution of identifiers to Preservica entities, backed by a local
+SQLite index of identifier to entity uris so repeat runs can skip the
+by-identifier lookups entirely."""
+
+
+import time
+import json
+import pathlib
+import sqlite3
+import argparse
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from preservica_API import preservica_session, logger, log_to_console
+
+DEFAULT_INDEX = pathlib.Path().home() / '.preservica/identifiers.db'
+
+
+class identifier_index(object):
+    """Persistent map of (identifier type, value) to the uris of the
+    entities carrying that identifier. Safe to share between threads."""
+
+    def __init__(self, path=DEFAULT_INDEX):
+        path = pathlib.Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._lock = Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS identifiers ('
+            'type TEXT, value TEXT, uris TEXT, updated REAL, '
+            'PRIMARY KEY (type, value))')
+        self._db.commit()
+
+    def lookup(self, value, type='code', max_age=None):
+        """Returns the indexed uris for value, or None if the identifier is
+        not indexed or its entry is older than max_age seconds. Identifiers
+        that matched nothing aren't indexed, so they are always looked up."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT uris, updated FROM identifiers '
+                'WHERE type = ? AND value = ?', (type, value)).fetchone()
+        if row is None:
+            return None
+        if max_age is not None and time.time() - row[1] > max_age:
+            return None
+        return json.loads(row[0]) or None
+
+    def store(self, value, uris, type='code'):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?)',
+                (type, value, json.dumps(uris), time.time()))
+            self._db.commit()
+
+    def invalidate(self, value=None, type='code'):
+        """Removes value from the index, or every identifier of type if no
+        value is given."""
+        with self._lock:
+            if value is None:
+                self._db.execute(
+                    'DELETE FROM identifiers WHERE type = ?', (type,))
+            else:
+                self._db.execute(
+                    'DELETE FROM identifiers WHERE type = ? AND value = ?',
+                    (type, value))
+            self._db.commit()
+
+    def invalidate_uri(self, uri):
+        """Removes every identifier that resolves to the entity at uri."""
+        pattern = json.dumps(uri)
+        for char in '\\%_':
+            pattern = pattern.replace(char, '\\'+char)
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM identifiers WHERE uris LIKE ? ESCAPE '\\'",
+                ('%'+pattern+'%',))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM identifiers').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def resolve_one(session, identifier, index=None, type='code', refresh=False,
+                max_age=None, fetch=True):
+    """Resolves a single identifier, see resolve."""
+    uris = None
+    if index is not None and not refresh:
+        uris = index.lookup(identifier, type=type, max_age=max_age)
+    looked_up = uris is None
+    if looked_up:
+        uris = session.get_urisbyid(identifier, type=type)
+        if uris is None:
+            return identifier, []
+        if index is not None:
+            if uris:
+                index.store(identifier, uris, type=type)
+            else:
+                # matched nothing, so don't serve an older entry again
+                index.invalidate(identifier, type=type)
+    if not fetch:
+        return identifier, uris
+    objects = [session.get_object(uri) for uri in uris]
+    if None in objects and not looked_up:
+        # the index is stale, eg the entity has been deleted or moved
+        logger.info(f'Index entry for {identifier} is stale, refreshing')
+        return resolve_one(
+            session, identifier, index, type, True, max_age, fetch)
+    return identifier, [o for o in objects if o is not None]
+
+
+def resolve(session, identifiers, index=None, type='code', workers=8,
+            refresh=False, max_age=None, fetch=True):
+    """Generator resolving an iterable of identifiers concurrently, yielding
+    (identifier, entities) tuples in completion order. With an index, known
+    identifiers are resolved without a by-identifier lookup; refresh forces
+    a lookup and max_age (seconds) expires old index entries. With
+    fetch=False entity uris are yielded instead of entities. identifiers
+    is consumed lazily so it can be a stream of any size."""
+    window = workers * 4
+    running = set()
+    identifiers = iter(identifiers)
+    with ThreadPoolExecutor(workers) as ex:
+        while True:
+            for identifier in identifiers:
+                running.add(ex.submit(
+                    resolve_one, session, identifier, index, type, refresh,
+                    max_age, fetch))
+                if len(running) >= window:
+                    break
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+
+
+def build_index(session, identifiers, index, type='code', workers=8):
+    """Refreshes the index entries for identifiers without fetching the
+    entities. Returns the number of identifiers that resolved."""
+    found = 0
+    for identifier, uris in resolve(
+            session, identifiers, index=index, type=type, workers=workers,
+            refresh=True, fetch=False):
+        if uris:
+            found += 1
+    return found
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Build or refresh the local identifier index from a file'
+        ' of identifiers, one per line')
+    parser.add_argument('identifiers', help='file of identifiers')
+    parser.add_argument(
+        '--index', default=str(DEFAULT_INDEX), help='path to the index')
+    parser.add_argument(
+        '--type', default='code', help='identifier type')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--workers', type=int, default=8, help='concurrent lookups')
+    args = parser.parse_args()
+    with open(args.identifiers) as f:
+        idents = (line.strip() for line in f if line.strip())
+        with preservica_session.get_session(profile=args.profile) as sesh, \
+                identifier_index(args.index) as index:
+            found = build_index(
+                sesh, idents, index, type=args.type, workers=args.workers)
+            print(f'{found} identifiers resolved, {len(index)} in index')
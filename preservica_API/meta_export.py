@@ -1,20 +1,169 @@
-import sys
+"""Exports MODS crosswalked from an EMu 'xml for preservica' report. The
+export is read as a stream so it can be any size. Records can be
+crosswalked in a process pool, and written either one file per record or
+bundled into a single zip, tar or concatenated file with a JSON lines
+index, so a whole catalogue export is one large sequential write."""
+
+
 import os
-import meta_update
+import json
+import tarfile
+import zipfile
+import argparse
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from lxml import etree
+from preservica_API import meta_update
 
+BUNDLES = ('zip', 'tar', 'jsonl')
 
-def main(xmlfile, outdir):
-    tree = etree.parse(xmlfile)
-    for record in tree.xpath('/table[@name="ecatalogue"]/tuple'):
+
+def export_batch(batch):
+    """Crosswalks a batch of serialised EMu records, returning the
+    identifier and MODS document bytes for each."""
+    results = []
+    for data in batch:
+        record = etree.fromstring(data) if isinstance(data, bytes) else data
         ident = record.find('atom[@name="EADUnitID"]').text
-        print('exporting metadata for record', ident)
         root = meta_update.build_root(record)
-        tree = etree.ElementTree(root)
-        fname = os.path.join(outdir, ident+'.xml')
-        tree.write(
-            fname, pretty_print=True, standalone=True, xml_declaration=True,
-            encoding='UTF-8')
+        results.append((ident, etree.tostring(
+            etree.ElementTree(root), pretty_print=True, standalone=True,
+            xml_declaration=True, encoding='UTF-8')))
+    return results
+
+
+class file_writer(object):
+    """Writes each record to its own file in outdir."""
+
+    def __init__(self, outdir, name=None):
+        self.outdir = outdir
+
+    def write(self, ident, data):
+        with open(os.path.join(self.outdir, ident+'.xml'), 'wb') as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+
+class zip_writer(object):
+    def __init__(self, outdir, name='mods'):
+        self.path = os.path.join(outdir, name+'.zip')
+        self._zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+
+    def write(self, ident, data):
+        self._zip.writestr(ident+'.xml', data)
+
+    def close(self):
+        self._zip.close()
+
+
+class tar_writer(object):
+    def __init__(self, outdir, name='mods'):
+        self.path = os.path.join(outdir, name+'.tar')
+        self._tar = tarfile.open(self.path, 'w|')
+
+    def write(self, ident, data):
+        info = tarfile.TarInfo(ident+'.xml')
+        info.size = len(data)
+        self._tar.addfile(info, BytesIO(data))
+
+    def close(self):
+        self._tar.close()
+
+
+class jsonl_writer(object):
+    """Concatenates the records into name.xml, with name.jsonl giving the
+    identifier, byte offset and length of each."""
+
+    def __init__(self, outdir, name='mods'):
+        self.path = os.path.join(outdir, name+'.xml')
+        self._data = open(self.path, 'wb')
+        self._index = open(os.path.join(outdir, name+'.jsonl'), 'w')
+        self._offset = 0
+
+    def write(self, ident, data):
+        self._data.write(data)
+        self._index.write(json.dumps(
+            {'identifier': ident, 'offset': self._offset,
+             'length': len(data)})+'\n')
+        self._offset += len(data)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+WRITERS = {
+    None: file_writer, 'zip': zip_writer, 'tar': tar_writer,
+    'jsonl': jsonl_writer}
+
+
+def _batches(xmlfile, batch_size):
+    batch = []
+    for record in meta_update.iter_records(xmlfile):
+        batch.append(etree.tostring(record))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _parallel(xmlfile, processes, batch_size):
+    """Yields export_batch results in input order, with at most two
+    batches per process in flight."""
+    window = deque()
+    limit = (processes or os.cpu_count() or 1) * 2
+    with ProcessPoolExecutor(processes) as ex:
+        for batch in _batches(xmlfile, batch_size):
+            window.append(ex.submit(export_batch, batch))
+            if len(window) >= limit:
+                yield from window.popleft().result()
+        while window:
+            yield from window.popleft().result()
+
+
+def main(xmlfile, outdir, processes=1, bundle=None, name='mods',
+         batch_size=100):
+    """Exports MODS for every record in xmlfile to outdir. processes above
+    1 (or None for one per CPU) crosswalks in a process pool. bundle is
+    None for a file per record, or one of zip, tar or jsonl to write a
+    single bundle called name."""
+    writer = WRITERS[bundle](outdir, name)
+    if processes == 1:
+        results = (
+            result for record in meta_update.iter_records(xmlfile)
+            for result in export_batch([record]))
+    else:
+        results = _parallel(xmlfile, processes, batch_size)
+    count = 0
+    try:
+        for ident, data in results:
+            if processes == 1:
+                print('exporting metadata for record', ident)
+            writer.write(ident, data)
+            count += 1
+    finally:
+        writer.close()
+    print(f'Exported {count} records to {outdir}')
 
 
-main(sys.argv[1], sys.argv[2])
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export MODS records from an EMu XML export')
+    parser.add_argument('xmlfile', help='EMu xml for preservica report')
+    parser.add_argument('outdir', help='directory for MODS files')
+    parser.add_argument(
+        '--processes', '-p', type=int, default=1,
+        help='crosswalk processes, 0 for one per CPU')
+    parser.add_argument(
+        '--bundle', choices=BUNDLES,
+        help='write a single bundle instead of a file per record')
+    parser.add_argument(
+        '--name', default='mods', help='file name for the bundle')
+    args = parser.parse_args()
+    main(
+        args.xmlfile, args.outdir, processes=args.processes or None,
+        bundle=args.bundle, name=args.name)
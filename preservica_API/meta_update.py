@@ -2,158 +2,257 @@
 From an EMu XML document generated from the 'xml for preservica' report,
 pings preservica for entities with a matching identifier, then crosswalks
 metadata into MODS and either posts a new fragment of replacing an existing
-one."""
+one. Records whose title and canonicalised MODS are unchanged since the last
+run, according to a local state store, are skipped without any API calls."""
 
 
 import sys
+import json
+import time
+import copy
+import difflib
+import pathlib
+import hashlib
+import sqlite3
+import argparse
+from threading import Lock
 from lxml import etree
-from datetime import date
-from API import preservica_session
-
-nsmap = {
-    'mods': 'http://www.loc.gov/mods/v3',
-    'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
-
-
-def add_field(parent, field, sourcenode, **kwargs):
-    if hasattr(sourcenode, 'text'):
-        f = etree.SubElement(
-            parent, '{http://www.loc.gov/mods/v3}'+field,
-            attrib=kwargs)
-        f.text = sourcenode.text
-
-
-def build_host(element):
-    lod = element.find('atom[@name="EADLevelAttribute"]').text
-    host = etree.Element(
-        '{http://www.loc.gov/mods/v3}relatedItem',
-        type='host', displayLabel="Part of "+lod)
-    add_field(
-        host, 'identifier', element.find('atom[@name="EADUnitID"]'),
-        type="UMA")
-    title = etree.SubElement(host, '{http://www.loc.gov/mods/v3}titleInfo')
-    add_field(title, 'title', element.find('atom[@name="EADUnitTitle"]'))
-    oinfo = etree.SubElement(host, '{http://www.loc.gov/mods/v3}originInfo')
-    add_field(
-        oinfo, 'dateCreated', element.find('atom[@name="EADUnitDate"]'))
-    for crtr in element.findall('table[@name="EADOriginationRef_tab"]/tuple'):
-        name = etree.SubElement(host, '{http://www.loc.gov/mods/v3}name')
-        add_field(
-            name, 'namePart',
-            crtr.find('atom[@name="NamFullName"]'))
-        role = etree.SubElement(name, '{http://www.loc.gov/mods/v3}role')
-        roleterm = etree.SubElement(role, '{http://www.loc.gov/mods/v3}roleterm')
-        roleterm.text = 'Creator'
-    return host
+from preservica_API import preservica_session, log_to_console
+from preservica_API.crosswalk import build_mods
+from preservica_API.identifier_index import identifier_index, DEFAULT_INDEX
+
+MODS_NS = 'http://www.loc.gov/mods/v3'
+DEFAULT_STATE = pathlib.Path().home() / '.preservica/sync_state.db'
+DAY = 24 * 60 * 60
 
 
 def build_root(record):
-    root = etree.Element('{http://www.loc.gov/mods/v3}mods', nsmap=nsmap)
-    root.set('version', '3.4')
-    rinfo = etree.SubElement(root, '{http://www.loc.gov/mods/v3}recordInfo')
-    add_field(
-        rinfo, 'recordIdentifier', record.find('atom[@name="irn"]'),
-        source="EMu catalogue irn")
-    cdate = etree.SubElement(rinfo, '{http://www.loc.gov/mods/v3}recordCreationDate')
-    cdate.text = date.today().isoformat()
-    stand = etree.SubElement(rinfo, '{http://www.loc.gov/mods/v3}descriptionStandard')
-    stand.text = 'University of Melbourne Archives descriptive standards'
-    add_field(
-        root, 'identifier', record.find('atom[@name="EADUnitID"]'),
-        type="UMA")
-    title = etree.SubElement(root, '{http://www.loc.gov/mods/v3}titleInfo')
-    add_field(title, 'title', record.find('atom[@name="EADUnitTitle"]'))
-    oinfo = etree.SubElement(root, '{http://www.loc.gov/mods/v3}originInfo')
-    add_field(
-        oinfo, 'dateCreated', record.find('atom[@name="EADUnitDate"]'))
-    add_field(
-        root, 'abstract', record.find('atom[@name="EADScopeAndContent"]'),
-        displayLabel="Scope and Content")
-    for crtr in record.findall('table[@name="EADOriginationRef_tab"]/tuple'):
-        name = etree.SubElement(record, '{http://www.loc.gov/mods/v3}name')
-        add_field(
-            name, 'namePart',
-            crtr.find('atom[@name="NamFullName"]'))
-        role = etree.SubElement(name, '{http://www.loc.gov/mods/v3}role')
-        roleterm = etree.SubElement(role, '{http://www.loc.gov/mods/v3}roleterm')
-        roleterm.text = 'Creator'
-    for cont in record.findall('table[@name="contributors"]/tuple'):
-        name = etree.Element('{http://www.loc.gov/mods/v3}name')
-        add_field(
-            name, 'namePart',
-            cont.find('atom[@name="NamFullName"]'))
-        role = etree.Element('{http://www.loc.gov/mods/v3}role')
-        add_field(
-            role, 'roleTerm',
-            cont.find('atom[@name="AssRelatedPartiesRelationship"]'))
-        name.append(role)
-        root.append(name)
-    phys = etree.SubElement(
-        root, '{http://www.loc.gov/mods/v3}physicalDescription')
-    for elem in record.xpath('table[@name="EADExtent_tab"]/tuple/atom'):
-        add_field(phys, 'extent', elem)
-    for elem in record.xpath('table[@name="EADGenreForm_tab"]/tuple/atom'):
-        add_field(phys, 'form', elem)
-    for elem in record.xpath('table[@name="EADPhysicalDescription_tab"]/tuple/atom'):
-        add_field(phys, 'note', elem, displayLabel='Technical details')
-    subjects = etree.SubElement(
-        root, '{http://www.loc.gov/mods/v3}subject')
-    for elem in record.xpath('table[@name="EADSubject_tab"]/tuple/atom'):
-        add_field(subjects, 'topic', elem)
-    for elem in record.xpath('table[@name="EADName_tab"]/tuple/atom'):
-        add_field(subjects, 'name', elem)
-    for elem in record.xpath('table[@name="EADGeographicName_tab"]/tuple/atom'):
-        add_field(subjects, 'geographic', elem)
-    for elem in record.xpath('table[@name="EADPersonalName_tab"]/tuple/atom'):
-        add_field(subjects, 'name', elem)
-    for elem in record.xpath('table[@name="EADCorporateName_tab"]/tuple/atom'):
-        add_field(subjects, 'name', elem)
-    for elem in record.xpath('table[@name="EADTitle_tab"]/tuple/atom'):
-        add_field(subjects, 'titleInfo', elem)
-    add_field(
-        root, 'accessCondition',
-        record.find('atom[@name="EADAccessRestrictions"]'),
-        type="access",
-        displayLabel="Conditions governing access")
-    add_field(
-        root, 'accessCondition',
-        record.find('atom[@name="EADUseRestrictions"]'),
-        type="use",
-        displayLabel="Conditions governing use")
-    for host in record.xpath('.//tuple[@name="AssParentObjectRef"]'):
-        if host.find('atom[@name="EADLevelAttribute"]').text is not None:
-            root.append(build_host(host))
-    return root
-
-
-def main(xmlfile, session):
-    tree = etree.parse(sys.argv[1])
-    for record in tree.xpath('/table[@name="ecatalogue"]/tuple'):
-        ident = record.find('atom[@name="EADUnitID"]').text
-        title = record.find('atom[@name="EADUnitTitle"]').text
-        date = record.find('atom[@name="EADUnitDate"]').text
-        # iso_dates = get_iso(date)
-        print('Finding refs for identifier', ident)
-        objects = session.get_objectsbyid(ident)
-        root = build_root(record)
-        for object in objects:
-            meta = [meta for meta in object.metadata if meta.get('schema') == "http://www.loc.gov/mods/v3"]
-            session.update_xipmeta(object, 'Title', title)
-            # if iso_dates != []:
-                # session.update_extended_xip(uri, iso_dates[0], iso_dates[-1])
-            if meta == []:
+    """Crosswalks an EMu record to a MODS root element. The mapping is
+    defined in crosswalk.CROSSWALK."""
+    return build_mods(record)
+
+
+def iter_records(xmlfile):
+    """Yields the top level ecatalogue tuples of an EMu export one at a time
+    using iterparse. Each record is cleared, along with any records before
+    it, once the caller moves on to the next, so memory use doesn't grow
+    with the size of the export. Don't hold on to records between
+    iterations; build what you need from them first."""
+    for event, elem in etree.iterparse(xmlfile, events=('end',), tag='tuple'):
+        parent = elem.getparent()
+        if parent is None or parent.getparent() is not None:
+            continue  # a nested tuple, handled with its record
+        if parent.tag != 'table' or parent.get('name') != 'ecatalogue':
+            continue
+        yield elem
+        elem.clear(keep_tail=True)
+        while elem.getprevious() is not None:
+            del parent[0]
+
+
+def canonical(root):
+    """C14N serialisation of a MODS record for comparison. The record
+    creation date, which changes every run, and whitespace-only text from
+    pretty printing are left out."""
+    root = copy.deepcopy(root)
+    for elem in root.iter('{%s}recordCreationDate' % MODS_NS):
+        elem.getparent().remove(elem)
+    for elem in root.iter():
+        if elem.text is not None and not elem.text.strip():
+            elem.text = None
+        if elem.tail is not None and not elem.tail.strip():
+            elem.tail = None
+    return etree.tostring(root, method='c14n')
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class sync_state(object):
+    """SQLite record of what was last written to Preservica for each
+    identifier: a hash of the title, a hash of the canonical MODS and the
+    refs of the entities updated."""
+
+    def __init__(self, path=DEFAULT_STATE):
+        path = pathlib.Path(path).expanduser()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS state (identifier TEXT PRIMARY KEY, '
+            'title_hash TEXT, mods_hash TEXT, refs TEXT, updated REAL)')
+        self._db.commit()
+
+    def get(self, ident):
+        """Returns (title_hash, mods_hash) for ident, or None. Records
+        stored without any refs, which matched nothing, count as unsynced."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT title_hash, mods_hash FROM state WHERE identifier = ? '
+                "AND refs != '[]'", (ident,)).fetchone()
+
+    def unchanged(self, ident, title_hash, mods_hash):
+        return self.get(ident) == (title_hash, mods_hash)
+
+    def store(self, ident, title_hash, mods_hash, refs):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)',
+                (ident, title_hash, mods_hash, json.dumps(refs), time.time()))
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def _diff(old, new, label):
+    old = etree.tostring(old, pretty_print=True).decode().splitlines()
+    new = etree.tostring(new, pretty_print=True).decode().splitlines()
+    return '\n'.join(difflib.unified_diff(
+        old, new, f'{label} (Preservica)', f'{label} (EMu)', lineterm=''))
+
+
+def sync_record(session, ident, title, root, objects, state=None,
+                verify=False, dry_run=False, report=sys.stdout):
+    """Brings the title and MODS fragment of each entity in objects into
+    line with title and root, sending only what has changed. The title is
+    compared with the entity's current title. The MODS is compared with the
+    server's fragment if verify or dry_run is set, otherwise with the hash
+    in state. In a dry run, changes (with a diff where the server fragment
+    was read) are written to report instead of to Preservica. Returns the
+    number of writes made, or that would have been made."""
+    title_hash = digest(title or '')
+    mods_hash = digest(canonical(root))
+    stored = state.get(ident) if state is not None else None
+    data = etree.tostring(root, pretty_print=True).decode()
+    writes = 0
+    ok = True
+    for object in objects:
+        if object.title != title:
+            writes += 1
+            if dry_run:
+                report.write(
+                    f'{ident} {object.ref}: title {object.title!r} -> {title!r}\n')
+            else:
+                r = session.update_xipmeta(object, 'Title', title)
+                ok = ok and r is not False and r.status_code == 200
+        meta = [m for m in object.metadata if m.get('schema') == MODS_NS]
+        if meta == []:
+            writes += 1
+            if dry_run:
+                report.write(f'{ident} {object.ref}: new MODS fragment\n')
+            else:
                 print('Adding new metadata fragment to', ident)
-                session.post_metadata(
-                    object,
-                    etree.tostring(root, pretty_print=True).decode())
+                r = session.post_metadata(object, data)
+                ok = ok and r.status_code == 200
+            continue
+        for m in meta:
+            if verify or dry_run:
+                current = session.get_fragment(m['uri'])
+                if current is not None and canonical(current) == canonical(root):
+                    continue
+            elif stored is not None and stored[1] == mods_hash:
+                continue
+            writes += 1
+            if dry_run:
+                report.write(f'{ident} {object.ref}: MODS changed\n')
+                if current is not None:
+                    report.write(_diff(current, root, ident)+'\n')
             else:
-                for m in meta:
-                    print('Replacing metadata fragment at', ident)
-                    session.replace_metadata(
-                        m['uri'],
-                        etree.tostring(root, pretty_print=True).decode())
+                print('Replacing metadata fragment at', ident)
+                r = session.replace_metadata(m['uri'], data)
+                ok = ok and r.status_code == 200
+    # nothing matched is not a sync: the record is retried on the next run
+    if state is not None and not dry_run and ok and objects:
+        state.store(
+            ident, title_hash, mods_hash, [object.ref for object in objects])
+    return writes
+
+
+def main(xmlfile, session, index=None, workers=8, state=None, verify=False,
+         dry_run=False, report=sys.stdout, refresh=False, max_age=None):
+    pending = {}
+    counts = {'skipped': 0, 'writes': 0}
+
+    def changed():
+        """Streams the identifiers of changed records to the resolver,
+        holding each record's crosswalk until its entities arrive."""
+        for record in iter_records(xmlfile):
+            ident = record.find('atom[@name="EADUnitID"]').text
+            title = record.find('atom[@name="EADUnitTitle"]').text
+            root = build_root(record)
+            if state is not None and not verify and state.unchanged(
+                    ident, digest(title or ''), digest(canonical(root))):
+                counts['skipped'] += 1
+                continue
+            if ident in pending:
+                pending[ident].append((title, root))
+                continue
+            pending[ident] = [(title, root)]
+            print('Finding refs for identifier', ident)
+            yield ident
+
+    for ident, objects in session.resolve_identifiers(
+            changed(), index=index, workers=workers, refresh=refresh,
+            max_age=max_age):
+        for title, root in pending.pop(ident):
+            counts['writes'] += sync_record(
+                session, ident, title, root, objects, state=state,
+                verify=verify, dry_run=dry_run, report=report)
+    print(f"{counts['skipped']} records unchanged since last sync")
+    if dry_run:
+        print(f"Dry run, {counts['writes']} changes would be sent")
+    else:
+        print(f"{counts['writes']} changes sent")
     session.close()
 
 if __name__ == '__main__':
-    sesh = preservica_session.get_session()
-    main(sys.argv[1], sesh)
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Synchronise metadata from an EMu XML export to Preservica')
+    parser.add_argument('xmlfile', help='EMu xml for preservica report')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--index', default=str(DEFAULT_INDEX),
+        help='local identifier index, reused between runs')
+    parser.add_argument(
+        '--noindex', action='store_true',
+        help='look up every identifier with the API')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='look up every identifier with the API and update the index')
+    parser.add_argument(
+        '--maxage', type=float,
+        help='look up identifiers indexed more than this many days ago')
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='number of identifiers resolved concurrently')
+    parser.add_argument(
+        '--state', default=str(DEFAULT_STATE),
+        help='local record of what was last synced, for skipping no-op writes')
+    parser.add_argument(
+        '--nostate', action='store_true',
+        help='compare every record with Preservica rather than the state')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='compare MODS with the fragment in Preservica before writing')
+    parser.add_argument(
+        '--dryrun', action='store_true',
+        help='report what would change without writing anything')
+    parser.add_argument(
+        '--report', help='file for the dry run report, defaults to stdout')
+    args = parser.parse_args()
+    index = None if args.noindex else identifier_index(args.index)
+    state = None if args.nostate else sync_state(args.state)
+    report = sys.stdout if args.report is None else open(args.report, 'w')
+    sesh = preservica_session.get_session(profile=args.profile)
+    main(
+        args.xmlfile, sesh, index=index, workers=args.workers, state=state,
+        verify=args.verify, dry_run=args.dryrun, report=report,
+        refresh=args.refresh,
+        max_age=None if args.maxage is None else args.maxage * DAY)
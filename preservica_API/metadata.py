@@ -0,0 +1,85 @@
+"""Concurrent retrieval of metadata fragments for many entities, for
+collection-wide metadata audits."""
+
+
+import argparse
+from itertools import count
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from preservica_API import (
+    preservica_session, select_fragments, logger, log_to_console, SCHEMAS)
+
+
+def fetch_metadata(session, objects, schemas=None, workers=8):
+    """Generator yielding (entity, fragments) for each entity in objects,
+    where fragments is a list of dicts with the schema, uri and parsed
+    content of each fragment, as from preservica_session.get_metadata.
+    Fragments are filtered by schema before download and fetched workers at
+    a time across all entities, so many small entities or a few heavily
+    described ones both keep the pool busy. Entities are yielded once all
+    their fragments have arrived, in completion order. objects is consumed
+    lazily and may be a stream such as the output of walk(fetch=True). A
+    fragment that can't be retrieved is logged and has content None, as
+    with get_fragment."""
+    window = workers * 4
+    running = {}
+    waiting = {}
+    objects = iter(objects)
+    keys = count()  # an entity may appear more than once in objects
+    with ThreadPoolExecutor(workers) as ex:
+        while True:
+            for object in objects:
+                fragments = select_fragments(object, schemas)
+                if not fragments:
+                    yield object, []
+                    continue
+                key = next(keys)
+                waiting[key] = [object, fragments, len(fragments)]
+                for frag in fragments:
+                    f = ex.submit(session.get_fragment, frag['uri'])
+                    running[f] = (key, frag)
+                if len(running) >= window:
+                    break
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                key, frag = running.pop(f)
+                try:
+                    frag['content'] = f.result()
+                except Exception as e:
+                    logger.error(
+                        f"Unable to retrieve metadata fragment {frag['uri']}")
+                    logger.exception(e)
+                    frag['content'] = None
+                state = waiting[key]
+                state[2] -= 1
+                if state[2] == 0:
+                    del waiting[key]
+                    yield state[0], state[1]
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Dump the metadata of everything beneath a folder')
+    parser.add_argument('ref', help='ref of the folder to start from')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--schemas', nargs='+',
+        help=f'schemas to retrieve, namespaces or one of {list(SCHEMAS)}')
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help='number of fragments fetched concurrently')
+    args = parser.parse_args()
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        objects = sesh.walk(args.ref, types=['SO', 'IO'], fetch=True)
+        for object, fragments in fetch_metadata(
+                sesh, objects, schemas=args.schemas, workers=args.workers):
+            for frag in fragments:
+                if frag['content'] is not None:
+                    print(object.ref, frag['schema'])
+                    print(etree.tostring(
+                        frag['content'], pretty_print=True).decode())
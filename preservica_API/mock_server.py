@@ -0,0 +1,394 @@
+"""Local stand-in for the parts of the Preservica REST API used by this
+library, for testing and benchmarking without touching a real tenant.
+Entities are held in memory. Latency, error rates and page sizes can be
+set to mimic a loaded server.
+
+python mock_server.py --port 8080 --folders 10 --items 100 --latency 0.02
+then point a session at it with protocol='http' and host='localhost:8080'."""
+
+
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+from threading import Lock, Thread
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape, quoteattr
+
+ENTITY_NS = "http://preservica.com/EntityAPI/v6.0"
+XIP_NS = "http://preservica.com/XIP/v6.0"
+TYPES = {
+    "structural-objects": ("SO", "StructuralObject"),
+    "information-objects": ("IO", "InformationObject"),
+    "content-objects": ("CO", "ContentObject")}
+SHORT_TYPES = {short: path for path, (short, _) in TYPES.items()}
+ENTITY_PATH = re.compile(
+    r'^/api/entity/(structural-objects|information-objects|content-objects)'
+    r'/([^/]+)(?:/(children|metadata|upload-package|security-tag|'
+    r'representations)(?:/([^/]+)(?:/([^/]+))?)?)?$')
+
+
+class mock_preservica(ThreadingHTTPServer):
+    """In-memory Preservica. latency is a number of seconds, or a (min, max)
+    tuple for uniformly jittered delays, added to every request.
+    error_rate is the fraction of entity requests answered with 503 and a
+    Retry-After of retry_after seconds. page_size caps the number of
+    children returned per page regardless of what the client asks for."""
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+                 retry_after=0, page_size=100, token_lifetime=15):
+        super(mock_preservica, self).__init__(address, mock_handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.token_lifetime = token_lifetime
+        self.entities = {}
+        self.identifiers = {}
+        self.tokens = set()
+        self.uploads = []
+        self.requests = 0
+        self.lock = Lock()
+
+    @property
+    def host(self):
+        return f'{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        """Serves from a background thread, returning the host to connect
+        to."""
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self.host
+
+    def add_entity(self, type, title, parent=None, security='open',
+                   identifier=None, ref=None):
+        ref = ref or str(uuid.uuid4())
+        self.entities[ref] = {
+            'type': type, 'title': title, 'parent': parent,
+            'security': security, 'children': [], 'metadata': {},
+            'version': 1}
+        if parent is not None:
+            self.entities[parent]['children'].append(ref)
+        if identifier is not None:
+            self.identifiers.setdefault(identifier, []).append(ref)
+        return ref
+
+    def descendants(self, ref):
+        """Refs of everything beneath ref, content objects included."""
+        found = []
+        pending = list(self.entities[ref]['children'])
+        while pending:
+            child = pending.pop()
+            found.append(child)
+            pending.extend(self.entities[child]['children'])
+        return found
+
+    def add_metadata(self, ref, schema, content):
+        meta_id = str(uuid.uuid4())
+        self.entities[ref]['metadata'][meta_id] = (schema, content)
+        self.entities[ref]['version'] += 1
+        return meta_id
+
+    def populate(self, folders=10, items=100, prefix='TEST'):
+        """Builds a root folder containing folders, each holding items
+        assets with identifiers prefix.folder.item and a MODS fragment.
+        Returns the root folder ref."""
+        root = self.add_entity('SO', 'Root')
+        for f in range(folders):
+            folder = self.add_entity(
+                'SO', f'Folder {f}', parent=root,
+                identifier=f'{prefix}.{f}')
+            for i in range(items):
+                ident = f'{prefix}.{f}.{i}'
+                ref = self.add_entity(
+                    'IO', f'Item {ident}', parent=folder, identifier=ident)
+                self.add_metadata(
+                    ref, 'http://www.loc.gov/mods/v3',
+                    '<mods xmlns="http://www.loc.gov/mods/v3"><titleInfo>'
+                    f'<title>Item {ident}</title></titleInfo></mods>')
+        return root
+
+    def url(self, ref):
+        path = SHORT_TYPES[self.entities[ref]['type']]
+        return f'http://{self.host}/api/entity/{path}/{ref}'
+
+
+class mock_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _delay(self):
+        latency = self.server.latency
+        if isinstance(latency, (tuple, list)):
+            latency = random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def _send(self, status, body=b'', content_type='application/xml',
+              headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self, method):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._body() if method in ('POST', 'PUT') else b''
+        self._delay()
+        if url.path.startswith('/api/accesstoken/'):
+            return self._token(url.path.rsplit('/', 1)[1], body, query)
+        if url.path == '/mock/stats':
+            return self._send(200, json.dumps({
+                'requests': self.server.requests,
+                'entities': len(self.server.entities),
+                'uploads': len(self.server.uploads)}), 'application/json')
+        if self.headers.get('Preservica-Access-Token') not in self.server.tokens:
+            return self._send(401)
+        if random.random() < self.server.error_rate:
+            return self._send(
+                503, headers={'Retry-After': str(self.server.retry_after)})
+        if method == 'GET':
+            return self._route(method, url, query, body)
+        with self.server.lock:
+            return self._route(method, url, query, body)
+
+    def _route(self, method, url, query, body):
+        if url.path == '/api/entity/entities/by-identifier' and method == 'GET':
+            return self._by_identifier(query)
+        match = ENTITY_PATH.match(url.path)
+        if match is None:
+            return self._send(404)
+        path, ref, sub, meta_id, number = match.groups()
+        ent = self.server.entities.get(ref)
+        if ent is None or TYPES[path][0] != ent['type']:
+            return self._send(404)
+        if sub is None and method == 'GET':
+            return self._entity(ref, ent)
+        if sub is None and method == 'PUT':
+            return self._update(ref, ent, body)
+        if sub == 'children' and method == 'GET':
+            return self._children(ref, ent, query)
+        if sub == 'representations' and method == 'GET' \
+                and ent['type'] == 'IO':
+            if meta_id is None:
+                return self._representations(ref)
+            if (meta_id, number) == ('Preservation', '1'):
+                return self._representation(ref, ent)
+        if sub == 'metadata' and meta_id is None and method == 'POST':
+            meta_id = self.server.add_metadata(
+                ref, _schema(body), body.decode())
+            return self._metadata(ref, ent, meta_id)
+        if sub == 'metadata' and meta_id in ent['metadata']:
+            if method == 'PUT':
+                ent['metadata'][meta_id] = (_schema(body), body.decode())
+                ent['version'] += 1
+            return self._metadata(ref, ent, meta_id)
+        if sub == 'security-tag' and method == 'PUT':
+            refs = [ref]
+            if query.get('includeDescendants') == 'true':
+                refs += self.server.descendants(ref)
+            for r in refs:
+                self.server.entities[r]['security'] = body.decode()
+                self.server.entities[r]['version'] += 1
+            return self._send(202, str(uuid.uuid4()), 'text/plain')
+        if sub == 'upload-package' and method == 'POST':
+            self.server.uploads.append((ref, query.get('filename'), len(body)))
+            return self._send(200, str(uuid.uuid4()), 'text/plain')
+        return self._send(404)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _token(self, action, body, query):
+        form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if action == 'revoke':
+            self.server.tokens.discard(query.get('access-token'))
+            return self._send(200, 'Token revoked', 'text/plain')
+        if action == 'refresh' and form.get('refreshToken') is None:
+            return self._send(401)
+        token = str(uuid.uuid4())
+        self.server.tokens.add(token)
+        return self._send(200, json.dumps({
+            'success': True, 'token': token,
+            'refresh-token': str(uuid.uuid4()),
+            'validFor': self.server.token_lifetime}), 'application/json')
+
+    def _entity(self, ref, ent):
+        etag = f'"{ent["version"]}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers={'ETag': etag})
+        tag = TYPES[SHORT_TYPES[ent['type']]][1]
+        url = self.server.url(ref)
+        xip = (
+            f'<xip:{tag}><xip:Ref>{ref}</xip:Ref>'
+            f'<xip:Title>{escape(ent["title"])}</xip:Title>'
+            f'<xip:SecurityTag>{escape(ent["security"])}</xip:SecurityTag>')
+        info = f'<Self>{url}</Self>'
+        if ent['parent'] is not None:
+            xip += f'<xip:Parent>{ent["parent"]}</xip:Parent>'
+            info += f'<Parent>{self.server.url(ent["parent"])}</Parent>'
+        xip += f'</xip:{tag}>'
+        if ent['type'] == 'SO':
+            info += f'<Children>{url}/children</Children>'
+        if ent['metadata']:
+            info += '<Metadata>' + ''.join(
+                f'<Fragment schema={quoteattr(schema)}>{url}/metadata/{m}</Fragment>'
+                for m, (schema, _) in ent['metadata'].items()) + '</Metadata>'
+        body = (
+            f'<EntityResponse xmlns="{ENTITY_NS}" xmlns:xip="{XIP_NS}">'
+            f'{xip}<AdditionalInformation>{info}</AdditionalInformation>'
+            '</EntityResponse>')
+        return self._send(200, body, headers={'ETag': etag})
+
+    def _update(self, ref, ent, body):
+        for field, key in (('Title', 'title'), ('SecurityTag', 'security')):
+            match = re.search(
+                rf'<(?:\w+:)?{field}>(.*?)</(?:\w+:)?{field}>', body.decode(),
+                re.S)
+            if match is not None:
+                ent[key] = match.group(1)
+        ent['version'] += 1
+        return self._entity(ref, ent)
+
+    def _children(self, ref, ent, query):
+        start = int(query.get('start', 0))
+        size = min(int(query.get('max', 100)), self.server.page_size)
+        page = ent['children'][start:start+size]
+        children = ''.join(
+            f'<Child title={quoteattr(self.server.entities[c]["title"])} '
+            f'ref="{c}" type="{self.server.entities[c]["type"]}">'
+            f'{self.server.url(c)}</Child>' for c in page)
+        url = self.server.url(ref) + '/children'
+        paging = f'<TotalResults>{len(ent["children"])}</TotalResults>'
+        if start + size < len(ent['children']):
+            paging = (
+                f'<Next>{url}?start={start+size}&amp;max={size}</Next>'
+                + paging)
+        body = (
+            f'<ChildrenResponse xmlns="{ENTITY_NS}" xmlns:xip="{XIP_NS}">'
+            f'<Children>{children}</Children><Paging>{paging}</Paging>'
+            f'<AdditionalInformation><Self>{url}</Self>'
+            '</AdditionalInformation></ChildrenResponse>')
+        return self._send(200, body)
+
+    def _representations(self, ref):
+        """Assets have a single representation holding their children."""
+        url = f'{self.server.url(ref)}/representations'
+        body = (
+            f'<RepresentationsResponse xmlns="{ENTITY_NS}" '
+            f'xmlns:xip="{XIP_NS}"><Representations>'
+            f'<Representation type="Preservation">{url}/Preservation/1'
+            '</Representation></Representations><AdditionalInformation>'
+            f'<Self>{url}</Self></AdditionalInformation>'
+            '</RepresentationsResponse>')
+        return self._send(200, body)
+
+    def _representation(self, ref, ent):
+        url = f'{self.server.url(ref)}/representations/Preservation/1'
+        objects = ''.join(
+            f'<ContentObject title={quoteattr(self.server.entities[c]["title"])} '
+            f'ref="{c}" type="CO">{self.server.url(c)}</ContentObject>'
+            for c in ent['children'])
+        body = (
+            f'<RepresentationResponse xmlns="{ENTITY_NS}" '
+            f'xmlns:xip="{XIP_NS}"><xip:Representation>'
+            f'<xip:InformationObject>{ref}</xip:InformationObject>'
+            '<xip:Name>Preservation-1</xip:Name>'
+            '<xip:Type>Preservation</xip:Type></xip:Representation>'
+            f'<ContentObjects>{objects}</ContentObjects>'
+            f'<AdditionalInformation><Self>{url}</Self>'
+            '</AdditionalInformation></RepresentationResponse>')
+        return self._send(200, body)
+
+    def _by_identifier(self, query):
+        refs = self.server.identifiers.get(query.get('value'), [])
+        entities = ''.join(
+            f'<Entity title={quoteattr(self.server.entities[r]["title"])} '
+            f'ref="{r}" type="{self.server.entities[r]["type"]}">'
+            f'{self.server.url(r)}</Entity>' for r in refs)
+        body = (
+            f'<IdentifiersResponse xmlns="{ENTITY_NS}" xmlns:xip="{XIP_NS}">'
+            f'<Entities>{entities}</Entities></IdentifiersResponse>')
+        return self._send(200, body)
+
+    def _metadata(self, ref, ent, meta_id):
+        schema, content = ent['metadata'][meta_id]
+        url = f'{self.server.url(ref)}/metadata/{meta_id}'
+        body = (
+            f'<MetadataResponse xmlns="{ENTITY_NS}" xmlns:xip="{XIP_NS}">'
+            f'<MetadataContainer schema={quoteattr(schema)}>'
+            f'<Ref>{meta_id}</Ref><Entity>{ref}</Entity>'
+            f'<Content>{_strip_declaration(content)}</Content>'
+            '</MetadataContainer><AdditionalInformation>'
+            f'<Self>{url}</Self></AdditionalInformation></MetadataResponse>')
+        return self._send(200, body)
+
+
+def _schema(body):
+    """Namespace of the root element of a metadata fragment."""
+    match = re.search(rb'<(?:\w+:)?\w+[^>]*?xmlns(?::\w+)?="([^"]+)"', body)
+    return match.group(1).decode() if match else ''
+
+
+def _strip_declaration(content):
+    return re.sub(r'^\s*<\?xml[^>]*\?>', '', content)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in Preservica API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--folders', type=int, default=10, help='folders to create')
+    parser.add_argument(
+        '--items', type=int, default=100, help='assets per folder')
+    parser.add_argument(
+        '--latency', type=float, nargs='+', default=[0],
+        help='seconds added to each request, or a min and max')
+    parser.add_argument(
+        '--errorrate', type=float, default=0,
+        help='fraction of requests answered with 503')
+    parser.add_argument(
+        '--pagesize', type=int, default=100, help='maximum children per page')
+    args = parser.parse_args()
+    latency = args.latency[0] if len(args.latency) == 1 else args.latency
+    server = mock_preservica(
+        ('127.0.0.1', args.port), latency=latency,
+        error_rate=args.errorrate, page_size=args.pagesize)
+    root = server.populate(args.folders, args.items)
+    print(f'Serving on {server.host}, root folder {root}')
+    server.serve_forever()
@@ -2,16 +2,30 @@ import pathlib
 from uuid import uuid4
 import sys
 import os
+import math
+import time
+import json
+import base64
+import hashlib
 import threading
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import (
+    ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED)
 import logging
 import boto3
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
 MB = 1024 ** 2
 GB = 1024 ** 3
-logging.basicConfig(
-    format=f'%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+# S3 multipart limits
+MIN_PART = 5 * MB
+MAX_PART = 5 * GB
+MAX_PARTS = 10000
 formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('S3upload')
@@ -20,23 +34,47 @@ ch = logging.StreamHandler()
 ch.setFormatter(formatter)
 ch.setLevel(logging.ERROR)
 logger.addHandler(ch)
-CONFIG = TransferConfig(multipart_threshold=GB)
+DEFAULT_CHUNK = 16 * MB
+TARGET_PART_SECONDS = 5
+MAX_SOCKETS = 20
+CHECKSUM_ALGORITHM = 'SHA256' if crc32c is None else 'CRC32C'
+READ_BLOCK = 8 * MB
 
 
 class ProgressTracker(object):
-    def __init__(self):
+    """Counts bytes sent by upload threads and renders progress from a
+    single thread every interval seconds, so uploads never contend for the
+    console. Counts are per part, so the lock around the total is taken
+    rarely. If jsonl is given (a path or file object) a JSON line with the
+    same figures is appended to it on every render."""
+
+    def __init__(self, interval=1.0, stream=sys.stdout, jsonl=None):
+        self.interval = interval
+        self.stream = stream
+        self.jsonl = jsonl
         self._size = 0
         self._numfiles = 0
-        self._seen_so_far = 0
         self.completed = 0
         self.failed = 0
+        self._sent = 0
         self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._jsonl = None
+        self._start = None
+        self._last = (None, 0)
+        self._rate = 0
+
+    @property
+    def sent(self):
+        return self._sent
 
     def trackfile(self, fpath):
         fpath = pathlib.Path(fpath)
         with self._lock:
             self._size += fpath.stat().st_size
             self._numfiles += 1
+        self.start()
 
     def complete(self):
         with self._lock:
@@ -46,74 +84,499 @@ class ProgressTracker(object):
         with self._lock:
             self.failed += 1
 
-    def displaymessage(self):
-        if self._size < GB:
-            dsize = f"{round(self._size / MB, ndigits=2)}mb"
-            dseen = f"{round(self._seen_so_far / MB, ndigits=2)}mb"
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self._sent += bytes_amount
+
+    def start(self):
+        """Starts the render thread if it isn't already running."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            if isinstance(self.jsonl, (str, os.PathLike)):
+                self._jsonl = open(self.jsonl, 'a')
+            else:
+                self._jsonl = self.jsonl
+            self._start = self._last = (time.monotonic(), self.sent)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._render, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the render thread after a final render."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join()
+        self.stream.write('\n')
+        self.stream.flush()
+        if self._jsonl is not None and self._jsonl is not self.jsonl:
+            self._jsonl.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _render(self):
+        while True:
+            stopping = self._stop.wait(self.interval)
+            self.render()
+            if stopping:
+                return
+
+    def snapshot(self):
+        """Returns the current figures as a dict. rate is the throughput
+        since the last snapshot and average since the tracker started, both
+        in bytes per second. eta is in seconds, or None while nothing has
+        been sent."""
+        now = time.monotonic()
+        sent = self.sent
+        then, before = self._last
+        if now > then:
+            self._rate = (sent - before) / (now - then)
+        self._last = (now, sent)
+        began, base = self._start
+        elapsed = now - began
+        average = (sent - base) / elapsed if elapsed else 0
+        eta = None
+        if average:
+            eta = max(self._size - sent, 0) / average
+        return {
+            'time': time.time(), 'packages': self._numfiles,
+            'completed': self.completed, 'failed': self.failed,
+            'sent': sent, 'total': self._size, 'rate': self._rate,
+            'average': average, 'eta': eta}
+
+    def render(self):
+        snapshot = self.snapshot()
+        self.stream.write(self.displaymessage(snapshot))
+        self.stream.flush()
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps(snapshot) + '\n')
+            self._jsonl.flush()
+
+    def displaymessage(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        size, seen = snapshot['total'], snapshot['sent']
+        if size < GB:
+            dsize = f"{round(size / MB, ndigits=2)}mb"
+            dseen = f"{round(seen / MB, ndigits=2)}mb"
         else:
-            dsize = f"{round(self._size / GB, ndigits=2)}gb"
-            dseen = f"{round(self._seen_so_far / GB, ndigits=2)}gb"
-        percentage = round((self._seen_so_far / self._size) * 100, ndigits=2)
+            dsize = f"{round(size / GB, ndigits=2)}gb"
+            dseen = f"{round(seen / GB, ndigits=2)}gb"
+        percentage = round((seen / size) * 100, ndigits=2) if size else 0
+        eta = snapshot['eta']
+        eta = 'unknown' if eta is None else f'{eta:.0f}s'
         basemessage = f'\rUploaded {self.completed} of {self._numfiles} package(s)'
         if self.failed > 0:
             basemessage += f' ({self.failed} failed)'
-        message = basemessage + f', {dseen} / {dsize} ({percentage}%)    '
+        message = basemessage + (
+            f', {dseen} / {dsize} ({percentage}%), '
+            f'{snapshot["rate"] / MB:.2f}mb/s '
+            f'(avg {snapshot["average"] / MB:.2f}mb/s), ETA {eta}    ')
         return message
 
-    def __call__(self, bytes_amount):
+
+TRACKER = ProgressTracker()
+
+
+class BandwidthEstimator(object):
+    """Exponentially weighted estimate of the throughput of a single upload
+    connection, learned from completed uploads."""
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.estimate = None
+        self._lock = threading.Lock()
+
+    def update(self, nbytes, seconds, connections):
+        if seconds <= 0 or nbytes < MIN_PART:
+            return  # too small to say anything useful
+        rate = nbytes / seconds / max(connections, 1)
         with self._lock:
-            self._seen_so_far += bytes_amount
-            sys.stdout.write(self.displaymessage())
-            sys.stdout.flush()
+            if self.estimate is None:
+                self.estimate = rate
+            else:
+                self.estimate += self.weight * (rate - self.estimate)
 
 
-TRACKER = ProgressTracker()
+BANDWIDTH = BandwidthEstimator()
+
+
+def transfer_config(size, bandwidth=None, max_concurrency=10):
+    """Chooses multipart settings for a file of size bytes. Parts are sized
+    to take about TARGET_PART_SECONDS at the per-connection bandwidth (bytes
+    per second) where it is known, and otherwise to DEFAULT_CHUNK, grown so
+    large files stay within 1000 parts. Parts always respect the S3 limits
+    of 5mb to 5gb and at most 10,000 per upload. Files of more than one
+    part go up as concurrent multipart uploads, using up to max_concurrency
+    connections but no more than there are parts."""
+    if bandwidth:
+        chunk = bandwidth * TARGET_PART_SECONDS
+    else:
+        chunk = max(DEFAULT_CHUNK, size / 1000)
+    chunk = max(chunk, math.ceil(size / MAX_PARTS), MIN_PART)
+    chunk = min(MB * math.ceil(chunk / MB), MAX_PART)
+    parts = max(1, math.ceil(size / chunk))
+    return TransferConfig(
+        multipart_threshold=chunk + 1, multipart_chunksize=chunk,
+        max_concurrency=max(1, min(max_concurrency, parts)))
 
 
-def get_client(bucketpath):
-    """Get the thing that uploads files to bucketpath"""
-    s3 = boto3.resource('s3')
+def get_client(bucketpath, max_sockets=MAX_SOCKETS, endpoint_url=None):
+    """Get the thing that uploads files to bucketpath. max_sockets sizes
+    the connection pool, which is shared by every upload using the client.
+    endpoint_url allows a local S3 stand-in to be used."""
+    s3 = boto3.resource(
+        's3', endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=max_sockets))
     bucket = s3.Bucket(bucketpath)
     return bucket
 
 
-def S3upload(file, bucketpath, delete_source=True, client=None):
+class S3journal(object):
+    """Append-only JSON lines record of S3 uploads, by object key. Each
+    package's name, size and modification time are kept with its key, so
+    an interrupted multipart upload (whose upload id, part size and checksum
+    algorithm are recorded) can be found and resumed without rereading the
+    package. Completed uploads are also indexed by the SHA-256 taken while
+    uploading, so a package whose content is already in the bucket is
+    skipped whenever its hash is known up front: from a .sha256 sidecar, or
+    because the journal has seen the package unchanged."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._entries = {}  # key: merged entry
+        self._keys = {}  # stat: key
+        self._digests = {}  # stat: sha256
+        self._completed = {}  # sha256: key
+        if self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # partial line from an interrupted write
+                    self._add(entry)
+
+    def _add(self, entry):
+        key = entry['key']
+        stat = tuple(entry['stat'])
+        merged = self._entries.setdefault(key, {})
+        merged.update(entry)
+        self._keys[stat] = key
+        sha256 = merged.get('sha256')
+        if sha256 is not None:
+            self._digests[stat] = sha256
+            if merged['status'] == 'complete':
+                self._completed[sha256] = key
+
+    @staticmethod
+    def stat(fpath):
+        stat = pathlib.Path(fpath).stat()
+        return (pathlib.Path(fpath).name, stat.st_size, stat.st_mtime_ns)
+
+    def digest(self, fpath):
+        """SHA-256 of the package if the journal has seen it unchanged,
+        otherwise None. The package isn't read."""
+        return self._digests.get(self.stat(fpath))
+
+    def lookup(self, fpath):
+        """The journal entry for the package, if it is unchanged since it
+        was last recorded, otherwise None."""
+        key = self._keys.get(self.stat(fpath))
+        return None if key is None else self._entries.get(key)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def completed(self, digest):
+        """The key the package with SHA-256 digest was uploaded as, or None
+        if it hasn't been."""
+        return self._completed.get(digest)
+
+    def record(self, fpath, key, status, **details):
+        entry = dict(
+            key=key, stat=list(self.stat(fpath)), status=status,
+            time=time.time(), **details)
+        with self._lock:
+            with self.path.open('a') as f:
+                f.write(json.dumps(entry)+'\n')
+            self._add(entry)
+
+
+class ChecksumMismatch(Exception):
+    """Raised when a package doesn't match its recorded SHA-256."""
+
+
+def _b64(digest):
+    return base64.b64encode(digest).decode()
+
+
+def _checksum(data, algorithm):
+    """Base64 checksum of data in the form S3 expects."""
+    if algorithm == 'CRC32C':
+        return _b64(crc32c.crc32c(data).to_bytes(4, 'big'))
+    return _b64(hashlib.sha256(data).digest())
+
+
+def sidecar_sha256(fpath):
+    """The SHA-256 recorded for a package in a sha256sum style sidecar file
+    (package.zip.sha256), or None if there isn't one."""
+    sidecar = pathlib.Path(f'{fpath}.sha256')
+    if not sidecar.exists():
+        return None
+    return sidecar.read_text().split()[0].lower()
+
+
+def _check_sha256(fpath, sha256, expected):
+    for value in expected:
+        if value is not None and value != sha256:
+            raise ChecksumMismatch(
+                f'{fpath} has SHA-256 {sha256}, expected {value}')
+
+
+def _upload_part(client, bucket, key, upload_id, number, data, algorithm):
+    checksum = _checksum(data, algorithm)
+    response = client.upload_part(
+        Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+        Body=data, **{f'Checksum{algorithm}': checksum})
+    TRACKER(len(data))
+    return {
+        'PartNumber': number, 'ETag': response['ETag'],
+        f'Checksum{algorithm}': checksum}
+
+
+def _uploaded_parts(client, bucket, key, upload_id, algorithm):
+    parts = {}
+    paginator = client.get_paginator('list_parts')
+    for page in paginator.paginate(
+            Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            if f'Checksum{algorithm}' not in part:
+                continue  # can't complete without it, so send it again
+            parts[part['PartNumber']] = {
+                'PartNumber': part['PartNumber'], 'ETag': part['ETag'],
+                f'Checksum{algorithm}': part[f'Checksum{algorithm}'],
+                'Size': part['Size']}
+    return parts
+
+
+def _put(bucket, fpath, key, metadata, algorithm, expected):
+    """Single request upload, streamed from the file after it has been
+    read in blocks for the SHA-256 and the checksum, so the package is
+    never held in memory. Returns the SHA-256 of the package and the
+    checksum S3 stored."""
+    sha = hashlib.sha256()
+    crc = 0
+    with fpath.open('rb') as data:
+        for block in iter(lambda: data.read(READ_BLOCK), b''):
+            sha.update(block)
+            if algorithm == 'CRC32C':
+                crc = crc32c.crc32c(block, crc)
+        sha256 = sha.hexdigest()
+        _check_sha256(fpath, sha256, expected)
+        if algorithm == 'CRC32C':
+            checksum = _b64(crc.to_bytes(4, 'big'))
+        else:
+            checksum = _b64(sha.digest())
+        data.seek(0)
+        response = bucket.meta.client.put_object(
+            Bucket=bucket.name, Key=key, Body=data,
+            **{f'Checksum{algorithm}': checksum}, **metadata)
+    TRACKER(fpath.stat().st_size)
+    return sha256, response.get(f'Checksum{algorithm}')
+
+
+def _multipart_upload(bucket, fpath, key, metadata, config, algorithm,
+                      expected, journal=None, resume=None):
+    """Multipart upload through the low-level client. Parts are read once,
+    in order, feeding both the part upload and a SHA-256 of the whole
+    package, and each part is sent with its checksum so S3 verifies it on
+    arrival. With a journal the upload id, part size and checksum algorithm
+    are recorded. If resume is the journal entry of an upload of this
+    package that S3 still knows about, only the parts it doesn't have are
+    sent, with the algorithm the upload was started with; the parts it has
+    are still read for the SHA-256. Returns the SHA-256 of the package, the
+    checksum S3 stored and the checksum algorithm used."""
+    client = bucket.meta.client
+    size = fpath.stat().st_size
+    entry = resume or {}
+    upload_id = entry.get('upload_id')
+    chunksize = entry.get('chunksize')
+    done = {}
+    if upload_id is not None:
+        resumed = entry.get('checksum_algorithm', 'SHA256')
+        try:
+            done = _uploaded_parts(
+                client, bucket.name, key, upload_id, resumed)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            upload_id = None
+        else:
+            if resumed != algorithm:
+                logger.info(
+                    f'Resuming {fpath} with {resumed} checksums, as it was '
+                    'started with')
+            algorithm = resumed
+            logger.info(
+                f'Resuming upload of {fpath}, {len(done)} part(s) already sent')
+            TRACKER(sum(part.pop('Size') for part in done.values()))
+    if upload_id is None:
+        chunksize = config.multipart_chunksize
+        upload_id = client.create_multipart_upload(
+            Bucket=bucket.name, Key=key, ChecksumAlgorithm=algorithm,
+            **metadata)['UploadId']
+        if journal is not None:
+            journal.record(
+                fpath, key, 'in progress', upload_id=upload_id,
+                chunksize=chunksize, checksum_algorithm=algorithm)
+    sha = hashlib.sha256()
+    inflight = set()
+
+    def collect(futures):
+        for f in futures:
+            part = f.result()
+            done[part['PartNumber']] = part
+
+    with fpath.open('rb') as data, \
+            ThreadPoolExecutor(config.max_concurrency) as ex:
+        for number in range(1, math.ceil(size / chunksize) + 1):
+            chunk = data.read(chunksize)
+            sha.update(chunk)
+            if number in done:
+                continue
+            if len(inflight) >= config.max_concurrency:
+                finished, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                collect(finished)
+            inflight.add(ex.submit(
+                _upload_part, client, bucket.name, key, upload_id, number,
+                chunk, algorithm))
+        collect(as_completed(inflight))
+    sha256 = sha.hexdigest()
+    try:
+        _check_sha256(fpath, sha256, expected)
+    except ChecksumMismatch:
+        client.abort_multipart_upload(
+            Bucket=bucket.name, Key=key, UploadId=upload_id)
+        raise
+    response = client.complete_multipart_upload(
+        Bucket=bucket.name, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': [done[n] for n in sorted(done)]})
+    return sha256, response.get(f'Checksum{algorithm}'), algorithm
+
+
+def S3upload(file, bucketpath, delete_source=True, client=None, config=None,
+             max_concurrency=10, journal=None, checksum_algorithm=None):
     """Function for S3 upload with minimum Preservica required metadata.
     If using this method, ensure either the destination bucket is configured
     as a source for a workflow context with a destination folder, or that
     the package for upload contains XIP metadata specifying a destination
     folder. Simple packages uploaded via this method without a destination
     folder configured in the workflow context will fail at ingest.
+    Unless a TransferConfig is given, multipart settings are chosen from the
+    size of the package and the bandwidth measured so far.
+    Every part is sent with an S3 additional checksum, CRC32C if the crc32c
+    package is installed and SHA-256 otherwise, computed from the same read
+    that feeds the upload along with a SHA-256 of the whole package. If the
+    package has a .sha256 sidecar the upload is abandoned when they differ.
+    With an S3journal, interrupted multipart uploads are resumed, and
+    packages whose SHA-256 is known without reading them (see S3journal)
+    are skipped if that content has already been uploaded. The object key
+    is then the SHA-256, otherwise a uuid. Returns the object key, or None
+    if the upload failed. The source is only deleted after a successful
+    upload.
     """
     if client is None:
         bucket = get_client(bucketpath)
     else:
         bucket = client
+    if isinstance(journal, (str, os.PathLike)):
+        journal = S3journal(journal)
+    if checksum_algorithm is None:
+        checksum_algorithm = CHECKSUM_ALGORITHM
+    elif checksum_algorithm == 'CRC32C' and crc32c is None:
+        raise ValueError('CRC32C checksums need the crc32c package')
     fpath = pathlib.Path(file)
-    key = str(uuid4())
+    size = fpath.stat().st_size
+    digest = sidecar_sha256(fpath)
+    resume = None
+    if journal is not None:
+        digest = digest or journal.digest(fpath)
+        entry = journal.lookup(fpath)
+        if entry is not None and entry['status'] == 'complete':
+            done = entry['key']
+        else:
+            done = None if digest is None else journal.completed(digest)
+        if done is not None:
+            logger.info(f'Skipping {fpath}, already uploaded as {done}')
+            if delete_source:
+                _delete_source(fpath)
+            return done
+        if entry is not None and entry.get('upload_id') is not None:
+            resume = entry
+    key = resume['key'] if resume is not None else digest or str(uuid4())
+    expected = (digest,)
     metadata = {"Metadata": {
         "key": key,
         "name": fpath.name,
-        "size": str(round(fpath.stat().st_size/1024))}}
-    with fpath.open('rb') as data:
-        logger.info(f'Uploading {fpath} to {bucketpath}')
-        try:
-            TRACKER.trackfile(fpath)
-            bucket.upload_fileobj(
-                data, key,  ExtraArgs=metadata, Config=CONFIG,
-                Callback=TRACKER)
-            logger.info(f'Upload of {fpath} complete')
-            TRACKER.complete()
-        except boto3.exceptions.S3UploadFailedError as e:
-            logger.exception(e)
-            TRACKER.fail()
+        "size": str(round(size/1024))}}
+    if config is None:
+        config = transfer_config(
+            size, BANDWIDTH.estimate, max_concurrency=max_concurrency)
+    # an interrupted multipart upload is finished rather than left holding
+    # its parts, even if this package would now go up in one request
+    multipart = resume is not None or size >= config.multipart_threshold
+    logger.info(
+        f'Uploading {fpath} to {bucketpath} in '
+        f'{config.multipart_chunksize // MB}mb parts, '
+        f'{config.max_concurrency} at a time')
+    try:
+        TRACKER.trackfile(fpath)
+        start = time.monotonic()
+        if multipart:
+            sha256, checksum, checksum_algorithm = _multipart_upload(
+                bucket, fpath, key, metadata, config, checksum_algorithm,
+                expected, journal=journal, resume=resume)
+        else:
+            sha256, checksum = _put(
+                bucket, fpath, key, metadata, checksum_algorithm, expected)
+        connections = config.max_concurrency if multipart else 1
+        BANDWIDTH.update(size, time.monotonic() - start, connections)
+    except (BotoCoreError, ClientError, ChecksumMismatch) as e:
+        logger.exception(e)
+        TRACKER.fail()
+        if journal is not None:
+            journal.record(fpath, key, 'failed', error=str(e))
+        return None
+    logger.info(
+        f'Upload of {fpath} complete, SHA-256 {sha256}, '
+        f'{checksum_algorithm} {checksum}')
+    TRACKER.complete()
+    if journal is not None:
+        journal.record(
+            fpath, key, 'complete', upload_id=None, sha256=sha256,
+            checksum_algorithm=checksum_algorithm, checksum=checksum)
     if delete_source:
-        try:
-            fpath.unlink()
-            logger.info(f'Removed source package {fpath}')
-        except Exception as e:
-            logger.error(f'Unable to delete source package {fpath}')
-            logger.exception(e)
+        _delete_source(fpath)
+    return key
+
+
+def _delete_source(fpath):
+    try:
+        fpath.unlink()
+        logger.info(f'Removed source package {fpath}')
+    except Exception as e:
+        logger.error(f'Unable to delete source package {fpath}')
+        logger.exception(e)
 
 
 def _done_callback(future):
@@ -123,17 +586,38 @@ def _done_callback(future):
         logger.exception(e)
 
 
-def bulks3upload(directory, bucketpath, delete_source=True):
-    """Bulk upload method. Threads are capped at 5, beyond this AWS
-    has problems"""
-    bucket = get_client(bucketpath)
-    with ThreadPoolExecutor(5) as ex:
-        for file in os.scandir(directory):
-            if file.name.endswith('zip'):
-                f = ex.submit(
-                    S3upload, *(file.path, bucketpath),
-                    **{'client': bucket, 'delete_source': delete_source})
-                f.add_done_callback(_done_callback)
+def bulks3upload(directory, bucketpath, delete_source=True, workers=5,
+                 max_sockets=MAX_SOCKETS, endpoint_url=None, journal=None,
+                 largest_first=False, checksum_algorithm=None):
+    """Bulk upload method. Packages are capped at 5 at a time by default,
+    beyond this AWS has problems. The max_sockets connections are divided
+    between the packages in flight, so the total number of sockets stays
+    capped however the parts of each package are spread. Uploads are
+    recorded in journal (by default s3_journal.jsonl in directory), so a
+    rerun skips completed packages and resumes partial ones. largest_first
+    starts the biggest packages first so one doesn't finish on its own at
+    the end of the batch."""
+    bucket = get_client(
+        bucketpath, max_sockets=max_sockets, endpoint_url=endpoint_url)
+    if journal is None:
+        journal = pathlib.Path(directory) / 's3_journal.jsonl'
+    journal = S3journal(journal)
+    packages = [
+        file for file in os.scandir(directory) if file.name.endswith('zip')]
+    if largest_first:
+        packages.sort(key=lambda file: file.stat().st_size, reverse=True)
+    else:
+        packages.sort(key=lambda file: file.name)
+    per_package = max(1, max_sockets // workers)
+    with ThreadPoolExecutor(workers) as ex:
+        for file in packages:
+            f = ex.submit(
+                S3upload, *(file.path, bucketpath),
+                **{'client': bucket, 'delete_source': delete_source,
+                   'max_concurrency': per_package, 'journal': journal,
+                   'checksum_algorithm': checksum_algorithm})
+            f.add_done_callback(_done_callback)
+    TRACKER.stop()
 
 
 def configlogfile(logfile):
@@ -147,6 +631,8 @@ def configlogfile(logfile):
 
 
 if __name__ == '__main__':
+    logging.basicConfig(
+        format=f'%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
     parser = argparse.ArgumentParser(
         description='Upload some SIPs to an S3 bucket with Preservica required'
         ' metadata')
@@ -164,12 +650,50 @@ if __name__ == '__main__':
     parser.add_argument(
         '--logfile', '-l',
         help='Path to a log file. If omitted, will log to console')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=5,
+        help='Packages uploaded at once with --bulk')
+    parser.add_argument(
+        '--maxsockets', type=int, default=MAX_SOCKETS,
+        help='Cap on connections across all uploads')
+    parser.add_argument(
+        '--endpoint', help='S3 endpoint url, for S3 compatible stores')
+    parser.add_argument(
+        '--journal', '-j',
+        help='Journal of uploads, used to skip or resume packages. Defaults '
+        'to s3_journal.jsonl in the directory with --bulk')
+    parser.add_argument(
+        '--largestfirst', action='store_true',
+        help='Upload the largest packages first with --bulk')
+    parser.add_argument(
+        '--checksum', choices=['SHA256', 'CRC32C'],
+        help='S3 checksum sent with each part. Defaults to CRC32C if the '
+        'crc32c package is installed, otherwise SHA256')
+    parser.add_argument(
+        '--interval', type=float, default=1.0,
+        help='Seconds between progress updates')
+    parser.add_argument(
+        '--jsonl', help='Append progress as JSON lines to this file')
     args = parser.parse_args()
+    TRACKER.interval = args.interval
+    TRACKER.jsonl = args.jsonl
 
     if args.logfile is not None:
         configlogfile(args.logfile)
 
     if args.bulk:
-        bulks3upload(args.i, args.bucket, delete_source=args.deletesource)
+        bulks3upload(
+            args.i, args.bucket, delete_source=args.deletesource,
+            workers=args.workers, max_sockets=args.maxsockets,
+            endpoint_url=args.endpoint, journal=args.journal,
+            largest_first=args.largestfirst,
+            checksum_algorithm=args.checksum)
     else:
-        S3upload(args.i, args.bucket, delete_source=args.deletesource)
+        client = get_client(
+            args.bucket, max_sockets=args.maxsockets,
+            endpoint_url=args.endpoint)
+        S3upload(
+            args.i, args.bucket, delete_source=args.deletesource,
+            client=client, max_concurrency=args.maxsockets,
+            journal=args.journal, checksum_algorithm=args.checksum)
+        TRACKER.stop()
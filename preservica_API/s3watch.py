@@ -0,0 +1,251 @@
+"""Watches a directory for packages and uploads them to S3 as they arrive.
+A package is picked up once it has stopped changing, or once its sentinel
+file appears, and queued to a fixed pool of upload workers. Uploads are
+journaled as in bulks3upload, so restarting the watcher resumes where it
+left off."""
+
+
+import os
+import json
+import time
+import signal
+import pathlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from preservica_API import s3upload
+from preservica_API.s3upload import (
+    S3upload, S3journal, get_client, configlogfile, logger, MAX_SOCKETS)
+
+
+class folder_watcher(object):
+    """Polls directory every interval seconds for files ending in suffix.
+    Without a sentinel, a package is ready once its size and modification
+    time are unchanged between two polls and it hasn't been modified for
+    settle seconds. With a sentinel (e.g. '.done'), a package is ready once
+    package.zip.done exists. Ready packages are uploaded workers at a time;
+    failed ones are retried after retry seconds. If status is given, a JSON
+    summary is written there after every poll."""
+
+    def __init__(self, directory, bucketpath, workers=5,
+                 max_sockets=MAX_SOCKETS, endpoint_url=None, journal=None,
+                 interval=1.0, settle=2.0, sentinel=None, suffix='.zip',
+                 status=None, retry=60, delete_source=False,
+                 checksum_algorithm=None):
+        self.directory = pathlib.Path(directory)
+        self.bucketpath = bucketpath
+        self.workers = workers
+        self.interval = interval
+        self.settle = settle
+        self.sentinel = sentinel
+        self.suffix = suffix
+        self.status = None if status is None else pathlib.Path(status)
+        self.retry = retry
+        self.delete_source = delete_source
+        self.checksum_algorithm = checksum_algorithm
+        self.bucket = get_client(
+            bucketpath, max_sockets=max_sockets, endpoint_url=endpoint_url)
+        self.per_package = max(1, max_sockets // workers)
+        if journal is None:
+            journal = self.directory / 's3_journal.jsonl'
+        self.journal = S3journal(journal)
+        self.completed = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._candidates = {}  # path: (size, mtime_ns) at the last poll
+        self._active = {}  # path: future, for queued and uploading packages
+        self._uploading = set()
+        self._finished = {}  # path: (size, mtime_ns) of the uploaded version
+        self._failures = {}  # path: time of the last failure
+        self._executor = None
+
+    def stop(self, *args):
+        """Stops polling. Uploads already started are allowed to finish."""
+        if not self._stop.is_set():
+            logger.info('Stopping, waiting for uploads in progress')
+        self._stop.set()
+
+    def _ready(self, entry, now):
+        stat = entry.stat()
+        key = (stat.st_size, stat.st_mtime_ns)
+        path = entry.path
+        if self._finished.get(path) == key:
+            return False
+        if path in self._failures:
+            if now - self._failures[path] < self.retry:
+                return False
+        if self.sentinel is not None:
+            return os.path.exists(path + self.sentinel)
+        previous = self._candidates.get(path)
+        self._candidates[path] = key
+        return previous == key and now - stat.st_mtime >= self.settle
+
+    def poll(self):
+        """Scans the directory once and queues any packages that are ready.
+        Returns the number queued."""
+        now = time.time()
+        queued = 0
+        seen = set()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(self.suffix) or not entry.is_file():
+                    continue
+                seen.add(entry.path)
+                with self._lock:
+                    if entry.path in self._active:
+                        continue
+                try:
+                    ready = self._ready(entry, now)
+                except FileNotFoundError:
+                    continue  # removed since the scan
+                if ready:
+                    self._submit(entry.path)
+                    queued += 1
+        for path in set(self._candidates) - seen:
+            del self._candidates[path]
+        # forget packages that have gone, eg deleted after upload
+        with self._lock:
+            for record in (self._finished, self._failures):
+                for path in set(record) - seen - set(self._active):
+                    del record[path]
+        return queued
+
+    def _submit(self, path):
+        self._candidates.pop(path, None)
+        stat = os.stat(path)
+        # registered before submitting, as a quick upload may finish first
+        with self._lock:
+            self._active[path] = None
+        future = self._executor.submit(
+            self._upload, path, (stat.st_size, stat.st_mtime_ns))
+        with self._lock:
+            if path in self._active:
+                self._active[path] = future
+
+    def _upload(self, path, key):
+        with self._lock:
+            self._uploading.add(path)
+        try:
+            result = S3upload(
+                path, self.bucketpath, delete_source=self.delete_source,
+                client=self.bucket, max_concurrency=self.per_package,
+                journal=self.journal,
+                checksum_algorithm=self.checksum_algorithm)
+        except Exception as e:
+            logger.exception(e)
+            result = None
+        with self._lock:
+            self._uploading.discard(path)
+            del self._active[path]
+            if result is None:
+                self.failed += 1
+                self._failures[path] = time.time()
+            else:
+                self.completed += 1
+                self._failures.pop(path, None)
+                self._finished[path] = key
+        return result
+
+    def write_status(self, state='running'):
+        if self.status is None:
+            return
+        with self._lock:
+            status = {
+                'state': state, 'time': time.time(),
+                'directory': str(self.directory),
+                'uploading': sorted(self._uploading),
+                'queued': sorted(set(self._active) - self._uploading),
+                'completed': self.completed, 'failed': self.failed,
+                'retrying': sorted(self._failures),
+                'bytes_sent': s3upload.TRACKER.sent}
+        tmp = self.status.with_name(self.status.name + '.tmp')
+        tmp.write_text(json.dumps(status, indent=2))
+        os.replace(tmp, self.status)
+
+    def run(self):
+        """Polls until stop is called or the process receives SIGINT or
+        SIGTERM, then waits for uploads in progress and abandons any that
+        haven't started."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+        logger.info(f'Watching {self.directory} for packages')
+        self._executor = ThreadPoolExecutor(self.workers)
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll()
+                except OSError as e:
+                    logger.exception(e)
+                self.write_status()
+                self._stop.wait(self.interval)
+        finally:
+            with self._lock:
+                for future in self._active.values():
+                    future.cancel()
+                cancelled = [
+                    path for path, f in self._active.items() if f.cancelled()]
+                for path in cancelled:
+                    del self._active[path]
+            self.write_status('stopping')
+            self._executor.shutdown(wait=True)
+            s3upload.TRACKER.stop()
+            self.write_status('stopped')
+            logger.info(
+                f'Stopped watching {self.directory}, {self.completed} '
+                f'uploaded, {self.failed} failed')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format=f'%(asctime)s %(levelname)s %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Upload packages to an S3 bucket as they appear in a '
+        'directory')
+    parser.add_argument('directory', help='directory to watch')
+    parser.add_argument('bucket', help='Path to S3 bucket')
+    parser.add_argument(
+        '--workers', '-w', type=int, default=5,
+        help='Packages uploaded at once')
+    parser.add_argument(
+        '--maxsockets', type=int, default=MAX_SOCKETS,
+        help='Cap on connections across all uploads')
+    parser.add_argument(
+        '--endpoint', help='S3 endpoint url, for S3 compatible stores')
+    parser.add_argument(
+        '--journal', '-j',
+        help='Journal of uploads. Defaults to s3_journal.jsonl in directory')
+    parser.add_argument(
+        '--interval', type=float, default=1.0,
+        help='Seconds between scans of the directory')
+    parser.add_argument(
+        '--settle', type=float, default=2.0,
+        help='Seconds a package must be unmodified before upload')
+    parser.add_argument(
+        '--sentinel',
+        help='Only upload a package once a file with this suffix appended '
+        'to its name exists, e.g. .done')
+    parser.add_argument(
+        '--status', help='Path of a JSON status file to keep updated')
+    parser.add_argument(
+        '--deletesource', '-d', action='store_true',
+        help='Delete source packages on successful upload')
+    parser.add_argument(
+        '--checksum', choices=['SHA256', 'CRC32C'],
+        help='S3 checksum sent with each part. Defaults to CRC32C if the '
+        'crc32c package is installed, otherwise SHA256')
+    parser.add_argument(
+        '--logfile', '-l',
+        help='Path to a log file. If omitted, will log to console')
+    args = parser.parse_args()
+    if args.logfile is not None:
+        configlogfile(args.logfile)
+    folder_watcher(
+        args.directory, args.bucket, workers=args.workers,
+        max_sockets=args.maxsockets, endpoint_url=args.endpoint,
+        journal=args.journal, interval=args.interval, settle=args.settle,
+        sentinel=args.sentinel, status=args.status,
+        delete_source=args.deletesource,
+        checksum_algorithm=args.checksum).run()
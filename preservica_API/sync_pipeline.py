@@ -0,0 +1,305 @@
+"""Pipelined version of the meta_update sync. Parsing the EMu export,
+crosswalking to MODS and talking to the API run as three concurrent stages
+joined by bounded queues, so a full sync takes about as long as its slowest
+stage rather than the sum of all three. Full queues block the stage feeding
+them, so a slow API stage throttles parsing rather than filling memory.
+
+python sync_pipeline.py export.xml --processes 4 --apiworkers 8
+"""
+
+
+import io
+import sys
+import time
+import queue
+import argparse
+from threading import Thread, Lock, Semaphore, Event
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from lxml import etree
+from preservica_API import (
+    preservica_session, session_pool, logger, log_to_console)
+from preservica_API import meta_update
+from preservica_API.identifier_index import (
+    identifier_index, resolve_one, DEFAULT_INDEX)
+
+DONE = None
+
+
+class stage_counter(object):
+    """Items processed by a pipeline stage, for throughput reporting."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self._lock = Lock()
+
+    def add(self, n=1, failed=False):
+        with self._lock:
+            if failed:
+                self.failed += n
+            else:
+                self.count += n
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.count / elapsed if elapsed else 0
+
+    def __str__(self):
+        message = f'{self.name} {self.count} ({self.rate():.1f}/s)'
+        if self.failed:
+            message += f' {self.failed} failed'
+        return message
+
+
+def crosswalk(batch):
+    """Process pool task: crosswalks a batch of serialised EMu records,
+    returning (ident, title, mods, title_hash, mods_hash) for each."""
+    results = []
+    for data in batch:
+        record = etree.fromstring(data)
+        ident = record.find('atom[@name="EADUnitID"]').text
+        title = record.find('atom[@name="EADUnitTitle"]').text
+        root = meta_update.build_root(record)
+        results.append((
+            ident, title, etree.tostring(root),
+            meta_update.digest(title or ''),
+            meta_update.digest(meta_update.canonical(root))))
+    return results
+
+
+class sync_pipeline(object):
+    """Runs a sync of xmlfile through parse, crosswalk and API stages.
+    processes sets the size of the crosswalk process pool and api_workers
+    the number of records synced concurrently; queue_size bounds each
+    queue, in batches of batch_size records between the first two stages.
+    Records sharing an identifier update the same objects, so they are
+    synced one at a time."""
+
+    def __init__(self, session, xmlfile, index=None, state=None,
+                 verify=False, dry_run=False, report=sys.stdout,
+                 processes=None, api_workers=8, batch_size=50, queue_size=16,
+                 interval=10, refresh=False, max_age=None):
+        self.session = session
+        self.xmlfile = xmlfile
+        self.index = index
+        self.refresh = refresh
+        self.max_age = max_age
+        self.state = state
+        self.verify = verify
+        self.dry_run = dry_run
+        self.report = report
+        self.processes = processes
+        self.api_workers = api_workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.records = queue.Queue(queue_size)
+        self.crosswalks = queue.Queue(queue_size)
+        self.mods = queue.Queue(queue_size * batch_size)
+        self.parsed = stage_counter('parsed')
+        self.crosswalked = stage_counter('crosswalked')
+        self.unchanged = stage_counter('unchanged')
+        self.synced = stage_counter('synced')
+        self.writes = 0
+        self._lock = Lock()
+        self._report_lock = Lock()
+        self._idents = {}  # ident: [lock, records waiting or syncing]
+        self._error = None
+
+    def status(self):
+        return (
+            f'{self.parsed}, {self.crosswalked}, {self.unchanged}, '
+            f'{self.synced}; queued {self.records.qsize()} batches, '
+            f'{self.mods.qsize()} records')
+
+    def _failed(self, e):
+        """Records the first error that stopped a stage, for run to raise."""
+        with self._lock:
+            if self._error is None:
+                self._error = e
+
+    def _parse(self):
+        batch = []
+        try:
+            for record in meta_update.iter_records(self.xmlfile):
+                batch.append(etree.tostring(record))
+                if len(batch) == self.batch_size:
+                    self.records.put(batch)
+                    self.parsed.add(len(batch))
+                    batch = []
+            if batch:
+                self.records.put(batch)
+                self.parsed.add(len(batch))
+        except Exception as e:
+            self._failed(e)
+            raise
+        finally:
+            self.records.put(DONE)
+
+    def _submit(self, ex):
+        """Feeds batches to the process pool in order. The crosswalks queue
+        of pending futures is bounded, which caps the work in flight."""
+        try:
+            while True:
+                batch = self.records.get()
+                if batch is DONE:
+                    break
+                self.crosswalks.put((len(batch), ex.submit(crosswalk, batch)))
+        except Exception as e:
+            self._failed(e)
+            raise
+        finally:
+            self.crosswalks.put(DONE)
+
+    def _collect(self):
+        while True:
+            item = self.crosswalks.get()
+            if item is DONE:
+                break
+            size, future = item
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.exception(e)
+                self.crosswalked.add(size, failed=True)
+                continue
+            self.crosswalked.add(len(results))
+            for result in results:
+                self.mods.put(result)
+        self.mods.put(DONE)
+
+    def _claim(self, ident):
+        """Registers a record for ident, returning the lock that serialises
+        syncs of that identifier. The lock is dropped once no record for
+        ident is waiting or syncing."""
+        with self._lock:
+            claim = self._idents.setdefault(ident, [Lock(), 0])
+            claim[1] += 1
+            return claim[0]
+
+    def _release(self, ident):
+        with self._lock:
+            claim = self._idents[ident]
+            claim[1] -= 1
+            if not claim[1]:
+                del self._idents[ident]
+
+    def _sync(self, pool, item, ident_lock):
+        ident, title, mods, title_hash, mods_hash = item
+        report = io.StringIO()
+        try:
+            with ident_lock, pool.acquire() as session:
+                ident, objects = resolve_one(
+                    session, ident, index=self.index, refresh=self.refresh,
+                    max_age=self.max_age)
+                writes = meta_update.sync_record(
+                    session, ident, title, etree.fromstring(mods), objects,
+                    state=self.state, verify=self.verify,
+                    dry_run=self.dry_run, report=report)
+        finally:
+            self._release(item[0])
+            # a record's report lines are written together
+            if report.tell():
+                with self._report_lock:
+                    self.report.write(report.getvalue())
+        with self._lock:
+            self.writes += writes
+
+    def _done(self, slots, future):
+        slots.release()
+        try:
+            future.result()
+            self.synced.add()
+        except Exception as e:
+            logger.exception(e)
+            self.synced.add(failed=True)
+
+    def _report(self, stop):
+        while not stop.wait(self.interval):
+            logger.info(self.status())
+
+    def run(self):
+        """Runs the sync to completion, returning the number of writes
+        made (or that would be made, in a dry run). If parsing or handing
+        records to the crosswalk pool failed, the records already queued
+        are synced and the error is then raised."""
+        stop = Event()
+        threads = [
+            Thread(target=self._parse, daemon=True),
+            Thread(target=self._collect, daemon=True),
+            Thread(target=self._report, args=(stop,), daemon=True)]
+        slots = Semaphore(self.api_workers * 2)
+        with ProcessPoolExecutor(self.processes) as procs, \
+                session_pool(self.session, self.api_workers) as pool, \
+                ThreadPoolExecutor(self.api_workers) as api:
+            submitter = Thread(target=self._submit, args=(procs,), daemon=True)
+            threads.append(submitter)
+            for t in threads:
+                t.start()
+            while True:
+                item = self.mods.get()
+                if item is DONE:
+                    break
+                ident, _, _, title_hash, mods_hash = item
+                if self.state is not None and not self.verify and \
+                        self.state.unchanged(ident, title_hash, mods_hash):
+                    self.unchanged.add()
+                    continue
+                slots.acquire()
+                f = api.submit(self._sync, pool, item, self._claim(ident))
+                f.add_done_callback(lambda f: self._done(slots, f))
+        stop.set()
+        logger.info(self.status())
+        if self._error is not None:
+            raise self._error
+        return self.writes
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='Synchronise metadata from an EMu XML export to '
+        'Preservica, parsing, crosswalking and updating concurrently')
+    parser.add_argument('xmlfile', help='EMu xml for preservica report')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--index', default=str(DEFAULT_INDEX),
+        help='local identifier index, reused between runs')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='look up every identifier with the API and update the index')
+    parser.add_argument(
+        '--maxage', type=float,
+        help='look up identifiers indexed more than this many days ago')
+    parser.add_argument(
+        '--state', default=str(meta_update.DEFAULT_STATE),
+        help='local record of what was last synced, for skipping no-op writes')
+    parser.add_argument(
+        '--nostate', action='store_true',
+        help='compare every record with Preservica rather than the state')
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='compare MODS with the fragment in Preservica before writing')
+    parser.add_argument(
+        '--dryrun', action='store_true',
+        help='report what would change without writing anything')
+    parser.add_argument(
+        '--processes', type=int, help='crosswalk processes, defaults to CPUs')
+    parser.add_argument(
+        '--apiworkers', type=int, default=8,
+        help='number of records synced concurrently')
+    args = parser.parse_args()
+    index = identifier_index(args.index)
+    state = None if args.nostate else meta_update.sync_state(args.state)
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        writes = sync_pipeline(
+            sesh, args.xmlfile, index=index, state=state, verify=args.verify,
+            dry_run=args.dryrun, processes=args.processes,
+            api_workers=args.apiworkers, refresh=args.refresh,
+            max_age=None if args.maxage is None else
+            args.maxage * meta_update.DAY).run()
+    print(f'{writes} changes sent' if not args.dryrun else
+          f'Dry run, {writes} changes would be sent')
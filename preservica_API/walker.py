@@ -0,0 +1,147 @@
+"""Breadth-first traversal of a Preservica hierarchy. Children are listed
+concurrently and yielded as soon as they arrive, so walks over large
+collections never need the whole tree in memory. Progress can be
+checkpointed to a file so an interrupted walk resumes where it stopped."""
+
+
+import os
+import sys
+import json
+import pathlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from preservica_API import (
+    preservica_session, logger, log_to_console, TYPE_MAP)
+
+CHECKPOINT_EVERY = 100
+
+
+def _load_checkpoint(checkpoint):
+    with open(checkpoint) as f:
+        state = json.load(f)
+    logger.info(
+        f"Resuming walk from {checkpoint}, {len(state['pending'])} "
+        "folder(s) outstanding")
+    return deque(tuple(p) for p in state['pending']), state['seen']
+
+
+def _save_checkpoint(checkpoint, pending, seen):
+    tmp = pathlib.Path(str(checkpoint)+'.tmp')
+    with tmp.open('w') as f:
+        json.dump({'pending': [list(p) for p in pending], 'seen': seen}, f)
+    os.replace(tmp, checkpoint)
+
+
+def _fetch(session, child):
+    """The entity for a child dict, keeping its depth, or None."""
+    entity = session.get_object(child['uri'])
+    if entity is None:
+        logger.warning(f"Skipping {child['type']} {child['ref']}, not found")
+        return None
+    entity.depth = child['depth']
+    return entity
+
+
+def _list(session, uri, depth, types, fetch, max_depth=None):
+    """Lists the children of the folder at uri, and the content objects of
+    any assets among them if CO is in types. Returns the matching children
+    and the folders to descend into."""
+    found = []
+    folders = []
+    assets = []
+    for child in session.iter_children(uri+'/children'):
+        child['depth'] = depth
+        if child['type'] == 'SO':
+            folders.append(child['uri'])
+        elif child['type'] == 'IO':
+            assets.append(child['uri'])
+        if child['type'] in types:
+            found.append(child)
+    if 'CO' in types and (max_depth is None or depth < max_depth):
+        for asset in assets:
+            for child in session.iter_content_objects(asset):
+                child['depth'] = depth + 1
+                found.append(child)
+    if fetch:
+        found = [_fetch(session, child) for child in found]
+        found = [child for child in found if child is not None]
+    return found, folders
+
+
+def walk(session, ref, types=('SO', 'IO', 'CO'), max_depth=None, workers=4,
+         checkpoint=None, fetch=False):
+    """Generator yielding the descendants of the folder at ref, breadth
+    first. types limits what is yielded (folders are still descended into),
+    max_depth limits how far below ref the walk goes. Content objects are
+    listed from the representations of each asset, one level below it, and
+    only if CO is in types. By default children are yielded as dicts of
+    ref, type, title, uri and depth; with fetch=True the full entity is
+    retrieved for each instead, with its depth, and any that can't be
+    retrieved are skipped. If checkpoint is a file
+    path the outstanding folders are saved there as the walk progresses and
+    an existing checkpoint is resumed from. Children of folders in flight
+    when a walk is interrupted may be yielded again on resume."""
+    for t in types:
+        if t not in TYPE_MAP:
+            raise ValueError(f'Unknown entity type: {t}')
+    if checkpoint is not None and os.path.exists(checkpoint):
+        pending, seen = _load_checkpoint(checkpoint)
+    else:
+        pending = deque([(session.make_uri(ref, TYPE_MAP['SO']), 1)])
+        seen = 0
+    running = {}
+    completed = 0
+    saved = 0
+    with ThreadPoolExecutor(workers) as ex:
+        while pending or running:
+            while pending and len(running) < workers:
+                uri, depth = pending.popleft()
+                f = ex.submit(
+                    _list, session, uri, depth, types, fetch, max_depth)
+                running[f] = (uri, depth)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                uri, depth = running.pop(f)
+                found, folders = f.result()
+                if max_depth is None or depth < max_depth:
+                    pending.extend((folder, depth+1) for folder in folders)
+                for child in found:
+                    seen += 1
+                    yield child
+                completed += 1
+            if checkpoint is not None and completed - saved >= CHECKPOINT_EVERY:
+                saved = completed
+                _save_checkpoint(
+                    checkpoint, list(running.values()) + list(pending), seen)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    logger.info(f'Walk of {ref} complete, {seen} entities found')
+
+
+if __name__ == '__main__':
+    log_to_console()
+    parser = argparse.ArgumentParser(
+        description='List everything beneath a Preservica folder')
+    parser.add_argument('ref', help='ref of the folder to start from')
+    parser.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    parser.add_argument(
+        '--types', nargs='+', default=['SO', 'IO', 'CO'],
+        choices=list(TYPE_MAP), help='entity types to list')
+    parser.add_argument(
+        '--depth', type=int, help='maximum depth below the folder')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='number of folders listed concurrently')
+    parser.add_argument(
+        '--checkpoint', help='file for saving and resuming progress')
+    args = parser.parse_args()
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        for child in walk(
+                sesh, args.ref, types=args.types, max_depth=args.depth,
+                workers=args.workers, checkpoint=args.checkpoint):
+            sys.stdout.write(
+                f"{child['depth']}\t{child['type']}\t{child['ref']}\t"
+                f"{child['title']}\n")
@@ -0,0 +1,33 @@
+"""Tools for building Preservica V6 SIPs and working with the API.
+
+The names below are imported from xip_builder and preservica_API the
+first time they are used, so importing pyservica (and running the
+pyservica command) doesn't load lxml, requests or boto3 until a command
+needs them.
+"""
+
+
+import importlib
+
+_EXPORTS = {
+    'Sip': 'xip_builder',
+    'log_to_console': 'xip_builder',
+    'preservica_session': 'preservica_API',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    try:
+        module = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(
+            f'module {__name__!r} has no attribute {name!r}') from None
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,4 @@
+import sys
+from pyservica.cli import main
+
+sys.exit(main())
@@ -0,0 +1,320 @@
+"""The pyservica command. Each subcommand imports the modules it uses when
+it runs, so the command starts quickly and only loads lxml, requests or
+boto3 on the paths that need them.
+
+pyservica build <directory> <outdir> --parent <ref>
+pyservica verify <sip>...
+pyservica upload <package or directory> <parentref>
+pyservica s3upload <package or directory> <bucket>
+pyservica sync <export.xml>
+pyservica export <export.xml> <outdir>
+pyservica ingest <outdir> <directory>... --bucket <bucket>
+"""
+
+
+import os
+import sys
+import logging
+import argparse
+
+FORMAT = '%(asctime)-15s [%(levelname)s] %(message)s'
+
+
+def build(args):
+    import xip_builder
+    xip_builder.main(
+        os.path.abspath(args.indir), os.path.abspath(args.out),
+        parent=args.parent, security=args.security,
+        identifier=args.identifier, manifest=args.manifest,
+        namespace=args.namespace)
+
+
+def verify(args):
+    from xip_builder import Sip
+    failed = 0
+    for path in args.sips:
+        with Sip(path, mode='r') as sip:
+            problems = sip.verify()
+        for name, problem in problems:
+            print(f'{path}: {name}: {problem}')
+        if problems:
+            failed += 1
+        else:
+            print(f'{path}: OK')
+    return 1 if failed else 0
+
+
+def upload(args):
+    from preservica_API import preservica_session
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        if os.path.isdir(args.path):
+            from preservica_API.bulk_upload import bulk_upload
+            failed = bulk_upload(
+                sesh, args.path, args.parentref, workers=args.workers,
+                journal=args.journal, delete_source=args.deletesource)
+            return 1 if failed else 0
+        response = sesh.upload_package(args.path, args.parentref)
+        return 0 if response is not None and response.ok else 1
+
+
+def s3upload(args):
+    from preservica_API import s3upload
+    if os.path.isdir(args.path):
+        s3upload.bulks3upload(
+            args.path, args.bucket, delete_source=args.deletesource,
+            workers=args.workers, max_sockets=args.maxsockets,
+            endpoint_url=args.endpoint, journal=args.journal,
+            largest_first=args.largestfirst, checksum_algorithm=args.checksum)
+    else:
+        client = s3upload.get_client(
+            args.bucket, max_sockets=args.maxsockets,
+            endpoint_url=args.endpoint)
+        s3upload.S3upload(
+            args.path, args.bucket, delete_source=args.deletesource,
+            client=client, max_concurrency=args.maxsockets,
+            journal=args.journal, checksum_algorithm=args.checksum)
+        s3upload.TRACKER.stop()
+    return 1 if s3upload.TRACKER.failed else 0
+
+
+def sync(args):
+    from preservica_API import preservica_session, meta_update
+    from preservica_API.identifier_index import identifier_index
+    index = None if args.noindex else identifier_index(args.index)
+    state = None if args.nostate else meta_update.sync_state(args.state)
+    max_age = None if args.maxage is None else args.maxage * meta_update.DAY
+    with preservica_session.get_session(profile=args.profile) as sesh:
+        if args.metrics is not None:
+            sesh.enable_metrics()
+        if args.processes is None:
+            meta_update.main(
+                args.xmlfile, sesh, index=index, workers=args.workers,
+                state=state, verify=args.verify, dry_run=args.dryrun,
+                refresh=args.refresh, max_age=max_age)
+        else:
+            from preservica_API.sync_pipeline import sync_pipeline
+            writes = sync_pipeline(
+                sesh, args.xmlfile, index=index, state=state,
+                verify=args.verify, dry_run=args.dryrun,
+                processes=args.processes or None,
+                api_workers=args.workers, refresh=args.refresh,
+                max_age=max_age).run()
+            print(f'{writes} changes sent' if not args.dryrun else
+                  f'Dry run, {writes} changes would be sent')
+        if args.metrics is not None:
+            sesh.metrics.write(args.metrics)
+
+
+def export(args):
+    from preservica_API import meta_export
+    meta_export.main(
+        args.xmlfile, args.outdir, processes=args.processes or None,
+        bundle=args.bundle, name=args.name)
+
+
+def ingest(args):
+    from pyservica.ingest import ingest, s3_uploader, api_uploader, GB
+    if (args.bucket is None) == (args.parentref is None):
+        sys.exit('pyservica ingest: give one of --bucket or --parentref')
+    try:
+        job = ingest(
+            args.sources, args.outdir, None, build_workers=args.buildworkers,
+            upload_workers=args.uploadworkers,
+            min_free=int(args.minfree * GB), parent=args.parent,
+            security=args.security, namespace=args.namespace)
+    except ValueError as e:
+        sys.exit(f'pyservica ingest: {e}')
+    if args.bucket is not None:
+        from preservica_API import s3upload
+        job.upload = s3_uploader(
+            args.bucket, endpoint_url=args.endpoint, journal=args.journal,
+            workers=args.uploadworkers, delete_source=not args.keep)
+        failed = job.run()
+        s3upload.TRACKER.stop()
+    else:
+        from preservica_API import preservica_session, session_pool
+        with preservica_session.get_session(profile=args.profile) as sesh, \
+                session_pool(sesh, args.uploadworkers) as pool:
+            job.upload = api_uploader(
+                pool, args.parentref, delete_source=not args.keep)
+            failed = job.run()
+    for source in failed:
+        print(f'Failed: {source}')
+    return 1 if failed else 0
+
+
+def _home(*parts):
+    return os.path.join(os.path.expanduser('~'), '.preservica', *parts)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='pyservica',
+        description='Build, check and upload Preservica SIPs and sync '
+        'metadata with Preservica')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    p = commands.add_parser('build', help='build a SIP from a directory')
+    p.add_argument('indir', help='base directory for a SIP')
+    p.add_argument('out', help='directory for output of SIP')
+    p.add_argument('--parent', help='parent folder ref in Preservica for SIP')
+    p.add_argument('--security', default='open', help='security tag')
+    p.add_argument(
+        '--identifier', help='identifier to be appended to top folder')
+    p.add_argument(
+        '--manifest',
+        help='build manifest; if it exists, only new and changed files are '
+        'included in the SIP')
+    p.add_argument(
+        '--namespace',
+        help='build a reproducible SIP, with refs derived from this UUID or '
+        'name and timestamps from SOURCE_DATE_EPOCH')
+    p.set_defaults(func=build)
+
+    p = commands.add_parser(
+        'verify', help='check SIP contents against their XIP fixities')
+    p.add_argument('sips', nargs='+', help='SIPs to check')
+    p.set_defaults(func=verify)
+
+    p = commands.add_parser(
+        'upload', help='upload a package, or a directory of them, via the API')
+    p.add_argument('path', help='package or directory of packages')
+    p.add_argument('parentref', help='ref of target folder')
+    p.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    p.add_argument(
+        '--workers', type=int, default=4, help='concurrent uploads')
+    p.add_argument(
+        '--journal', help='path to journal of completed uploads')
+    p.add_argument(
+        '--deletesource', '-d', action='store_true',
+        help='Delete source packages on successful upload')
+    p.set_defaults(func=upload)
+
+    p = commands.add_parser(
+        's3upload', help='upload a package, or a directory of them, to S3')
+    p.add_argument('path', help='package or directory of packages')
+    p.add_argument('bucket', help='Path to S3 bucket')
+    p.add_argument(
+        '--workers', '-w', type=int, default=5,
+        help='Packages uploaded at once from a directory')
+    p.add_argument(
+        '--maxsockets', type=int, default=20,
+        help='Cap on connections across all uploads')
+    p.add_argument(
+        '--endpoint', help='S3 endpoint url, for S3 compatible stores')
+    p.add_argument(
+        '--journal', '-j',
+        help='Journal of uploads, used to skip or resume packages. Defaults '
+        'to s3_journal.jsonl in the directory')
+    p.add_argument(
+        '--largestfirst', action='store_true',
+        help='Upload the largest packages first')
+    p.add_argument(
+        '--checksum', choices=['SHA256', 'CRC32C'],
+        help='S3 checksum sent with each part')
+    p.add_argument(
+        '--deletesource', '-d', action='store_true',
+        help='Delete source packages on successful upload')
+    p.set_defaults(func=s3upload)
+
+    p = commands.add_parser(
+        'sync', help='synchronise metadata from an EMu XML export')
+    p.add_argument('xmlfile', help='EMu xml for preservica report')
+    p.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    p.add_argument(
+        '--index', default=_home('identifiers.db'),
+        help='local identifier index, reused between runs')
+    p.add_argument(
+        '--noindex', action='store_true',
+        help='look up every identifier with the API')
+    p.add_argument(
+        '--refresh', action='store_true',
+        help='look up every identifier with the API and update the index')
+    p.add_argument(
+        '--maxage', type=float,
+        help='look up identifiers indexed more than this many days ago')
+    p.add_argument(
+        '--state', default=_home('sync_state.db'),
+        help='local record of what was last synced, for skipping no-op writes')
+    p.add_argument(
+        '--nostate', action='store_true',
+        help='compare every record with Preservica rather than the state')
+    p.add_argument(
+        '--workers', type=int, default=8,
+        help='number of records synced concurrently')
+    p.add_argument(
+        '--processes', type=int,
+        help='run as a pipeline with this many crosswalk processes, 0 for '
+        'one per CPU')
+    p.add_argument(
+        '--verify', action='store_true',
+        help='compare MODS with the fragment in Preservica before writing')
+    p.add_argument(
+        '--dryrun', action='store_true',
+        help='report what would change without writing anything')
+    p.add_argument(
+        '--metrics',
+        help='write request metrics here at the end, as JSON if the name '
+        'ends in .json, otherwise in Prometheus text format')
+    p.set_defaults(func=sync)
+
+    p = commands.add_parser(
+        'export', help='export MODS records from an EMu XML export')
+    p.add_argument('xmlfile', help='EMu xml for preservica report')
+    p.add_argument('outdir', help='directory for MODS files')
+    p.add_argument(
+        '--processes', '-p', type=int, default=1,
+        help='crosswalk processes, 0 for one per CPU')
+    p.add_argument(
+        '--bundle', choices=['zip', 'tar', 'jsonl'],
+        help='write a single bundle instead of a file per record')
+    p.add_argument(
+        '--name', default='mods', help='file name for the bundle')
+    p.set_defaults(func=export)
+
+    p = commands.add_parser(
+        'ingest', help='build and upload SIPs for many directories at once')
+    p.add_argument('outdir', help='scratch directory for SIPs')
+    p.add_argument('sources', nargs='+', help='directories to build SIPs of')
+    p.add_argument('--bucket', help='upload SIPs to this S3 bucket')
+    p.add_argument(
+        '--parentref', help='or upload via the API to this folder ref')
+    p.add_argument('--parent', help='parent folder ref in Preservica for SIPs')
+    p.add_argument('--security', default='open', help='security tag')
+    p.add_argument(
+        '--profile', default='DEFAULT',
+        help='loads session from config file with specified profile')
+    p.add_argument(
+        '--endpoint', help='S3 endpoint url, for S3 compatible stores')
+    p.add_argument('--journal', '-j', help='Journal of S3 uploads')
+    p.add_argument(
+        '--buildworkers', type=int,
+        help='SIPs built at once, defaults to one per CPU')
+    p.add_argument(
+        '--uploadworkers', type=int, default=4, help='SIPs uploaded at once')
+    p.add_argument(
+        '--minfree', type=float, default=5,
+        help='gb of free space to keep in outdir')
+    p.add_argument(
+        '--namespace',
+        help='build reproducible SIPs, with refs derived from this UUID or '
+        'name and timestamps from SOURCE_DATE_EPOCH')
+    p.add_argument(
+        '--keep', action='store_true', help='keep SIPs after upload')
+    p.set_defaults(func=ingest)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(format=FORMAT)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""Builds and uploads SIPs for many source directories at once. SIPs are
+built in a process pool and uploaded from a thread pool as each one is
+finished, so building, disk and network work overlap and a campaign takes
+about as long as its slowest stage. Builds are held back while free space
+in the output directory would drop below a floor, so a slow upload stage
+throttles building rather than filling the disk.
+
+pyservica ingest <outdir> <source>... --bucket <bucket>
+"""
+
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import pathlib
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED)
+
+logger = logging.getLogger('siplog')
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+
+def tree_size(directory):
+    """Total size of the files under directory, as an upper bound on the
+    size of the SIP built from it."""
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            try:
+                size += os.stat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def sip_path(source, outdir):
+    return pathlib.Path(outdir) / (pathlib.Path(source).name + '.zip')
+
+
+def _build(source, outdir, parent, security, namespace):
+    """Process pool task: builds the SIP for source, returning its path, or
+    None if nothing was built."""
+    import xip_builder
+    path = xip_builder.main(
+        source, outdir, parent=parent, security=security,
+        namespace=namespace)
+    return None if path is None else str(path)
+
+
+def s3_uploader(bucket, endpoint_url=None, journal=None, max_sockets=20,
+                workers=4, delete_source=True):
+    """Returns a function that uploads a SIP to an S3 bucket, for ingest."""
+    from preservica_API import s3upload
+    client = s3upload.get_client(
+        bucket, max_sockets=max_sockets, endpoint_url=endpoint_url)
+    if journal is not None:
+        journal = s3upload.S3journal(journal)
+
+    def upload(path):
+        return s3upload.S3upload(
+            path, bucket, delete_source=delete_source, client=client,
+            max_concurrency=max(1, max_sockets // workers),
+            journal=journal) is not None
+    return upload
+
+
+def api_uploader(pool, parentref, delete_source=True):
+    """Returns a function that uploads a SIP via the API with a session
+    from pool (a preservica_API.session_pool), for ingest."""
+
+    def _upload(session, path):
+        response = session.upload_package(path, parentref)
+        return response is not None and response.ok
+
+    def upload(path):
+        ok = pool.call(_upload, path)
+        if ok and delete_source:
+            os.remove(path)
+        return ok
+    return upload
+
+
+class stage(object):
+    """Count, bytes and throughput of one stage of an ingest."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.failed = 0
+        self.start = time.monotonic()
+
+    def add(self, size):
+        self.count += 1
+        self.bytes += size
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.bytes / elapsed / MB if elapsed else 0
+        message = (
+            f'{self.name} {self.count} '
+            f'({self.bytes / MB:.1f}mb, {rate:.1f}mb/s)')
+        if self.failed:
+            message += f' {self.failed} failed'
+        return message
+
+
+class ingest(object):
+    """Builds a SIP for each of sources in outdir with build_workers
+    processes (one per CPU by default) and passes each to upload, a
+    function taking the SIP path and returning True on success, with
+    upload_workers threads. Each SIP is named after its source directory,
+    so sources must have distinct names. SIPs are built in a scratch
+    directory in outdir, so nothing already in outdir is overwritten or
+    removed; SIPs left after their upload (kept, or failed) are moved into
+    outdir at the end of the run. A build only starts if the free space in
+    outdir, less the source size of the builds in progress and of the new
+    one, stays above min_free bytes. With a namespace, SIPs are built
+    reproducibly (see xip_builder.Sip)."""
+
+    def __init__(self, sources, outdir, upload, build_workers=None,
+                 upload_workers=4, min_free=5 * GB, parent=None,
+                 security='open', interval=10, namespace=None):
+        self.sources = deque(os.path.abspath(source) for source in sources)
+        self.outdir = os.path.abspath(outdir)
+        names = {}
+        for source in self.sources:
+            name = os.path.basename(source)
+            if name in names:
+                raise ValueError(
+                    f'{source} and {names[name]} would both be built as '
+                    f'{name}.zip')
+            names[name] = source
+        self.upload = upload
+        self.build_workers = build_workers or os.cpu_count() or 1
+        self.upload_workers = upload_workers
+        self.min_free = min_free
+        self.parent = parent
+        self.security = security
+        self.namespace = namespace
+        self.interval = interval
+        self.built = stage('built')
+        self.uploaded = stage('uploaded')
+        self.failed = []
+        self._reserved = 0
+        self._waiting = False
+        self._workdir = None
+
+    def _room_for(self, size):
+        free = shutil.disk_usage(self.outdir).free - self._reserved
+        return free - size >= self.min_free
+
+    def status(self, building, uploading):
+        free = shutil.disk_usage(self.outdir).free
+        return (
+            f'{self.built}, {self.uploaded}; building {building}, '
+            f'uploading {uploading}, {len(self.sources)} waiting, '
+            f'{free / GB:.1f}gb free')
+
+    def _start_builds(self, ex, building):
+        while self.sources and len(building) < self.build_workers:
+            size = tree_size(self.sources[0])
+            if not self._room_for(size):
+                if not self._waiting:
+                    logger.info(
+                        f'Waiting for space to build {self.sources[0]}')
+                self._waiting = True
+                return
+            self._waiting = False
+            source = self.sources.popleft()
+            self._reserved += size
+            future = ex.submit(
+                _build, source, self._workdir, self.parent, self.security,
+                self.namespace)
+            building[future] = (source, size)
+
+    def run(self):
+        """Runs the ingest to completion, returning the sources whose SIP
+        failed to build or upload."""
+        os.makedirs(self.outdir, exist_ok=True)
+        self._workdir = tempfile.mkdtemp(prefix='.building-', dir=self.outdir)
+        try:
+            self._run()
+        finally:
+            self._finish()
+        return self.failed
+
+    def _finish(self):
+        """Moves the SIPs left in the scratch directory into outdir, unless
+        that would replace a file, and removes the scratch directory once
+        it is empty."""
+        for path in pathlib.Path(self._workdir).iterdir():
+            target = pathlib.Path(self.outdir, path.name)
+            if target.exists():
+                logger.warning(f'{target} exists, leaving the new SIP in {path}')
+                continue
+            os.replace(path, target)
+        try:
+            os.rmdir(self._workdir)
+        except OSError:
+            pass
+
+    def _run(self):
+        building = {}
+        uploading = {}
+        last_report = time.monotonic()
+        with ProcessPoolExecutor(self.build_workers) as builders, \
+                ThreadPoolExecutor(self.upload_workers) as uploaders:
+            while self.sources or building or uploading:
+                self._start_builds(builders, building)
+                if not building and not uploading:
+                    if self.sources:
+                        # nothing in flight will free space for it
+                        source = self.sources.popleft()
+                        logger.error(f'Not enough space to build {source}')
+                        self.built.failed += 1
+                        self.failed.append(source)
+                    continue
+                done, _ = wait(
+                    list(building) + list(uploading), timeout=self.interval,
+                    return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in building:
+                        source, size = building.pop(future)
+                        self._reserved -= size
+                        try:
+                            path = future.result()
+                            if path is None:
+                                raise ValueError(f'No SIP built for {source}')
+                            sip_size = os.path.getsize(path)
+                        except Exception as e:
+                            logger.exception(e)
+                            self.built.failed += 1
+                            self.failed.append(source)
+                            # don't keep a partly written SIP
+                            partial = sip_path(source, self._workdir)
+                            if partial.exists():
+                                partial.unlink()
+                            continue
+                        self.built.add(sip_size)
+                        uploading[uploaders.submit(self.upload, path)] = (
+                            source, sip_size)
+                    else:
+                        source, size = uploading.pop(future)
+                        try:
+                            ok = future.result()
+                        except Exception as e:
+                            logger.exception(e)
+                            ok = False
+                        if ok:
+                            self.uploaded.add(size)
+                        else:
+                            self.uploaded.failed += 1
+                            self.failed.append(source)
+                if time.monotonic() - last_report >= self.interval:
+                    logger.info(self.status(len(building), len(uploading)))
+                    last_report = time.monotonic()
+        logger.info(self.status(0, 0))
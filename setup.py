@@ -19,5 +19,8 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
+    entry_points={
+        'console_scripts': ['pyservica=pyservica.cli:main'],
+    },
 )
@@ -2,7 +2,7 @@ import argparse
 import os
 import pathlib
 from PIL import Image
-from pyservica import Sip
+from pyservica import Sip, log_to_console
 Image.MAX_IMAGE_PIXELS = None
 
 
@@ -41,6 +41,7 @@ def iter_folders(parent_dir, outdir, target):
                 build_asset(sippath, i_path, target, ident)
 
 if __name__ == '__main__':
+    log_to_console()
     parser = argparse.ArgumentParser(
         description='Simple script for creating multipart assets with PDF'
         'access copies from the UMA digital asset storage')
@@ -0,0 +1,65 @@
+import csv
+import pytest
+from preservica_API import preservica_session
+from preservica_API.batch_update import read_changes, batch_update
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+def changes_file(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, ['ref', 'tag', 'value'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return path
+
+
+def test_checkpointed_refs_are_skipped(server, session, tmp_path):
+    refs = [server.add_entity('IO', f'Asset {n}') for n in range(3)]
+    missing = 'not-a-ref'
+    path = changes_file(tmp_path / 'changes.csv', [
+        {'ref': refs[0], 'tag': 'Title', 'value': 'New 0'},
+        {'ref': refs[1], 'tag': 'Title', 'value': 'Asset 1'},
+        {'ref': refs[2], 'tag': 'SecurityTag', 'value': 'closed'},
+        {'ref': missing, 'tag': 'Title', 'value': 'New'}])
+    checkpoint = tmp_path / 'done.txt'
+    report = tmp_path / 'report.csv'
+    results = batch_update(
+        session, read_changes(path), checkpoint_file=checkpoint,
+        report=report)
+    statuses = {r['ref']: r['status'] for r in results}
+    assert statuses == {
+        refs[0]: 'updated', refs[1]: 'unchanged', refs[2]: 'updated',
+        missing: 'missing'}
+    assert server.entities[refs[0]]['title'] == 'New 0'
+    assert server.entities[refs[2]]['security'] == 'closed'
+    assert set(checkpoint.read_text().split()) == set(refs)
+    # only the entity that wasn't done is tried again
+    results = batch_update(
+        session, read_changes(path), checkpoint_file=checkpoint,
+        report=report)
+    assert [r['ref'] for r in results] == [missing]
+    with open(report) as f:
+        assert len(list(csv.DictReader(f))) == 5
+
+
+def test_dry_run_changes_nothing(server, session, tmp_path):
+    ref = server.add_entity('IO', 'Asset')
+    path = changes_file(tmp_path / 'changes.csv', [
+        {'ref': ref, 'tag': 'Title', 'value': 'New'}])
+    results = batch_update(session, read_changes(path), dry_run=True)
+    assert results[0]['status'] == 'would update'
+    assert server.entities[ref]['title'] == 'Asset'
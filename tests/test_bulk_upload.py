@@ -0,0 +1,56 @@
+import pytest
+from preservica_API import preservica_session
+from preservica_API.bulk_upload import bulk_upload
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+def packages(directory, count):
+    for n in range(count):
+        (directory / f'{n}.zip').write_bytes(b'x' * (n + 1) * 1000)
+
+
+def test_rerun_uploads_only_outstanding_packages(
+        server, session, tmp_path, monkeypatch):
+    target = server.add_entity('SO', 'Target')
+    packages(tmp_path, 6)
+    upload_package = preservica_session.upload_package
+
+    def interrupted(self, fpath, targeturi, progress=None):
+        if fpath.name in ('1.zip', '4.zip'):
+            raise ConnectionError('connection reset')
+        if fpath.name == '2.zip':
+            return None
+        return upload_package(self, fpath, targeturi, progress=progress)
+    with monkeypatch.context() as m:
+        m.setattr(preservica_session, 'upload_package', interrupted)
+        failed = bulk_upload(session, tmp_path, target, workers=3)
+    assert sorted(f.name for f in failed) == ['1.zip', '2.zip', '4.zip']
+    assert len(server.uploads) == 3
+    assert bulk_upload(session, tmp_path, target, workers=3) == []
+    assert sorted(name for _, name, _ in server.uploads) == [
+        f'{n}.zip' for n in range(6)]
+    assert bulk_upload(session, tmp_path, target) == []
+    assert len(server.uploads) == 6
+
+
+def test_rebuilt_package_is_uploaded_again(server, session, tmp_path):
+    target = server.add_entity('SO', 'Target')
+    packages(tmp_path, 1)
+    bulk_upload(session, tmp_path, target)
+    (tmp_path / '0.zip').write_bytes(b'rebuilt')
+    bulk_upload(session, tmp_path, target)
+    assert [size for _, _, size in server.uploads] == [1000, 7]
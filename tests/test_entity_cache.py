@@ -0,0 +1,106 @@
+import threading
+import pytest
+from preservica_API import preservica_session, entity_cache, entity
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def connect(server, cache):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', cache=cache, protocol='http')
+
+
+def test_expired_entries_are_revalidated(server):
+    ref = server.add_entity('IO', 'Asset')
+    cache = entity_cache(ttl=0)
+    session = connect(server, cache)
+    assert session.get_object(server.url(ref)).title == 'Asset'
+    assert session.get_object(server.url(ref)).title == 'Asset'
+    assert cache.stats()['revalidated'] == 1
+    server.entities[ref]['title'] = 'Renamed'
+    server.entities[ref]['version'] += 1
+    assert session.get_object(server.url(ref)).title == 'Renamed'
+    assert cache.stats()['revalidated'] == 1
+
+
+def test_disk_tier_survives_a_new_session(server, tmp_path):
+    ref = server.add_entity('IO', 'Asset')
+    first = connect(server, entity_cache(cache_dir=tmp_path))
+    first.get_object(server.url(ref))
+    cache = entity_cache(cache_dir=tmp_path)
+    requests = server.requests
+    second = connect(server, cache)
+    assert second.get_object(server.url(ref)).title == 'Asset'
+    assert cache.stats()['hits'] == 1
+    # only the token request, the entity came from disk
+    assert server.requests - requests <= 1
+
+
+def test_invalidate_drops_fragments_on_disk(tmp_path):
+    cache = entity_cache(cache_dir=tmp_path)
+    uri = 'https://host/api/entity/information-objects/ref'
+
+    class response(object):
+        content = b'<x/>'
+        headers = {}
+    cache.store(uri, response)
+    cache.store(uri + '/metadata/1', response)
+    cache.store(uri + 'x', response)
+    cache.invalidate(uri)
+    fresh = entity_cache(cache_dir=tmp_path)
+    assert fresh.lookup(uri) == (None, False)
+    assert fresh.lookup(uri + '/metadata/1') == (None, False)
+    assert fresh.lookup(uri + 'x')[0] is not None
+
+
+def test_disk_entries_are_never_seen_part_written(server, tmp_path):
+    ref = server.add_entity('IO', 'Asset ' + 'x' * 100000)
+    uri = server.url(ref)
+    writer = connect(server, entity_cache(cache_dir=tmp_path))
+    writer.get_object(uri)
+    entry, _ = writer.cache.lookup(uri)
+    stop = threading.Event()
+    errors = []
+
+    def write():
+        while not stop.is_set():
+            writer.cache.touch(uri, dict(entry))
+
+    def read():
+        for _ in range(300):
+            found = entity_cache(cache_dir=tmp_path)._read_disk(uri)
+            if found is None:
+                continue
+            try:
+                entity.from_bytes(found['content'])
+            except Exception as e:
+                errors.append(e)
+    threads = [threading.Thread(target=write) for _ in range(2)]
+    for t in threads:
+        t.start()
+    try:
+        read()
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    assert errors == []
+
+
+def test_security_tag_change_invalidates_descendants(server):
+    root = server.add_entity('SO', 'Root')
+    folder = server.add_entity('SO', 'Folder', parent=root)
+    asset = server.add_entity('IO', 'Asset', parent=folder)
+    session = connect(server, entity_cache(ttl=3600))
+    uris = [server.url(ref) for ref in (root, folder, asset)]
+    objects = [session.get_object(uri) for uri in uris]
+    session.update_security_tag(objects[0], 'closed', descendants=True)
+    assert [session.get_object(uri).securityTag for uri in uris] == [
+        'closed'] * 3
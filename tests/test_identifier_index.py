@@ -0,0 +1,73 @@
+import pytest
+from preservica_API import preservica_session
+from preservica_API.identifier_index import (
+    identifier_index, resolve_one, resolve)
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    server.populate(folders=2, items=3)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+@pytest.fixture
+def index(tmp_path):
+    with identifier_index(tmp_path / 'identifiers.db') as index:
+        yield index
+
+
+def test_resolved_identifiers_are_indexed(server, session, index):
+    results = dict(resolve(
+        session, ['TEST.0.0', 'TEST.1.2', 'MISSING'], index=index))
+    assert [o.title for o in results['TEST.0.0']] == ['Item TEST.0.0']
+    assert results['MISSING'] == []
+    assert len(index) == 2
+    requests = server.requests
+    ident, objects = resolve_one(session, 'TEST.1.2', index=index)
+    assert len(objects) == 1
+    # only the entity itself is fetched, not looked up by identifier
+    assert server.requests - requests <= 1
+
+
+def test_stale_entry_that_now_matches_nothing_is_dropped(
+        server, session, index):
+    gone = server.url(server.add_entity('IO', 'Deleted'))
+    del server.entities[gone.rsplit('/', 1)[1]]
+    index.store('TEST.GONE', [gone])
+    assert resolve_one(session, 'TEST.GONE', index=index) == (
+        'TEST.GONE', [])
+    assert index.lookup('TEST.GONE') is None
+    assert len(index) == 0
+
+
+def test_stale_entry_is_refreshed(server, session, index):
+    gone = server.url(server.add_entity('IO', 'Deleted'))
+    del server.entities[gone.rsplit('/', 1)[1]]
+    index.store('TEST.0.1', [gone])
+    ident, objects = resolve_one(session, 'TEST.0.1', index=index)
+    assert [o.title for o in objects] == ['Item TEST.0.1']
+    assert index.lookup('TEST.0.1') == [objects[0].uri]
+
+
+def test_invalidate_uri_treats_wildcards_literally(index):
+    base = 'https://host/api/entity/information-objects/'
+    index.store('a', [base + 'ref_1'])
+    index.store('b', [base + 'refx1'])
+    index.store('c', [base + 'ref%1'])
+    index.store('d', [base + 'ref-100'])
+    index.invalidate_uri(base + 'ref_1')
+    index.invalidate_uri(base + 'ref%1')
+    assert index.lookup('a') is None
+    assert index.lookup('c') is None
+    assert index.lookup('b') == [base + 'refx1']
+    assert index.lookup('d') == [base + 'ref-100']
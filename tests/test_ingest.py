@@ -0,0 +1,91 @@
+import zipfile
+import pytest
+
+moto = pytest.importorskip('moto')
+from preservica_API import s3upload
+from pyservica import ingest
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        bucket = s3upload.get_client('ingested')
+        bucket.create()
+        yield bucket
+
+
+def make_sources(tmp_path, *names):
+    sources = []
+    for name in names:
+        source = tmp_path / 'sources' / name
+        (source / 'folder').mkdir(parents=True)
+        (source / 'folder' / 'file.txt').write_text(f'content of {name}')
+        sources.append(source)
+    return sources
+
+
+def run(sources, outdir, upload, **kwargs):
+    job = ingest.ingest(
+        sources, outdir, upload, build_workers=2, upload_workers=2,
+        min_free=0, interval=0.1, **kwargs)
+    return job, job.run()
+
+
+def test_ingest_uploads_every_source(bucket, tmp_path):
+    sources = make_sources(tmp_path, 'a', 'b', 'c')
+    outdir = tmp_path / 'out'
+    job, failed = run(
+        sources, outdir, ingest.s3_uploader(bucket.name, workers=2))
+    assert failed == []
+    assert job.uploaded.count == 3
+    assert len(list(bucket.objects.all())) == 3
+    assert list(outdir.iterdir()) == []
+
+
+def test_kept_sips_from_earlier_runs_survive(tmp_path):
+    sources = make_sources(tmp_path, 'a', 'b')
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    (outdir / 'a.zip').write_bytes(b'kept from an earlier run')
+    (outdir / 'other.zip').write_bytes(b'unrelated')
+    job, failed = run(sources, outdir, lambda path: True)
+    assert failed == []
+    assert (outdir / 'a.zip').read_bytes() == b'kept from an earlier run'
+    assert (outdir / 'other.zip').read_bytes() == b'unrelated'
+    assert zipfile.is_zipfile(outdir / 'b.zip')
+    scratch, = [p for p in outdir.iterdir() if p.is_dir()]
+    assert [p.name for p in scratch.iterdir()] == ['a.zip']
+
+
+def no_sip_for_b(source, outdir, parent, security, namespace):
+    if source.endswith('b'):
+        return None
+    return real_build(source, outdir, parent, security, namespace)
+
+
+real_build = ingest._build
+
+
+def test_build_without_a_sip_fails_only_its_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, '_build', no_sip_for_b)
+    sources = make_sources(tmp_path, 'a', 'b')
+    uploaded = []
+
+    def upload(path):
+        uploaded.append(path)
+        return True
+    job, failed = run(sources, tmp_path / 'out', upload)
+    assert failed == [str(sources[1])]
+    assert job.built.failed == 1
+    assert [p.rsplit('/', 1)[1] for p in uploaded] == ['a.zip']
+
+
+def test_duplicate_source_names_rejected(tmp_path):
+    first = make_sources(tmp_path, 'a')
+    second = tmp_path / 'elsewhere' / 'a'
+    second.mkdir(parents=True)
+    with pytest.raises(ValueError):
+        ingest.ingest(first + [second], tmp_path / 'out', None)
@@ -0,0 +1,60 @@
+import pytest
+from preservica_API import preservica_session
+from preservica_API.metadata import fetch_metadata
+from preservica_API.mock_server import mock_preservica
+
+MODS = 'http://www.loc.gov/mods/v3'
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+def described(server, title, fragments=2):
+    ref = server.add_entity('IO', title)
+    for n in range(fragments):
+        server.add_metadata(
+            ref, MODS, f'<mods xmlns="{MODS}"><note>{title} {n}</note></mods>')
+    return server.url(ref)
+
+
+def notes(fragments):
+    return sorted(frag['content'][0].text for frag in fragments)
+
+
+def test_repeated_entity_keeps_its_own_fragments(server, session):
+    uris = [described(server, title) for title in ('a', 'b')]
+    objects = [session.get_object(uri) for uri in uris]
+    results = list(fetch_metadata(
+        session, [objects[0], objects[1], objects[0]], workers=4))
+    assert len(results) == 3
+    assert sorted(notes(fragments) for _, fragments in results) == [
+        ['a 0', 'a 1'], ['a 0', 'a 1'], ['b 0', 'b 1']]
+
+
+def test_failed_fragment_is_logged_not_raised(server, session, monkeypatch):
+    uris = [described(server, title) for title in ('a', 'b')]
+    objects = [session.get_object(uri) for uri in uris]
+    broken = objects[0].metadata[1]['uri']
+    get_fragment = session.get_fragment
+
+    def flaky(uri):
+        if uri == broken:
+            raise ConnectionError('connection reset')
+        return get_fragment(uri)
+    monkeypatch.setattr(session, 'get_fragment', flaky)
+    results = {o.title: f for o, f in fetch_metadata(session, objects)}
+    assert notes(results['b']) == ['b 0', 'b 1']
+    contents = {frag['uri']: frag['content'] for frag in results['a']}
+    assert contents[broken] is None
+    assert len([c for c in contents.values() if c is not None]) == 1
@@ -0,0 +1,177 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+moto = pytest.importorskip('moto')
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from preservica_API import s3upload
+
+MB = s3upload.MB
+PARTS = TransferConfig(
+    multipart_threshold=5 * MB, multipart_chunksize=5 * MB, max_concurrency=1)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        bucket = s3upload.get_client('uploads')
+        bucket.create()
+        yield bucket
+
+
+@pytest.fixture
+def package(tmp_path):
+    fpath = tmp_path / 'package.zip'
+    fpath.write_bytes(os.urandom(12 * MB))
+    return fpath
+
+
+def upload(bucket, fpath, journal, config=PARTS, **kwargs):
+    return s3upload.S3upload(
+        fpath, bucket.name, delete_source=False, client=bucket,
+        config=config, journal=journal, checksum_algorithm='SHA256',
+        **kwargs)
+
+
+def interrupt(monkeypatch, at=2):
+    """Makes the upload of part number at fail."""
+    upload_part = s3upload._upload_part
+
+    def flaky(client, bucket, key, upload_id, number, data, algorithm):
+        if number == at:
+            raise ClientError(
+                {'Error': {'Code': '500', 'Message': 'interrupted'}},
+                'UploadPart')
+        return upload_part(
+            client, bucket, key, upload_id, number, data, algorithm)
+    monkeypatch.setattr(s3upload, '_upload_part', flaky)
+
+
+def list_checksums(monkeypatch, fpath, chunksize=5 * MB):
+    """moto doesn't return part checksums from list_parts, as S3 does, so
+    every part would be sent again. Adds them from the package."""
+    def uploaded_parts(client, bucket, key, upload_id, algorithm):
+        data = fpath.read_bytes()
+        parts = {}
+        for part in client.list_parts(
+                Bucket=bucket, Key=key, UploadId=upload_id).get('Parts', []):
+            n = part['PartNumber']
+            chunk = data[(n - 1) * chunksize:n * chunksize]
+            parts[n] = {
+                'PartNumber': n, 'ETag': part['ETag'],
+                f'Checksum{algorithm}': s3upload._checksum(chunk, algorithm),
+                'Size': part['Size']}
+        return parts
+    monkeypatch.setattr(s3upload, '_uploaded_parts', uploaded_parts)
+
+
+def entries(journal):
+    with open(journal) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_rerun_skips_completed_upload(bucket, package, tmp_path):
+    journal = tmp_path / 'journal.jsonl'
+    key = upload(bucket, package, journal)
+    assert upload(bucket, package, journal) == key
+    assert [o.key for o in bucket.objects.all()] == [key]
+
+
+def test_interrupt_resume_rerun(bucket, package, tmp_path, monkeypatch):
+    journal = tmp_path / 'journal.jsonl'
+    list_checksums(monkeypatch, package)
+    with monkeypatch.context() as m:
+        interrupt(m)
+        assert upload(bucket, package, journal) is None
+    key = upload(bucket, package, journal)
+    assert key is not None
+    assert upload(bucket, package, journal) == key
+    assert [o.key for o in bucket.objects.all()] == [key]
+    complete = entries(journal)[-1]
+    assert complete['status'] == 'complete'
+    assert complete['key'] == key
+    assert complete['sha256'] == hashlib.sha256(
+        package.read_bytes()).hexdigest()
+    body = bucket.Object(key).get()['Body'].read()
+    assert body == package.read_bytes()
+
+
+def test_resume_keeps_recorded_checksum_algorithm(
+        bucket, package, tmp_path, monkeypatch):
+    journal = tmp_path / 'journal.jsonl'
+    list_checksums(monkeypatch, package)
+    with monkeypatch.context() as m:
+        interrupt(m)
+        upload(bucket, package, journal)
+    s3upload.S3upload(
+        package, bucket.name, delete_source=False, client=bucket,
+        config=PARTS, journal=journal, checksum_algorithm='CRC32C')
+    assert entries(journal)[-1]['checksum_algorithm'] == 'SHA256'
+
+
+def test_resume_finishes_multipart_upload_under_single_put_config(
+        bucket, package, tmp_path, monkeypatch):
+    journal = tmp_path / 'journal.jsonl'
+    list_checksums(monkeypatch, package)
+    with monkeypatch.context() as m:
+        interrupt(m)
+        upload(bucket, package, journal)
+    whole = TransferConfig(
+        multipart_threshold=64 * MB, multipart_chunksize=64 * MB)
+    key = upload(bucket, package, journal, config=whole)
+    assert key is not None
+    client = bucket.meta.client
+    assert not client.list_multipart_uploads(
+        Bucket=bucket.name).get('Uploads')
+    assert [o.key for o in bucket.objects.all()] == [key]
+
+
+@pytest.mark.parametrize('algorithm', ['SHA256', 'CRC32C'])
+def test_single_put_sends_checksum(bucket, tmp_path, monkeypatch, algorithm):
+    if algorithm == 'CRC32C' and s3upload.crc32c is None:
+        pytest.skip('needs crc32c')
+    fpath = tmp_path / 'small.zip'
+    fpath.write_bytes(os.urandom(3 * MB + 17))
+    (tmp_path / 'small.zip.sha256').write_text(
+        hashlib.sha256(fpath.read_bytes()).hexdigest() + '  small.zip\n')
+    # moto neither checks nor returns checksums, so look at what was sent
+    client = bucket.meta.client
+    put_object = client.put_object
+    sent = {}
+
+    def spy(**kwargs):
+        sent.update(kwargs)
+        return put_object(**kwargs)
+    monkeypatch.setattr(client, 'put_object', spy)
+    key = s3upload.S3upload(
+        fpath, bucket.name, delete_source=False, client=bucket,
+        config=PARTS, checksum_algorithm=algorithm)
+    assert bucket.Object(key).get()['Body'].read() == fpath.read_bytes()
+    assert sent[f'Checksum{algorithm}'] == s3upload._checksum(
+        fpath.read_bytes(), algorithm)
+
+
+def test_single_put_rejects_sidecar_mismatch(bucket, tmp_path):
+    fpath = tmp_path / 'small.zip'
+    fpath.write_bytes(b'package')
+    (tmp_path / 'small.zip.sha256').write_text('0' * 64 + '  small.zip\n')
+    assert s3upload.S3upload(
+        fpath, bucket.name, delete_source=False, client=bucket,
+        config=PARTS) is None
+    assert not list(bucket.objects.all())
+
+
+def test_tracker_counts_across_short_lived_threads():
+    tracker = s3upload.ProgressTracker()
+    for _ in range(20):
+        with ThreadPoolExecutor(4) as ex:
+            for _ in range(10):
+                ex.submit(tracker, 5)
+    assert tracker.sent == 20 * 10 * 5
+    assert not hasattr(tracker, '_counters')
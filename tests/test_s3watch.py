@@ -0,0 +1,80 @@
+import time
+import threading
+from concurrent.futures import Future
+import pytest
+
+moto = pytest.importorskip('moto')
+from preservica_API import s3upload, s3watch
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        bucket = s3upload.get_client('watched')
+        bucket.create()
+        yield bucket
+
+
+class InlineExecutor(object):
+    """Runs each task as it is submitted, so every upload finishes before
+    submit returns."""
+
+    def __init__(self, workers):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def watch(directory, count, **kwargs):
+    watcher = s3watch.folder_watcher(
+        directory, 'watched', interval=0.05, settle=0, **kwargs)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while watcher.completed < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    watcher.stop()
+    thread.join()
+    return watcher
+
+
+def make_packages(directory, count):
+    for n in range(count):
+        (directory / f'{n}.zip').write_bytes(f'package {n}'.encode())
+
+
+def test_uploads_finishing_before_submit_returns(
+        bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(s3watch, 'ThreadPoolExecutor', InlineExecutor)
+    make_packages(tmp_path, 10)
+    watcher = watch(tmp_path, 10)
+    assert watcher.completed == 10
+    assert not watcher._active
+
+
+def test_many_small_packages_all_upload(bucket, tmp_path):
+    make_packages(tmp_path, 50)
+    watcher = watch(tmp_path, 50, workers=8)
+    assert watcher.completed == 50
+    assert watcher.failed == 0
+    assert not watcher._active
+    assert len(list(bucket.objects.all())) == 50
+
+
+def test_vanished_packages_are_forgotten(bucket, tmp_path):
+    make_packages(tmp_path, 5)
+    watcher = watch(tmp_path, 5, delete_source=True)
+    assert watcher.completed == 5
+    assert list(tmp_path.glob('*.zip')) == []
+    watcher.poll()
+    assert watcher._finished == {}
+    assert watcher._failures == {}
@@ -0,0 +1,134 @@
+import io
+import time
+import threading
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from lxml import etree
+from preservica_API import preservica_session, meta_update, sync_pipeline
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    server.populate(folders=2, items=3)
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+def export(path, idents, truncate=False):
+    with open(path, 'w') as f:
+        f.write('<table name="ecatalogue">')
+        for n, ident in enumerate(idents):
+            f.write(
+                f'<tuple><atom name="EADUnitID">{ident}</atom>'
+                f'<atom name="EADUnitTitle">Title {n}</atom></tuple>')
+        if not truncate:
+            f.write('</table>')
+    return path
+
+
+def run(pipeline, timeout=60):
+    """Runs pipeline in a thread so a hang fails the test rather than the
+    whole run. Returns what run returned or raises what it raised."""
+    result = {}
+
+    def target():
+        try:
+            result['writes'] = pipeline.run()
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'sync did not finish'
+    if 'error' in result:
+        raise result['error']
+    return result['writes']
+
+
+def test_sync_then_unchanged(session, tmp_path):
+    xml = export(tmp_path / 'export.xml', [f'TEST.{f}.{i}'
+                                          for f in range(2) for i in range(3)])
+    state = meta_update.sync_state(tmp_path / 'state.db')
+    first = sync_pipeline.sync_pipeline(
+        session, str(xml), state=state, report=io.StringIO(), processes=1,
+        api_workers=4)
+    assert run(first) > 0
+    assert first.synced.count == 6
+    second = sync_pipeline.sync_pipeline(
+        session, str(xml), state=state, report=io.StringIO(), processes=1,
+        api_workers=4)
+    assert run(second) == 0
+    assert second.unchanged.count == 6
+
+
+def test_records_sharing_an_identifier_are_serialised(
+        session, tmp_path, monkeypatch):
+    xml = export(tmp_path / 'export.xml', ['TEST.0.0', 'TEST.0.1'] * 10)
+    sync_record = meta_update.sync_record
+    active = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def tracked(session, ident, *args, **kwargs):
+        with lock:
+            if ident in active:
+                overlaps.append(ident)
+            active.add(ident)
+        try:
+            time.sleep(0.01)
+            return sync_record(session, ident, *args, **kwargs)
+        finally:
+            with lock:
+                active.discard(ident)
+    monkeypatch.setattr(meta_update, 'sync_record', tracked)
+    pipeline = sync_pipeline.sync_pipeline(
+        session, str(xml), report=io.StringIO(), processes=1, api_workers=8)
+    run(pipeline)
+    assert pipeline.synced.count == 20
+    assert overlaps == []
+    assert pipeline._idents == {}
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_parse_error_is_raised(session, tmp_path):
+    xml = export(tmp_path / 'export.xml', ['TEST.0.0'], truncate=True)
+    pipeline = sync_pipeline.sync_pipeline(
+        session, str(xml), report=io.StringIO(), processes=1)
+    with pytest.raises(etree.XMLSyntaxError):
+        run(pipeline)
+
+
+class BrokenPool(object):
+
+    def __init__(self, processes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def submit(self, fn, *args):
+        raise BrokenProcessPool('crosswalk process died')
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_broken_crosswalk_pool_is_raised(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_pipeline, 'ProcessPoolExecutor', BrokenPool)
+    xml = export(tmp_path / 'export.xml', ['TEST.0.0', 'TEST.0.1'])
+    pipeline = sync_pipeline.sync_pipeline(
+        session, str(xml), report=io.StringIO(), processes=1)
+    with pytest.raises(BrokenProcessPool):
+        run(pipeline)
@@ -0,0 +1,76 @@
+import pytest
+from preservica_API import preservica_session, walker
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica(page_size=3)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+@pytest.fixture
+def tree(server):
+    """A root with three levels of folders, two per folder, and two assets
+    with a content object each in every folder."""
+    root = server.add_entity('SO', 'Root')
+    refs = []
+    level = [root]
+    for depth in range(3):
+        below = []
+        for parent in level:
+            for n in range(2):
+                folder = server.add_entity('SO', 'Folder', parent=parent)
+                below.append(folder)
+                refs.append(folder)
+                for i in range(2):
+                    asset = server.add_entity('IO', 'Asset', parent=folder)
+                    content = server.add_entity('CO', 'File', parent=asset)
+                    refs += [asset, content]
+        level = below
+    return root, refs
+
+
+def test_walk_finds_everything(session, tree):
+    root, refs = tree
+    found = list(walker.walk(session, root))
+    assert sorted(c['ref'] for c in found) == sorted(refs)
+    assert {c['type'] for c in found} == {'SO', 'IO', 'CO'}
+
+
+def test_max_depth_and_fetch(session, tree):
+    root, refs = tree
+    found = list(walker.walk(
+        session, root, types=['SO', 'IO'], max_depth=2, fetch=True))
+    # two folders, then two folders and two assets in each
+    assert len(found) == 2 + 2 * 4
+    assert sorted(e.depth for e in found) == [1] * 2 + [2] * 8
+
+
+def test_interrupted_walk_resumes_from_checkpoint(
+        session, tree, tmp_path, monkeypatch):
+    monkeypatch.setattr(walker, 'CHECKPOINT_EVERY', 1)
+    root, refs = tree
+    checkpoint = tmp_path / 'walk.json'
+    first = []
+    walk = walker.walk(session, root, workers=1, checkpoint=checkpoint)
+    for child in walk:
+        first.append(child['ref'])
+        if len(first) == 40:
+            break
+    walk.close()
+    assert checkpoint.exists()
+    rest = [c['ref'] for c in walker.walk(
+        session, root, workers=1, checkpoint=checkpoint)]
+    assert not checkpoint.exists()
+    assert set(first) | set(rest) == set(refs)
+    # only folders in flight at the interruption are listed again
+    assert len(rest) < len(refs)
@@ -0,0 +1,91 @@
+import os
+import json
+import zipfile
+from datetime import datetime, timezone, timedelta
+import pytest
+import xip_builder
+
+FRAGMENT = '<note xmlns="http://example.com/note">{}</note>'
+
+
+@pytest.fixture(autouse=True)
+def keep_cwd(monkeypatch):
+    # main changes into the directory it builds
+    monkeypatch.chdir(os.getcwd())
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'accession'
+    (source / 'box').mkdir(parents=True)
+    (source / 'box' / 'one.txt').write_text('one')
+    (source / 'box' / 'metadata.xml').write_text(FRAGMENT.format('box'))
+    return source
+
+
+def build(source, tmp_path, **kwargs):
+    outdir = tmp_path / 'out'
+    outdir.mkdir(exist_ok=True)
+    return xip_builder.main(
+        source, outdir, parent='parent-ref', algorithms=['SHA256'], **kwargs)
+
+
+def names(sip):
+    with zipfile.ZipFile(sip) as z:
+        return sorted(
+            n.split('/', 1)[1] for n in z.namelist()
+            if '/' in n and not n.endswith('metadata.xml'))
+
+
+def xip(sip):
+    with zipfile.ZipFile(sip) as z:
+        name, = [n for n in z.namelist() if n.endswith('/metadata.xml')]
+        return z.read(name).decode()
+
+
+def test_delta_build_sends_only_changes(source, tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    first = build(source, tmp_path, manifest=manifest)
+    assert 'content/box/one.txt' in names(first)
+    box = json.loads(manifest.read_text())['folders']['box']
+    assert build(source, tmp_path, manifest=manifest) is None
+
+    (source / 'box' / 'two.txt').write_text('two')
+    (source / 'box' / 'metadata.xml').write_text(FRAGMENT.format('changed'))
+    second = build(source, tmp_path, manifest=manifest)
+    assert second.name == 'accession_2.zip'
+    assert names(second) == ['content/box/two.txt']
+    document = xip(second)
+    assert f'<Parent>{box}</Parent>' in document
+    assert f'<Entity>{box}</Entity>' in document
+    assert 'changed' in document
+    recorded = json.loads(manifest.read_text())
+    assert recorded['builds'] == 2
+    assert recorded['metadata']['box/metadata.xml']['ref'] is not None
+
+
+def test_pending_manifest_committed_after_upload(source, tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    build(source, tmp_path, manifest=manifest)
+    committed = manifest.read_text()
+    (source / 'box' / 'two.txt').write_text('two')
+    assert build(source, tmp_path, manifest=manifest, pending=True)
+    assert manifest.read_text() == committed
+    # an upload that failed is offered again
+    assert build(source, tmp_path, manifest=manifest, pending=True)
+    xip_builder.commit_manifest(manifest)
+    assert json.loads(manifest.read_text())['builds'] == 2
+    assert build(source, tmp_path, manifest=manifest) is None
+
+
+def test_reproducible_builds_are_identical(source, tmp_path, monkeypatch):
+    when = datetime(2024, 5, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+    builds = []
+    for user in ['alice', 'bob']:
+        monkeypatch.setattr(xip_builder.getpass, 'getuser', lambda: user)
+        outdir = tmp_path / user
+        outdir.mkdir()
+        builds.append(xip_builder.main(
+            source, outdir, parent='parent-ref', namespace='accession',
+            timestamp=when).read_bytes())
+    assert builds[0] == builds[1]
@@ -0,0 +1,36 @@
+import pytest
+from preservica_API import preservica_session
+from preservica_API.mock_server import mock_preservica
+
+
+@pytest.fixture
+def server():
+    server = mock_preservica()
+    server.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def session(server):
+    return preservica_session(
+        'test', 'test', server.host, 'TEST', protocol='http')
+
+
+def test_patch_xipmeta_updates_and_skips_no_ops(server, session):
+    ref = server.add_entity('IO', 'Old title')
+    object = session.get_object(server.url(ref))
+    r = session.patch_xipmeta(object, {'Title': 'New title'})
+    assert r.status_code == 200
+    assert server.entities[ref]['title'] == 'New title'
+    assert object.title == 'New title'
+    assert session.patch_xipmeta(
+        session.get_object(server.url(ref)), {'Title': 'New title'}) is None
+
+
+def test_patch_xipmeta_of_missing_entity(server, session):
+    ref = server.add_entity('IO', 'Deleted')
+    object = session.get_object(server.url(ref))
+    del server.entities[ref]
+    assert session.patch_xipmeta(object, {'Title': 'New title'}) is False
+    assert session.update_xipmeta(object, 'Title', 'New title') is False
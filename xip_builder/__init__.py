@@ -1,7 +1,9 @@
 from lxml import etree
-from uuid import uuid4
-from datetime import datetime
+from uuid import uuid4, uuid5, UUID, NAMESPACE_URL
+from datetime import datetime, timezone
 import os
+import json
+import shutil
 import hashlib
 import argparse
 import zipfile
@@ -10,22 +12,66 @@ import pathlib
 import logging
 from io import BytesIO
 FORMAT = '%(asctime)-15s [%(levelname)s] %(message)s'
-logging.basicConfig(format=FORMAT)
 logger = logging.getLogger('siplog')
 logger.setLevel(logging.INFO)
 HASH_BLOCK_SIZE = 512 * 1024
 SUPPORTED_ALGS = ['MD5', 'SHA1', 'SHA256', 'SHA512']
+ZIP_EPOCH = datetime(1980, 1, 1)
+CREATED_BY = 'xip_builder'
+
+
+def log_to_console():
+    """Sends log messages to the console. Called by the command line
+    scripts; importing the module leaves logging to the application."""
+    logging.basicConfig(format=FORMAT)
+
+
+def source_date(default=ZIP_EPOCH):
+    """The time given by the SOURCE_DATE_EPOCH environment variable, in
+    UTC, or default if it isn't set."""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch is None:
+        return default
+    return datetime.utcfromtimestamp(int(epoch))
+
+
+def _namespace(namespace):
+    if namespace is None or isinstance(namespace, UUID):
+        return namespace
+    try:
+        return UUID(namespace)
+    except ValueError:
+        return uuid5(NAMESPACE_URL, namespace)
 
 
 class Sip(zipfile.ZipFile):
-    def __init__(self, fpath, parent=None, name=None):
+    def __init__(self, fpath, parent=None, name=None, mode='a',
+                 namespace=None, timestamp=None, created_by=None):
         """Class representing a Preservica V6 Submission Information Package
         (SIP). Initialises a new, empty SIP at fpath, or if fpath exists,
-        loads the SIP for modification or analysis.
+        loads the SIP for modification or analysis. Pass mode='r' to open an
+        existing SIP read only.
+
+        For reproducible SIPs, pass a namespace (a UUID, or a string to
+        derive one from) and a timestamp (a datetime). Refs are then uuid5s
+        of the namespace and each entity's place in the hierarchy, and
+        timestamp is used for generation dates, the protocol and zip
+        entries, so the same input built the same way gives identical bytes.
+        created_by is recorded in the protocol; it defaults to the current
+        user, or to CREATED_BY for reproducible SIPs.
         """
+        self.namespace = _namespace(namespace)
+        if timestamp is not None and timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        self.timestamp = timestamp
+        if created_by is None:
+            reproducible = namespace is not None or timestamp is not None
+            created_by = CREATED_BY if reproducible else getpass.getuser()
+        self.created_by = created_by
+        self._keys = set()
         if os.path.exists(fpath):
             logger.info(f'Opening existing SIP at {fpath}')
-            super(Sip, self).__init__(fpath, 'a')
+            super(Sip, self).__init__(fpath, mode)
             for file in self.filelist:
                 fpath = pathlib.Path(file.filename)
                 if fpath.name == 'metadata.xml':
@@ -38,7 +84,8 @@ class Sip(zipfile.ZipFile):
             logger.info(f'Creating new SIP at {fpath}')
             super(Sip, self).__init__(
                 fpath, 'w', compression=zipfile.ZIP_DEFLATED)
-            self.sipref = str(uuid4())
+            self.sipref = self.new_ref(
+                'SIP', name or pathlib.Path(fpath).stem)
             self.xip = etree.Element(
                 'XIP',
                 nsmap={None: "http://preservica.com/XIP/v6.0"})
@@ -49,6 +96,44 @@ class Sip(zipfile.ZipFile):
             else:
                 self.name = name
 
+    def new_ref(self, *parts):
+        """Returns a random ref or, with a namespace, one derived from
+        parts, numbered if the same parts have already been used."""
+        if self.namespace is None:
+            return str(uuid4())
+        key = '/'.join(str(part) for part in parts)
+        unique, n = key, 1
+        while unique in self._keys:
+            n += 1
+            unique = f'{key}#{n}'
+        self._keys.add(unique)
+        return str(uuid5(self.namespace, unique))
+
+    def now(self):
+        return (self.timestamp or datetime.now()).isoformat()
+
+    def _zipinfo(self, arcname, size=0):
+        info = zipfile.ZipInfo(
+            pathlib.PurePath(arcname).as_posix(),
+            max(self.timestamp, ZIP_EPOCH).timetuple()[:6])
+        info.compress_type = self.compression
+        info.external_attr = 0o644 << 16
+        info.file_size = size
+        return info
+
+    def _write(self, fpath, arcname):
+        if self.timestamp is None:
+            self.write(fpath, arcname=arcname)
+            return
+        info = self._zipinfo(arcname, os.path.getsize(fpath))
+        with open(fpath, 'rb') as src, self.open(info, 'w') as dst:
+            shutil.copyfileobj(src, dst, HASH_BLOCK_SIZE)
+
+    def _writestr(self, arcname, data):
+        if self.timestamp is not None:
+            arcname = self._zipinfo(arcname)
+        self.writestr(arcname, data)
+
     def get_structs(self):
         structs = {}
         for e in self.xip.findall('StructuralObject', namespaces=self.xip.nsmap):
@@ -81,6 +166,48 @@ class Sip(zipfile.ZipFile):
                 sums[name][alg] = hash
         return sums
 
+    def verify(self):
+        """Checks every bitstream in the XIP against the package: that it is
+        present, is the recorded size and matches its fixities. Returns a
+        list of (filename, problem) tuples, empty if the SIP is sound."""
+        problems = []
+        content = pathlib.Path(self.content).as_posix()
+        for elem in self.xip.findall('Bitstream', namespaces=self.xip.nsmap):
+            name = elem.findtext('Filename', namespaces=self.xip.nsmap)
+            location = elem.findtext(
+                'PhysicalLocation', namespaces=self.xip.nsmap) or ''
+            arcname = pathlib.PurePosixPath(content, location, name).as_posix()
+            try:
+                info = self.getinfo(arcname)
+            except KeyError:
+                problems.append((arcname, 'missing from package'))
+                continue
+            size = elem.findtext('FileSize', namespaces=self.xip.nsmap)
+            if size is not None and int(size) != info.file_size:
+                problems.append(
+                    (arcname, f'{info.file_size} bytes, expected {size}'))
+            expected = {}
+            for fixity in elem.findall('Fixities/Fixity', namespaces=self.xip.nsmap):
+                alg = fixity.findtext(
+                    'FixityAlgorithmRef', namespaces=self.xip.nsmap)
+                expected[alg] = fixity.findtext(
+                    'FixityValue', namespaces=self.xip.nsmap).lower()
+            hashers = self._get_hashers(expected)
+            try:
+                with self.open(info) as f:
+                    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                        for hasher in hashers.values():
+                            hasher.update(block)
+            except zipfile.BadZipFile as e:
+                problems.append((arcname, str(e)))
+                continue
+            for alg, value in expected.items():
+                actual = hashers[alg].hexdigest()
+                if actual != value:
+                    problems.append(
+                        (arcname, f'{alg} {actual}, expected {value}'))
+        return problems
+
     def get_info(self):
         """Set filecount and filesize attributes for the protocol file."""
         self.filecount = 0
@@ -192,7 +319,7 @@ class Sip(zipfile.ZipFile):
         also information objects. Parent is the uuid of the destination folder
         in Preservica.
         """
-        ref = str(uuid4())
+        ref = self.new_ref('StructuralObject', parent_ref, title)
         logger.info(f'Adding StructuralObject {title} {ref}')
         sobj = self.add_xipelement(
             self.xip, 'StructuralObject')
@@ -215,7 +342,7 @@ class Sip(zipfile.ZipFile):
         self contained and not hierarchical.
         folder_ref is the uuid of the containing structural object.
         """
-        ref = str(uuid4())
+        ref = self.new_ref('InformationObject', folder_ref, title)
         logger.info(f'Adding InformationObject {title} {ref}')
         sobj = self.add_xipelement(
             self.xip, 'InformationObject')
@@ -253,7 +380,7 @@ class Sip(zipfile.ZipFile):
         """A logically atomic piece of content, for example an attachment or an
         email.
         """
-        ref = str(uuid4())
+        ref = self.new_ref('ContentObject', info_ref, fname)
         logger.info(f'Adding ContentObject {fname} {ref} to {info_ref}')
         content = self.add_xipelement(self.xip, 'ContentObject')
         self.add_xipelement(content, 'Ref').text = ref
@@ -275,7 +402,7 @@ class Sip(zipfile.ZipFile):
         self.add_xipelement(gen, 'ContentObject').text = contobj_ref
         self.add_xipelement(gen, 'Label').text = label
         self.add_xipelement(
-            gen, 'EffectiveDate').text = datetime.now().isoformat()
+            gen, 'EffectiveDate').text = self.now()
         b = self.add_xipelement(gen, 'Bitstreams')
         for bitstream in bitstreams:
             fpath = pathlib.Path(bitstream)
@@ -307,7 +434,7 @@ class Sip(zipfile.ZipFile):
             posix_path = ''
         if write:
             logger.info(f'Writing {fpath} to package')
-            self.write(fpath, arcname=arcname)
+            self._write(fpath, arcname)
         bstream = self.add_xipelement(self.xip, 'Bitstream')
         self.add_xipelement(bstream, 'Filename').text = arcname.name
         self.add_xipelement(
@@ -328,7 +455,7 @@ class Sip(zipfile.ZipFile):
     def add_asset_tree(self, parent_ref, fpath, security_tag='open', checksum=None):
         """Simple method for adding an InformationObject > ContentObject >
         Representation > Generation > Bitstream hierarchy where there's a 1:1
-        relationship in the hierarchy.
+        relationship in the hierarchy. Returns the InformationObject ref.
         """
         fpath = pathlib.Path(fpath)
         i = self.add_infobj(fpath.stem, parent_ref, security_tag=security_tag)
@@ -338,6 +465,7 @@ class Sip(zipfile.ZipFile):
         if checksum is None:
             checksum = self.hash_file(fpath, ['SHA256', 'SHA512'])
         self.add_bitstream(fpath, checksum)
+        return i
 
     def add_manifestation(self, info_ref, filepaths, type, security_tag='open', algorithms=['SHA256', 'SHA512'], rep_name=None, gen_label=''):
         """Add a manifestation to an existing information object. Filepaths
@@ -392,16 +520,16 @@ class Sip(zipfile.ZipFile):
             'protocol',
             nsmap={None: "http://www.tessella.com/xipcreateprotocol/v1"})
         logger.info(f'Writing protocol')
-        etree.SubElement(prot, 'dateCreated').text = datetime.now().isoformat()
+        etree.SubElement(prot, 'dateCreated').text = self.now()
         etree.SubElement(prot, 'size').text = str(self.filesize)
         etree.SubElement(prot, 'files').text = str(self.filecount)
         etree.SubElement(prot, 'submissionName').text = self.name
         etree.SubElement(prot, 'catalogueName').text = self.name
         etree.SubElement(prot, 'localAIP').text = self.sipref
         etree.SubElement(prot, 'globalAIP').text = self.parent
-        etree.SubElement(prot, 'createdBy').text = getpass.getuser()
+        etree.SubElement(prot, 'createdBy').text = self.created_by
         tree = etree.ElementTree(prot)
-        self.writestr(self.sipref+'.protocol', etree.tostring(
+        self._writestr(self.sipref+'.protocol', etree.tostring(
             tree, pretty_print=True, encoding="UTF-8",
             xml_declaration=True, standalone=True))
 
@@ -409,7 +537,7 @@ class Sip(zipfile.ZipFile):
         logger.info(f'Writing XIP')
         self.sort_xip()
         tree = etree.ElementTree(self.xip)
-        self.writestr(
+        self._writestr(
             os.path.join(self.sipref, 'metadata.xml'),
             etree.tostring(
                 tree, pretty_print=True, encoding="UTF-8",
@@ -439,8 +567,8 @@ class Sip(zipfile.ZipFile):
         InformationObjects or ContentObjects. fragment is the root element of
         an xml tree.
         """
-        ref = str(uuid4())
         nspace = fragment.tag.split('}')[0].strip('{')
+        ref = self.new_ref('Metadata', targetref, nspace)
         logger.info(f'Adding Metadata {nspace} to {targetref}')
         metadata = self.add_xipelement(
             self.xip, 'Metadata', schemaUri=nspace)
@@ -452,7 +580,7 @@ class Sip(zipfile.ZipFile):
 
     def add_extendedxip(self, targetref, earliest, latest, surrogate=True):
         nspace = "http://preservica.com/ExtendedXIP/v6.0"
-        ref = str(uuid4())
+        ref = self.new_ref('Metadata', targetref, nspace)
         logger.info(f'Adding Metadata {nspace} to {targetref}')
         metadata = etree.SubElement(self.xip, 'Metadata', schemaUri=nspace)
         etree.SubElement(metadata, 'Ref').text = ref
@@ -492,34 +620,177 @@ class Sip(zipfile.ZipFile):
         return({alg: hasher.hexdigest() for alg, hasher in hashers.items()})
 
 
-def main(basedir, outdir, parent=None, security='open', identifier=None):
+def load_manifest(path):
+    """Reads a build manifest written by main, or returns None if there
+    isn't one at path."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path, manifest):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def commit_manifest(path):
+    """Replaces the manifest at path with the one a main(pending=True)
+    build left beside it, once its SIP has been safely uploaded."""
+    os.replace(f'{path}.pending', path)
+
+
+def _changes(fpath, entry, algorithms):
+    """Returns (stat, checksums) for fpath, or None if it matches its
+    manifest entry. Files are only rehashed if their size or modification
+    time has changed."""
+    stat = fpath.stat()
+    if (entry is not None and entry['size'] == stat.st_size
+            and entry['mtime_ns'] == stat.st_mtime_ns):
+        return None
+    checksums = Sip.hash_file(
+        fpath, algorithms if entry is None else entry['fixities'])
+    if entry is not None and entry['fixities'] == checksums:
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return None
+    return stat, checksums
+
+
+def _entry(stat, checksums, ref):
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'fixities': checksums, 'ref': ref}
+
+
+def main(basedir, outdir, parent=None, security='open', identifier=None,
+         manifest=None, algorithms=['SHA256', 'SHA512'], namespace=None,
+         timestamp=None, created_by=None, pending=False):
     """
     Very simple method for building a V6 SIP with only single manifestations.
+    Returns the path of the SIP.
+
+    If manifest is given, the size, modification time, fixities and refs of
+    everything in the SIP, metadata.xml files included, are recorded there.
+    When it already holds the manifest of an earlier build of basedir, the
+    SIP only contains new and changed files, in new folders or under the
+    refs of existing ones, and None is returned if nothing has changed. A
+    changed file or metadata.xml is added again beside the one already in
+    Preservica, as a SIP can't replace it.
+
+    The manifest is updated as soon as the SIP is built, so if the SIP then
+    fails to upload its files won't be offered again. To avoid that, pass
+    pending=True and call commit_manifest once the upload has succeeded.
+
+    With a namespace, the SIP is reproducible (see Sip) and dated timestamp,
+    or SOURCE_DATE_EPOCH, or 1980-01-01 if that isn't set either.
     """
+    basedir = pathlib.Path(basedir).resolve()
+    outdir = pathlib.Path(outdir).resolve()
+    if manifest is not None:
+        manifest = os.path.abspath(manifest)
+        previous = load_manifest(manifest)
+    else:
+        previous = None
+    if previous is None:
+        folders, files, fragments, build = {}, {}, {}, 1
+    else:
+        parent = previous['parent']
+        folders, files = previous['folders'], previous['files']
+        fragments = previous['metadata']
+        build = previous['builds'] + 1
+    if namespace is not None:
+        if timestamp is None:
+            timestamp = source_date()
+        if build > 1:
+            # keep refs of files added again distinct from the earlier ones
+            namespace = uuid5(_namespace(namespace), f'build {build}')
     os.chdir(basedir)
-    basedir = pathlib.Path(basedir)
-    sip_path = pathlib.Path(outdir) / (basedir.name+'.zip')
-    with Sip(sip_path, parent) as sip:
-        for root, dirs, files in os.walk(os.getcwd()):
-            parent = sip.add_structobj(
-                os.path.split(root)[1],
-                parent_ref=parent, security_tag=security)
-            for file in files:
-                fpath = pathlib.Path(root) / file
-                if file == 'metadata.xml':
-                    fragment = etree.parse(str(pathlib.Path(root, file)))
-                    sip.add_metadata(parent, fragment.getroot())
-                else:
-                    relpath = fpath.relative_to(fpath.cwd())
-                    sip.add_asset_tree(parent, relpath, security_tag=security)
-        if identifier is not None:
-            top_refs = [elem.findtext('Ref', namespaces=elem.nsmap) for elem in sip.get_top()]
-            for ref in top_refs:
-                sip.add_identifier(ref, identifier)
-        sip.serialise()
+
+    new_folders, metadata, assets, seen = [], [], [], set()
+    for root, dirs, filenames in os.walk(basedir):
+        dirs.sort()
+        folder = pathlib.Path(root).relative_to(basedir).as_posix()
+        if folder not in folders:
+            parent_folder = None if folder == '.' else \
+                pathlib.PurePosixPath(folder).parent.as_posix()
+            new_folders.append(
+                (folder, os.path.split(root)[1], parent_folder))
+        for file in sorted(filenames):
+            fpath = pathlib.Path(root, file).relative_to(basedir)
+            relpath = fpath.as_posix()
+            seen.add(relpath)
+            if file == 'metadata.xml':
+                entry = fragments.get(relpath)
+                changes = _changes(fpath, entry, ['SHA256'])
+                if changes is None:
+                    continue
+                if entry is not None:
+                    logger.warning(
+                        f'{relpath} has changed since it was added as '
+                        f'{entry["ref"]}, adding it as a new fragment')
+                metadata.append((folder, fpath) + changes)
+                continue
+            entry = files.get(relpath)
+            changes = _changes(fpath, entry, algorithms)
+            if changes is None:
+                continue
+            if entry is not None:
+                logger.info(
+                    f'{relpath} has changed since it was added as '
+                    f'{entry["ref"]}, adding it again')
+            assets.append((folder, fpath) + changes)
+    for entries in (files, fragments):
+        for relpath in set(entries) - seen:
+            logger.info(f'{relpath} is no longer in {basedir}')
+            del entries[relpath]
+
+    sip_path = None
+    if previous is not None and not (new_folders or assets or metadata):
+        logger.info(f'No changes in {basedir} since the last build')
+    else:
+        name = basedir.name if build == 1 else f'{basedir.name}_{build}'
+        sip_path = outdir / (name + '.zip')
+        if sip_path.exists():
+            # eg a delta rebuilt after its upload failed; Sip would append
+            logger.info(f'Replacing {sip_path}')
+            sip_path.unlink()
+        with Sip(sip_path, parent, name=basedir.name, namespace=namespace,
+                 timestamp=timestamp, created_by=created_by) as sip:
+            for folder, title, parent_folder in new_folders:
+                folders[folder] = sip.add_structobj(
+                    title, security_tag=security,
+                    parent_ref=parent if parent_folder is None
+                    else folders[parent_folder])
+            for folder, fpath, stat, checksums in metadata:
+                fragment = etree.parse(str(fpath))
+                fragments[fpath.as_posix()] = _entry(
+                    stat, checksums,
+                    sip.add_metadata(folders[folder], fragment.getroot()))
+            for folder, fpath, stat, checksums in assets:
+                files[fpath.as_posix()] = _entry(
+                    stat, checksums, sip.add_asset_tree(
+                        folders[folder], fpath, security_tag=security,
+                        checksum=checksums))
+            if identifier is not None and previous is None:
+                top_refs = [elem.findtext('Ref', namespaces=elem.nsmap) for elem in sip.get_top()]
+                for ref in top_refs:
+                    sip.add_identifier(ref, identifier)
+            sip.serialise()
+    if manifest is not None:
+        # with nothing to upload there is nothing to wait for
+        if pending and sip_path is not None:
+            manifest += '.pending'
+        write_manifest(manifest, {
+            'source': str(basedir), 'parent': parent,
+            'builds': build if sip_path is not None else build - 1,
+            'folders': folders, 'files': files, 'metadata': fragments})
+    return sip_path
 
 
 if __name__ == '__main__':
+    log_to_console()
     parser = argparse.ArgumentParser(
         description='Build a simple SIP from a directory')
     parser.add_argument(
@@ -535,6 +806,14 @@ if __name__ == '__main__':
     parser.add_argument(
         '--identifier', type=str,
         help='identifier to be appended to top folder')
+    parser.add_argument(
+        '--manifest', type=str,
+        help='build manifest; if it exists, only new and changed files are '
+        'included in the SIP')
+    parser.add_argument(
+        '--namespace', type=str,
+        help='build a reproducible SIP, with refs derived from this UUID or '
+        'name. Timestamps are taken from SOURCE_DATE_EPOCH')
 
     args = parser.parse_args()
     main(
@@ -542,4 +821,6 @@ if __name__ == '__main__':
         args.out,
         parent=args.parent,
         security=args.security,
-        identifier=args.identifier)
+        identifier=args.identifier,
+        manifest=args.manifest,
+        namespace=args.namespace)